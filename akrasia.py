@@ -1,21 +1,42 @@
 import constants as c
 import discord
+import gzip
+import json
 import logging
 import os
 import sqlalchemy as db
+import tempfile
 
+from alias_cache import AliasCache
 from asyncio import ensure_future, get_event_loop
-from database_utils import Alias, AuditLogEntry, init_databases, get_or_init_server, get_or_init_user, update_database
+from audit_archive import AuditLogArchiver
+from avatar_cache import AvatarCache
+from command_args import ArgumentError, ArgumentSchema, split_command_args
+from command_scheduler import CommandScheduler
+from cooldowns import CooldownLimiter
+from database_executor import DatabaseExecutor, ExecutorSession
+from database_utils import AuditLogEntry, Server, User, init_audit_log_search, init_databases, get_or_init_server, get_or_init_user, update_database
+from default_modules.quotes import crop_avatar, load_render_resources
 from discord import Intents
+from hook_matcher import HookMatcher
+from identity_cache import IdentityCache
+from image_fetcher import ImageFetcher
 from json import load
 from logger import Logger
-from message_utils import MessageWrapper, send_lines
-from re import match
+from loop_monitor import LoopLagMonitor
+from message_utils import MessageWrapper
+from metrics import Metrics
+from outbound import OutboundQueue
+from profiler import CommandProfiler
+from quote_cache import QuoteCache
+from render_pool import RenderPool
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql.expression import func
 from sys import stdout
+from time import perf_counter
+from unit_of_work import UnitOfWork, UnitOfWorkStats
 
-from reactions import BasicReactionEvent, ReactionEvent
+from reactions import BasicReactionEvent, ReactionEvent, ReactionEventRegistry
 
 
 class Akrasia(discord.Client):
@@ -24,7 +45,16 @@ class Akrasia(discord.Client):
         self.bot_log = logging.getLogger(__name__)  # use a logger unique to akrasia
 
         super().__init__(intents=Intents.all())
+        self.database_executor = DatabaseExecutor() # blocking database calls go through here so they don't stall the event loop
         self.db_engine, self.db_session_builder = self.init_db_connection()
+        self.metrics = Metrics(self) # latencies and error counts, for !stats and the metrics endpoint
+        self.metrics.listen_to(self.db_engine)
+        self.loop_monitor = LoopLagMonitor(self) # finds out what's blocking the event loop when something does
+        self.command_profiler = CommandProfiler() # off until the config or !profiles says otherwise
+        self.unit_of_work_stats = UnitOfWorkStats(self) # statements and commits per command
+        self.unit_of_work_stats.listen_to(self.db_engine, self.db_session_builder)
+        self.identity_cache = IdentityCache([User, Server]) # so get_or_init_user/get_or_init_server don't SELECT on every command
+        self.identity_cache.listen_to(self.db_session_builder)
         self.event_loop = get_event_loop()
         self.version = "0.2.0"
         self.background_loops = background_loops
@@ -32,7 +62,15 @@ class Akrasia(discord.Client):
         self.database_uri = None
         self.user_command_cooldown = c.DEFAULT_COMMAND_COOLDOWN
         self.user_hook_cooldown = c.DEFAULT_HOOK_COOLDOWN
+        self.cooldown_limiter = CooldownLimiter({"command": self.user_command_cooldown, "hook": self.user_hook_cooldown})
+        self.command_scheduler = CommandScheduler(self)
         self.audit_logger = Logger()
+        self.outbound_queue = OutboundQueue(self.metrics) # every reply goes through here
+        self.image_fetcher = ImageFetcher(self.metrics) # shared by everything that downloads images (quotes, avatars)
+        self.render_pool = RenderPool(initializer=load_render_resources, metrics=self.metrics) # quote images are drawn in here, off the event loop
+        self.avatar_cache = AvatarCache(crop_avatar) # cropped avatars for quotes, in memory and on disk
+        self.quote_cache = QuoteCache() # rendered quotes by content, so quoting the same messages again skips the render (and the upload)
+        self.audit_log_archiver = AuditLogArchiver()
         self.status_list = ["with electrons"]
         self.change_status_timer = c.CHANGE_STATUS_TIMER
         self.help_messages = c.DEFAULT_HELP_DICT
@@ -43,11 +81,14 @@ class Akrasia(discord.Client):
             "auditlog": self.audit_log,
             "deletealias": self.delete_alias, # tested
             "echo": self.echo, # tested
+            "profiles": self.profiles,
             "help": self.help,
-            "setserver": self.set_server # tested,
+            "setserver": self.set_server, # tested
+            "stats": self.stats
         }
+        self.command_schemas = {} # keyword -> ArgumentSchema, for commands that declared their arguments
         self.hooks_dict = {}
-        self.reaction_events = {}
+        self.reaction_events = ReactionEventRegistry() # message id -> BasicReactionEvent/ReactionEvent; register new ones with self.reaction_events.register(event)
 
         if modules is not None:
             for module in modules:
@@ -55,6 +96,8 @@ class Akrasia(discord.Client):
                     if keyword not in self.command_dict:
                         self.command_dict[keyword] = function_help_pair[0]
                         self.help_messages[keyword] = function_help_pair[1]
+                        if len(function_help_pair) > 2: # optional third element: the command's argument schema
+                            self.command_schemas[keyword] = ArgumentSchema(function_help_pair[2])
                     else:
                         self.bot_log.warning("Failed to add modular function {} because a function with that keyword already existed!")
 
@@ -65,6 +108,9 @@ class Akrasia(discord.Client):
                         self.hooks_dict[hook_regex] = hook_function
                     else:
                         self.bot_log.warning("Failed to add hook {} because a hook with that regex already existed!")
+        self.hook_matcher = HookMatcher(self.hooks_dict) # compile every hook into one pattern up front, instead of re.match-ing them one-by-one per message
+        self.alias_cache = AliasCache(self.command_dict) # must be made after all the modules are in command_dict, since it keeps references to their functions
+        self.alias_cache.listen_to(self.db_session_builder)
 
     def run(self):
         with open("config.json") as f:
@@ -77,11 +123,36 @@ class Akrasia(discord.Client):
             self.command_prefix = config["command_prefix"]
             self.user_command_cooldown = config["per_user_command_cooldown"]
             self.user_hook_cooldown = config["per_user_hook_cooldown"]
+            cooldown_persist_interval = config.get("cooldown_persist_interval", c.DEFAULT_COOLDOWN_PERSIST_INTERVAL) # optional, so older configs still work
+            self.audit_log_archiver = AuditLogArchiver(config.get("audit_log_retention_days", c.DEFAULT_AUDIT_LOG_RETENTION_DAYS),
+                                                       {int(guild_id): days for guild_id, days in config.get("audit_log_retention_overrides", {}).items()}) # JSON keys are always strings
+            self.identity_cache.max_size = config.get("identity_cache_size", c.IDENTITY_CACHE_SIZE)
+            self.avatar_cache.max_images = config.get("avatar_cache_size", c.AVATAR_MEMORY_CACHE_SIZE)
+            self.avatar_cache.max_disk_bytes = config.get("avatar_disk_cache_bytes", c.AVATAR_DISK_CACHE_BYTES)
+            self.quote_cache.max_bytes = config.get("quote_cache_bytes", c.QUOTE_CACHE_BYTES)
+            self.command_scheduler = CommandScheduler(self, config.get("global_command_concurrency", c.COMMAND_GLOBAL_CONCURRENCY), config.get("guild_command_concurrency", c.COMMAND_GUILD_CONCURRENCY))
+            self.loop_monitor.threshold = config.get("loop_lag_threshold", c.LOOP_LAG_THRESHOLD)
+            self.command_profiler = CommandProfiler(config.get("profile_commands", []), [int(guild_id) for guild_id in config.get("profile_guilds", [])], config.get("profile_latency_threshold", 0))
+            self.render_pool = RenderPool(config.get("render_workers", c.RENDER_WORKERS), config.get("render_max_pending", c.RENDER_MAX_PENDING), load_render_resources, self.metrics)
+            metrics_host = config.get("metrics_host", c.METRICS_HOST)
+            metrics_port = config.get("metrics_port", c.METRICS_PORT)
             token = config["token"]
 
             if config["database_uri"]:
                 self.database_uri = config["database_uri"]
 
+        self.audit_logger.start(self)
+        self.cooldown_limiter = CooldownLimiter({"command": self.user_command_cooldown, "hook": self.user_hook_cooldown}, persist_interval=cooldown_persist_interval)
+        if self.cooldown_limiter.persist_interval:
+            ensure_future(self.cooldown_limiter.persist_loop(self))
+
+        ensure_future(self.audit_log_archiver.retention_loop(self)) # returns right away if retention isn't configured
+        self.reaction_events.load(self)
+        ensure_future(self.loop_monitor.start()) # returns right away if the monitor is turned off
+        if metrics_port:
+            ensure_future(self.metrics.serve(metrics_host, metrics_port))
+        ensure_future(self.reaction_events.sweep_loop(self))
+
         if self.background_loops is not None:
             for loop_function in self.background_loops: # insert all of the background loops into the client's event loop
                 ensure_future(loop_function(self))
@@ -90,156 +161,182 @@ class Akrasia(discord.Client):
 
     def init_db_connection(self):
         database_uri = "sqlite:///{}/{}/{}".format(os.getcwd(), c.DATABASE_DIR, c.MAIN_DATABASE_NAME)
-        engine = db.create_engine(database_uri)
+        engine = db.create_engine(database_uri, connect_args={"check_same_thread": False}) # sessions are made on the event loop but do their work on the database thread
         init_databases(engine)
+        self.audit_log_search_enabled = init_audit_log_search(engine) # False on backends without FTS5, in which case !auditlog searches scan
         if os.path.exists(database_uri[10:]):
             self.bot_log.info("Connected to existing database at {}".format(database_uri))
         else:
             self.bot_log.info("Created new database at {}".format(database_uri))
             update_database()
 
-        session_builder = sessionmaker(bind=engine) # create the tool we'll use to make sessions in the future
+        session_builder = sessionmaker(bind=engine, class_=ExecutorSession, database_executor=self.database_executor) # create the tool we'll use to make sessions in the future
         return engine, session_builder
 
+    async def close(self):
+        await self.command_scheduler.close() # let running commands finish (and get audit logged) first
+        await self.audit_logger.close() # write out everything still buffered
+        await self.database_executor.run(self.cooldown_limiter.persist, self) # save whatever cooldowns changed since the last batch
+        if self.reaction_events.persistent_changed:
+            self.reaction_events.save(self)
+        self.loop_monitor.close()
+        await self.image_fetcher.close()
+        self.render_pool.shutdown()
+        await self.metrics.close()
+        await super().close()
+        self.database_executor.shutdown()
+
     # Hooks for Discord events
     async def on_ready(self):
         self.bot_log.info("successfully logged in with version: {}".format(self.version))
 
+        session = self.db_session_builder()
+        try:
+            await session.run(self.alias_cache.load_all, session)
+            self.bot_log.info("loaded aliases for {} servers".format(len(self.alias_cache.guild_aliases)))
+        except Exception as e:
+            self.bot_log.error("Couldn't bulk load aliases (they'll be loaded per-server instead); error was: {}".format(e))
+        finally:
+            session.close()
+
     async def on_message(self, message):
         if message.author == self.user: # avoid feedback loops
             return
 
         if len(message.content) > len(self.command_prefix) and message.content[:len(self.command_prefix)] == self.command_prefix: # don't get tripped on images/files that have no message.content
-            await self.handle_command(message)
+            if not self.cooldown_limiter.try_acquire("command", message.author.id, message.created_at): # checked before queueing, so spam costs nothing
+                self.bot_log.warning("User {} (id: {}) ran another command before their command cooldown was up".format(message.author.name, message.author.id))
+                return
+            command_keyword = message.content[c.PREFIX_LENGTH:].split(" ", 1)[0].lower()
+            if not self.command_scheduler.submit(message, command_keyword):
+                self.bot_log.warning("Dropped command from user {} (id: {}); too many commands are already queued for their server".format(message.author.name, message.author.id))
             return # don't respond both to commands and hooks
 
+        if not self.hook_matcher.could_match(message.content): # skip computing clean_content (which rewrites every mention) for messages that can't trigger a hook
+            return
+
         clean_content = message.clean_content.lower() if message.clean_content is not None else None
         if clean_content:
-            for hook in self.hooks_dict:
-                if match(hook, clean_content):
-                    await self.handle_hook(message, hook)
-                    return # don't let the bot spam if someone sends a message with 60 triggers
+            hook = self.hook_matcher.match(clean_content) # only returns the first matching hook, so the bot doesn't spam if someone sends a message with 60 triggers
+            if hook is not None:
+                await self.handle_hook(message, hook)
 
     async def on_reaction_add(self, reaction, user):
         if user == self.user: # avoid feedback loops
             return False
 
-        if reaction.message in self.reaction_events:
-            reaction_event = self.reaction_events[reaction.message]
+        reaction_event = self.reaction_events.get(reaction.message.id)
+        if reaction_event is None:
+            return
 
-            if reaction_event.universal or user.id in reaction_event.allowed_responses:
-                reaction_emoji_name = reaction.emoji.name if reaction.emoji is discord.Emoji else reaction.emoji
-                if reaction_emoji_name in reaction_event.responses:
-                    reaction_event.uses -= 1
-                    if reaction_event.uses == 0:
-                        self.bot_log.info("reaction event on message {} is out of uses; removing...".format(reaction.message.id))
-                        self.reaction_events.pop(reaction.message)
+        if reaction_event.universal or user.id in reaction_event.allowed_users:
+            reaction_emoji_name = reaction.emoji.name if isinstance(reaction.emoji, discord.Emoji) else reaction.emoji
+            if reaction_emoji_name in reaction_event.responses:
+                remaining_uses = self.reaction_events.use(reaction.message.id)
+                if remaining_uses == 0:
+                    self.bot_log.info("reaction event on message {} is out of uses; removing...".format(reaction.message.id))
 
-                self.bot_log.info("triggering reaction event: (reaction: {}, remaining uses: {} message: {}, user: {}, guild: {})".format(reaction_emoji_name, reaction_event.uses, reaction.message.id, user.id, reaction.message.guild.id if reaction.message.guild else None))
+                self.bot_log.info("triggering reaction event: (reaction: {}, remaining uses: {}, message: {}, user: {}, guild: {})".format(reaction_emoji_name, remaining_uses, reaction.message.id, user.id, reaction.message.guild.id if reaction.message.guild else None))
                 await reaction.message.remove_reaction(reaction.emoji, user)
-                await reaction_event.responses[reaction_emoji_name](user, reaction_event.message.channel, reaction_emoji_name)
+                await reaction_event.responses[reaction_emoji_name](user, reaction.message.channel, reaction_emoji_name)
 
     async def handle_command(self, message):
         command_content = message.content[c.PREFIX_LENGTH:].split(" ") # cut off the prefix
-        command_args = self.__get_command_args(command_content) # None if len(command_content) == 1 else command_content[1:]
+        command_args = split_command_args(command_content[1:])
         command_keyword = None
+        start_time = perf_counter()
+        profile = self.command_profiler.start() if self.command_profiler.enabled else None
 
-        session = self.db_session_builder()
+        unit_of_work = UnitOfWork(self, "unknown command") # renamed once we know it's a real command, so made-up keywords don't each get their own stats
+        session = unit_of_work.session
+        self.loop_monitor.label_task("command (unknown)")
         try:
             command_keyword = command_content[0].lower()
             command_function = self.command_dict.get(command_keyword)
 
-            relevant_user = get_or_init_user(self, message, session)
-            if relevant_user.last_command_time is not None and (message.created_at - relevant_user.last_command_time).total_seconds() < self.user_command_cooldown:
-                self.bot_log.warning("User {} (id: {}) ran another command before their command cooldown was up".format(message.author.name, message.author.id))
-                return None
-            else:
-                relevant_user.last_command_time = message.created_at
-                session.commit() # commit here so people can't spam invalid commands and abuse the except: rollback
-
+            relevant_user = await session.run(get_or_init_user, self, message, session)
             if message.guild is None: # if in a DM, set the server to the user's home server, if they have one
-                if relevant_user.main_server is not None: # set the guild of the message to the user's main guild
+                if relevant_user.main_server_id is not None: # set the guild of the message to the user's main guild
                     home_guild = self.get_guild(relevant_user.main_server_id)
                     message = MessageWrapper(message, home_guild, home_guild.get_member(message.author.id)) # WARNING: if something you're doing is horribly and subtly broken, this is probably why
 
             if command_function is None: # if it's not a hardcoded command, check to see if it's an alias
-                aliased_command = session.query(Alias).filter(db.and_(Alias.server_id == message.guild.id, Alias.alias == command_keyword)).first()
+                aliased_command = self.alias_cache.get(message.guild.id, command_keyword, session)
                 if aliased_command is None:
                     raise Exception("unknown command recieved: {}".format(command_keyword)) # early exit and close the session
                 else:
-                    aliased_function_parts = aliased_command.true_function.split(" ")
-                    command_function = self.command_dict.get(aliased_function_parts[0])
-                    if len(aliased_function_parts) > 1:
-                        command_args = aliased_function_parts[1:] + command_args
-
-            self.audit_logger.log(self, message, session) # must audit log *after* setting the server to the home server
-
-            command_reply = await command_function(self, message, command_args, session)
+                    command_function = aliased_command.function
+                    command_keyword = aliased_command.keyword # the schema (if any) belongs to the real command
+                    if len(aliased_command.args) > 0:
+                        command_args = aliased_command.args + command_args
+            unit_of_work.name = command_keyword
+            self.loop_monitor.label_task("command {}".format(command_keyword))
+
+            await self.audit_logger.log(self, message, session) # must audit log *after* setting the server to the home server
+
+            command_reply = None
+            command_schema = self.command_schemas.get(command_keyword)
+            if command_schema is not None:
+                try:
+                    command_args = command_schema.parse(command_args)
+                except ArgumentError as e: # bad arguments never reach the command itself
+                    self.bot_log.info("User {} (id: {}) gave invalid arguments to {}: {}".format(message.author.name, message.author.id, command_keyword, e))
+                    command_reply = "{}".format(e)
+            if command_reply is None:
+                handler_start_time = perf_counter()
+                command_reply = await command_function(self, message, command_args, session)
+                self.metrics.observe("akrasia_command_handler_duration_seconds", perf_counter() - handler_start_time, command=command_keyword)
             if command_reply:
                 if len(command_reply) > 2000: # send replies that would have had to be split into multiple messages in DMs
                     if not isinstance(message.channel, discord.DMChannel):
-                        await message.channel.send("Check your DMs!")
-                    await send_lines(message.author, command_reply.split("\n"))
+                        await self.outbound_queue.send(message.channel, "Check your DMs!")
+                    await self.outbound_queue.send_lines(message.author, command_reply.split("\n"))
                 else:
-                    await message.channel.send(command_reply)
+                    await self.outbound_queue.send(message.channel, command_reply)
         except Exception as e:
             if "unknown command recieved" in str(e):
                 self.bot_log.info("{}".format(e))
             else:
                 self.bot_log.error("Something went wrong during function {}: {}".format(command_keyword, e))
-                await message.channel.send(c.DEFAULT_RETURN_MESSAGE)
-            session.rollback()
+                self.metrics.increment("akrasia_command_errors_total", command=unit_of_work.name)
+                await self.outbound_queue.send(message.channel, c.DEFAULT_RETURN_MESSAGE)
+            await unit_of_work.rollback()
+        else:
+            await unit_of_work.commit()
         finally:
-            session.commit()
-            session.close()
-
-    @staticmethod
-    def __get_command_args(command_content):
-        if len(command_content) == 1:
-            return []
-
-        command_args = []
-        current_arg = []
-        in_quotes = False
-        for word in [w for w in command_content[1:] if len(w) > 0]:
-            if word[0] == '"' and len(word) > 2:
-                word = word[1:]
-                in_quotes = True
-            if word[-1] == '"':
-                word = word[:-1]
-                in_quotes = False
-            current_arg.append(word)
-            if not in_quotes:
-                command_args.append(" ".join(current_arg))
-                current_arg = []
-        if len(current_arg) > 0: # clean up any unclosed quotes
-            command_args.append(" ".join(current_arg))
-
-        return command_args
+            unit_of_work.close()
+            self.loop_monitor.unlabel_task()
+            duration = perf_counter() - start_time
+            self.metrics.observe("akrasia_command_duration_seconds", duration, command=unit_of_work.name)
+            self.metrics.observe("akrasia_command_db_statements", unit_of_work.n_statements, command=unit_of_work.name)
+            if profile is not None:
+                profile_name = await self.command_profiler.finish(profile, unit_of_work.name, message.guild.id if message.guild is not None else None, duration)
+                if profile_name is not None:
+                    self.bot_log.info("Saved profile of {} ({:.0f}ms) as {}".format(unit_of_work.name, duration * 1000, profile_name))
 
     async def handle_hook(self, message, hook):
-        session = self.db_session_builder()
+        if not self.cooldown_limiter.try_acquire("hook", message.author.id, message.created_at):
+            self.bot_log.warning("User {} (id: {}) triggered another hook before their hook cooldown was up".format(message.author.name, message.author.id))
+            return None
+
+        start_time = perf_counter()
+        unit_of_work = UnitOfWork(self, hook)
+        session = unit_of_work.session
+        self.loop_monitor.label_task("hook {}".format(hook))
         try:
-            relevant_user = get_or_init_user(self, message, session)
-            if relevant_user.last_hook_time is not None and (message.created_at - relevant_user.last_hook_time).total_seconds() < self.user_hook_cooldown:
-                self.bot_log.warning("User {} (id: {}) triggered another hook before their hook cooldown was up".format(message.author.name, message.author.id))
-                return None
-            else:
-                relevant_user.last_hook_time = message.created_at
-                session.commit()  # commit here so people can't spam invalid commands and abuse the except: rollback
-
+            relevant_user = await session.run(get_or_init_user, self, message, session)
             hook_function = self.hooks_dict[hook]
 
             if message.guild is None:  # if in a DM, set the server to the user's home server, if they have one
-                if relevant_user.main_server is not None:  # set the guild of the message to the user's main guild
+                if relevant_user.main_server_id is not None:  # set the guild of the message to the user's main guild
                     home_guild = self.get_guild(relevant_user.main_server_id)
                     message = MessageWrapper(message, home_guild, home_guild.get_member(message.author.id))  # WARNING: if something you're doing is horribly and subtly broken, this is probably why
 
-            self.audit_logger.log(self, message, session)  # must audit log *after* setting the server to the home server
+            await self.audit_logger.log(self, message, session)  # must audit log *after* setting the server to the home server
 
             hook_reply = await hook_function(self, message, session)
             if hook_reply:
-                await message.channel.send(hook_reply)
+                await self.outbound_queue.send(message.channel, hook_reply)
 
             if message.guild is not None:
                 self.bot_log.info("Responded to hook {} in server {} (id: {})".format(hook, message.guild.name, message.guild.id))
@@ -247,11 +344,15 @@ class Akrasia(discord.Client):
                 self.bot_log.info("Responded to hook {} in DMs with user {} (id: {})".format(hook, message.author.name, message.author.id))
         except Exception as e:
             self.bot_log.error("Something went wrong during hook function for {}: {}".format(hook, e))
-            await message.channel.send(c.DEFAULT_RETURN_MESSAGE)
-            session.rollback()
+            self.metrics.increment("akrasia_hook_errors_total", hook=hook)
+            await self.outbound_queue.send(message.channel, c.DEFAULT_RETURN_MESSAGE)
+            await unit_of_work.rollback()
+        else:
+            await unit_of_work.commit()
         finally:
-            session.commit()
-            session.close()
+            unit_of_work.close()
+            self.loop_monitor.unlabel_task()
+            self.metrics.observe("akrasia_hook_duration_seconds", perf_counter() - start_time, hook=hook)
 
     # Command handling
     async def echo(self, _, message, command_args, __):
@@ -267,7 +368,7 @@ class Akrasia(discord.Client):
                 if len(command_args[0]) > 2 and command_args[0][:2] == "<#":
                     command_args[0] = command_args[0][2:-1] # turn a channel identifier like <#channelid> into channelid
 
-                await self.get_channel(int(command_args[0])).send(echo_message)
+                await self.outbound_queue.send(self.get_channel(int(command_args[0])), echo_message)
                 self.bot_log.info("Echoed the following message to channel {}: {}".format(command_args[0], echo_message))
                 return
         except discord.errors.HTTPException as e: # if that failed, we just echo the full command_args back to the channel
@@ -276,7 +377,7 @@ class Akrasia(discord.Client):
             pass
 
         echo_message = " ".join(command_args)
-        await message.channel.send(echo_message)
+        await self.outbound_queue.send(message.channel, echo_message)
         self.bot_log.info("Echoed the following message to channel {}: {}".format(message.channel.id, echo_message))
 
     async def add_alias(self, _, message, command_args, session):
@@ -298,7 +399,7 @@ class Akrasia(discord.Client):
         true_function_exists = self.command_dict.get(true_function_keyword)
         if true_function_exists is None:
             try: # check if we're aliasing to another alias; if so, map it to the true function of that alias
-                existing_alias = session.query(Alias).filter(db.and_(Alias.server_id == message.guild.id, Alias.alias == true_function)).first()
+                existing_alias = self.alias_cache.get(message.guild.id, true_function, session)
                 if existing_alias is None:
                     self.bot_log.info("Failed to add alias '{} = {}' in {} (id: {}); no such true function existed".format(alias, true_function, message.guild.name, message.guild.id))
                     return "The function you're trying to alias to doesn't exist!"
@@ -309,19 +410,19 @@ class Akrasia(discord.Client):
                 raise Exception("Couldn't look up existing aliases for {}: {}".format(true_function, e))
 
         try:
-            existing_alias = session.query(Alias).filter(db.and_(Alias.server_id == message.guild.id, Alias.alias == alias)).first()
+            existing_alias = self.alias_cache.get(message.guild.id, alias, session)
             if existing_alias is not None:
                 self.bot_log.info("Failed to add alias '{} = {}' in {} (id: {}); given alias already existed for {}".format(alias, true_function, message.guild.name, message.guild.id, existing_alias.true_function))
                 return "Alias already exists! (you can delete it using {}deletealias)".format(self.command_prefix)
         except Exception as e:
             raise Exception("Couldn't check if alias {} already existed: {}".format(alias, e))
 
-        alias_server = get_or_init_server(self, message.guild, session)
-        if len(alias_server.aliases) > c.MAX_ALIASES_PER_SERVER:
+        alias_server = await session.run(get_or_init_server, self, message.guild, session)
+        if len(self.alias_cache.aliases_for(message.guild.id, session)) > c.MAX_ALIASES_PER_SERVER:
             self.bot_log.error("Couldn't add alias to server {} (id: {}) because it had exceeded max aliases".format(message.guild.name, message.guild.id))
             return "Too many aliases on this server ({}). You should delete some with {}deletealias".format(c.MAX_ALIASES_PER_SERVER, self.command_prefix)
         try:
-            session.add(Alias(alias=alias, true_function=true_function, server=alias_server))
+            self.alias_cache.add(alias_server, alias, true_function, session) # only shows up in the cache once handle_command commits
         except Exception as e:
             raise Exception("Error adding alias '{} = {}' to server {} (id: {}); error was {}".format(alias, true_function, message.guild.name, message.guild.id, e))
 
@@ -341,7 +442,7 @@ class Akrasia(discord.Client):
         alias = alias[len(c.COMMAND_PREFIX):] if len(alias) > len(c.COMMAND_PREFIX) and alias[:len(c.COMMAND_PREFIX)] == c.COMMAND_PREFIX else alias
 
         try:
-            existing_alias = session.query(Alias).filter(db.and_(Alias.server_id == message.guild.id, Alias.alias == alias)).first()
+            existing_alias = self.alias_cache.get(message.guild.id, alias, session)
             if existing_alias is None:
                 self.bot_log.info("Failed to remove alias '{}' in server {} (id: {}); no such alias exists in database".format(alias, message.guild.name, message.guild.id))
                 return "No such alias exists!"
@@ -349,7 +450,7 @@ class Akrasia(discord.Client):
             raise Exception("Couldn't check if alias {} already existed: {}".format(alias, e))
 
         try:
-            session.delete(existing_alias)
+            await session.run(self.alias_cache.remove, message.guild.id, alias, session)
         except Exception as e:
             raise Exception("Error deleting alias '{} => {}' from server {} (id: {}); error was {}".format(alias, existing_alias.true_function, message.guild.name, message.guild.id, e))
 
@@ -362,21 +463,21 @@ class Akrasia(discord.Client):
         if not message.author.guild_permissions.administrator:
             return "You don't have permissions to run that command! (required permissions: administrator)"
 
-        server_aliases = session.query(Alias).filter(Alias.server_id == message.guild.id).all()
-        if len(server_aliases) == 0 or server_aliases is None:
+        server_aliases = list(self.alias_cache.aliases_for(message.guild.id, session).values())
+        if len(server_aliases) == 0:
             return "No aliases found!"
 
         return "{} aliases:\n".format(len(server_aliases)) + "\n".join(["{} => {} ".format(alias.alias, alias.true_function) for alias in server_aliases])
 
     async def set_server(self, _, message, command_args, session):
         if len(command_args) == 0: # no args defaults to current server, or resets the home server if called from DMs
-            user = get_or_init_user(self, message, session)
+            user = await session.run(get_or_init_user, self, message, session)
             if message.guild is None:
                 user.main_server = None
                 self.bot_log.info("Reset main server of {} (id: {})".format(message.author.name, message.author.id))
                 return "Cleared your home server!"
             else:
-                user.main_server = get_or_init_server(self, message.guild, session)
+                user.main_server = await session.run(get_or_init_server, self, message.guild, session)
                 self.bot_log.info("Set main server of {} (id: {}) to {} (id: {})".format(message.author.name, message.author.id, message.guild.name, message.guild.id))
                 return "Set home server to {}!".format(message.guild.name)
 
@@ -387,8 +488,8 @@ class Akrasia(discord.Client):
                 supposed_id = int(server_name_or_id)
                 server_matching_id = self.get_guild(supposed_id)
                 if server_matching_id is not None:
-                    main_server = get_or_init_server(self, server_matching_id, session)
-                    user = get_or_init_user(self, message, session)
+                    main_server = await session.run(get_or_init_server, self, server_matching_id, session)
+                    user = await session.run(get_or_init_user, self, message, session)
                     user.main_server = main_server
                     self.bot_log.info("Set main server of {} (id: {}) to {} (id: {})".format(message.author.name, message.author.id, main_server.name, main_server.id))
                     return "Set home server to {}!".format(server_matching_id.name)
@@ -409,8 +510,8 @@ class Akrasia(discord.Client):
             return "No servers found matching that search term!"
 
         server_matching_id = self.get_guild(servers_matching_search[0].id)
-        main_server = get_or_init_server(self, server_matching_id, session)
-        user = get_or_init_user(self, message, session)
+        main_server = await session.run(get_or_init_server, self, server_matching_id, session)
+        user = await session.run(get_or_init_user, self, message, session)
         user.main_server = main_server
         self.bot_log.info("Set main server of {} (id: {}) to {} (id: {})".format(message.author.name, message.author.id, main_server.name, main_server.id))
         return "Set home server to {}!".format(server_matching_id.name)
@@ -422,6 +523,10 @@ class Akrasia(discord.Client):
         if not message.author.guild_permissions.administrator:
             return "You don't have permissions to run that command! (required permissions: administrator)"
 
+        search_archive = len(command_args) > 0 and command_args[0].lower() == c.AUDIT_LOG_ARCHIVE_KEYWORD
+        if search_archive:
+            command_args = command_args[1:]
+
         if len(command_args) == 0:
             num_entries = c.DEFAULT_AUDIT_LOG_ENTRIES
             search_term = None
@@ -442,6 +547,7 @@ class Akrasia(discord.Client):
                 num_entries = c.DEFAULT_AUDIT_LOG_ENTRIES
                 search_term = " ".join(command_args).lower()
 
+        num_entries = max(num_entries, 0) # negative counts parse fine, but mean nothing (and would make SQLite's LIMIT unlimited)
         return_lines = []
         if num_entries > c.MAX_AUDIT_LOG_ENTRIES and message.author.id != c.AUTHOR_ID: # allow the bot owner to query arbitrarily many audit log lines
             return_lines.append("You requested too many lines, so here's the maximum ({})".format(return_lines))
@@ -449,10 +555,23 @@ class Akrasia(discord.Client):
             num_entries = c.MAX_AUDIT_LOG_ENTRIES
 
         self.bot_log.info("trying to send audit log to user {} (id: {}) based on (num_entries: {}, search_term: {})".format(message.author.name, message.author.id, num_entries, search_term))
-        if search_term is not None:
-            log_entries = session.query(AuditLogEntry).filter(db.and_(AuditLogEntry.guild_id == message.guild.id, func.lower(AuditLogEntry.message_content).contains(search_term.lower()))).order_by(AuditLogEntry.timestamp.desc()).limit(num_entries).all()
+        if search_archive: # archives are plain files, so read them on a worker thread rather than the database one
+            archived_lines = await self.event_loop.run_in_executor(None, self.audit_log_archiver.search, message.guild.id, search_term, num_entries)
+            if len(archived_lines) == 0:
+                self.bot_log.info("no archived audit log entries found for user {} (id: {}) based on (num_entries: {}, search_term: {})".format(message.author.name, message.author.id, num_entries, search_term))
+                return "No archived commands found matching the search terms (num_entries: {}, search_term: {})".format(num_entries, search_term)
+            self.bot_log.info("sent archived audit log to user {} (id: {}) based on (num_entries: {}, search_term: {})".format(message.author.name, message.author.id, num_entries, search_term))
+            return "\n".join(return_lines + archived_lines)
+
+        await self.audit_logger.flush() # so the results include commands still waiting in the buffer (like this one)
+        search_filter = self.__audit_log_search_filter(search_term)
+        if num_entries > c.AUDIT_LOG_EXPORT_THRESHOLD: # too many to send as messages (or to hold in memory at once), so send them as a file
+            return await self.__export_audit_log(message, search_term, search_filter, num_entries, session)
+
+        if search_filter is not None:
+            log_entries = await session.run(session.query(AuditLogEntry).filter(db.and_(AuditLogEntry.guild_id == message.guild.id, search_filter)).order_by(AuditLogEntry.timestamp.desc()).limit(num_entries).all)
         else:
-            log_entries = session.query(AuditLogEntry).filter(AuditLogEntry.guild_id == message.guild.id).order_by(AuditLogEntry.timestamp.desc()).limit(num_entries).all()
+            log_entries = await session.run(session.query(AuditLogEntry).filter(AuditLogEntry.guild_id == message.guild.id).order_by(AuditLogEntry.timestamp.desc()).limit(num_entries).all)
 
         if len(log_entries) == 0:
             self.bot_log.info("no audit log entries found for user {} (id: {}) based on (num_entries: {}, search_term: {})".format(message.author.name, message.author.id, num_entries, search_term))
@@ -464,21 +583,137 @@ class Akrasia(discord.Client):
         self.bot_log.info("sent audit log to user {} (id: {}) based on (num_entries: {}, search_term: {})".format(message.author.name, message.author.id, num_entries, search_term))
         return "\n".join(return_lines)
 
+    def __audit_log_search_filter(self, search_term):
+        if search_term is None:
+            return None
+
+        search_filter = func.lower(AuditLogEntry.message_content).contains(search_term.lower())
+        if self.audit_log_search_enabled and len(search_term) >= c.MIN_INDEXED_SEARCH_LENGTH and "%" not in search_term and "_" not in search_term: # the trigram index can't do shorter terms or LIKE wildcards
+            indexed_matches = db.text("SELECT rowid FROM auditlog_fts WHERE auditlog_fts MATCH :search_phrase").bindparams(search_phrase='"{}"'.format(search_term.replace('"', '""')))
+            search_filter = db.and_(AuditLogEntry.message_id.in_(indexed_matches), search_filter) # the index narrows it down; the original filter keeps the results exactly the same as a scan's
+        return search_filter
+
+    async def __export_audit_log(self, message, search_term, search_filter, num_entries, session):
+        """Streams up to num_entries matching entries (newest first) into a gzipped JSONL file a page at a time, then DMs it as one attachment"""
+        export_file = tempfile.NamedTemporaryFile(prefix="auditlog_", suffix=".jsonl.gz", delete=False)
+        export_file.close()
+        try:
+            n_exported = 0
+            last_entry_key = None
+            with gzip.open(export_file.name, "wt", encoding="utf-8") as export_writer:
+                while n_exported < num_entries:
+                    page = await session.run(self.__audit_log_page, session, message.guild.id, search_filter, last_entry_key, min(c.AUDIT_LOG_EXPORT_PAGE_SIZE, num_entries - n_exported))
+                    if len(page) == 0:
+                        break
+                    await self.event_loop.run_in_executor(None, self.__write_audit_log_page, export_writer, page) # compressing is CPU work, so keep it off the event loop (and the database thread)
+                    n_exported += len(page)
+                    last_entry_key = (page[-1].timestamp, page[-1].message_id)
+
+            if n_exported == 0:
+                self.bot_log.info("no audit log entries found to export for user {} (id: {}) based on (num_entries: {}, search_term: {})".format(message.author.name, message.author.id, num_entries, search_term))
+                return "No commands found matching the search terms (num_entries: {}, search_term: {})".format(num_entries, search_term)
+            if os.path.getsize(export_file.name) > c.MAX_UPLOAD_FILESIZE:
+                self.bot_log.warning("audit log export of {} entries for user {} (id: {}) was too big to upload ({} bytes)".format(n_exported, message.author.name, message.author.id, os.path.getsize(export_file.name)))
+                return "That export is too big to upload ({} entries); try asking for fewer, or using a search term.".format(n_exported)
+
+            await self.outbound_queue.send(message.author, "{} audit log entries from {} (newest first):".format(n_exported, message.guild.name), file=discord.File(export_file.name, filename="auditlog_{}.jsonl.gz".format(message.guild.id)))
+            self.bot_log.info("exported {} audit log entries to user {} (id: {}) based on (num_entries: {}, search_term: {})".format(n_exported, message.author.name, message.author.id, num_entries, search_term))
+            return "Exported {} commands; check your DMs!".format(n_exported)
+        finally:
+            os.remove(export_file.name)
+
+    @staticmethod
+    def __audit_log_page(session, guild_id, search_filter, last_entry_key, page_size):
+        page_query = session.query(AuditLogEntry.message_id, AuditLogEntry.user_id, AuditLogEntry.guild_id, AuditLogEntry.message_content, AuditLogEntry.timestamp).filter(AuditLogEntry.guild_id == guild_id)
+        if search_filter is not None:
+            page_query = page_query.filter(search_filter)
+        if last_entry_key is not None: # keyset pagination: pick up right after the last entry of the previous page, instead of OFFSET-ing past every earlier page
+            last_timestamp, last_message_id = last_entry_key
+            page_query = page_query.filter(db.or_(AuditLogEntry.timestamp < last_timestamp, db.and_(AuditLogEntry.timestamp == last_timestamp, AuditLogEntry.message_id < last_message_id)))
+        return page_query.order_by(AuditLogEntry.timestamp.desc(), AuditLogEntry.message_id.desc()).limit(page_size).all()
+
+    @staticmethod
+    def __write_audit_log_page(export_writer, page):
+        for entry in page:
+            export_writer.write(json.dumps({
+                "message_id": entry.message_id,
+                "user_id": entry.user_id,
+                "guild_id": entry.guild_id,
+                "message_content": entry.message_content,
+                "timestamp": entry.timestamp.isoformat() if entry.timestamp is not None else None
+            }) + "\n")
+
+    async def stats(self, _, message, command_args, __):
+        if message.author.id != c.AUTHOR_ID:
+            return "You don't have permission to run that command (required permissions: author)!"
+
+        if len(command_args) > 0 and command_args[0].lower() == "lag":
+            return "```\n{}\n```".format(self.loop_monitor.report())
+        return "```\n{}\n```".format(self.metrics.summary())
+
+    async def profiles(self, _, message, command_args, __):
+        if message.author.id != c.AUTHOR_ID:
+            return "You don't have permission to run that command (required permissions: author)!"
+
+        subcommand = command_args[0].lower() if len(command_args) > 0 else None
+        if subcommand == "get":
+            if len(command_args) < 2:
+                return "Which profile? (give its name or its number from {}profiles)".format(self.command_prefix)
+            profile_name = command_args[1]
+            if profile_name.isdigit():
+                profile_names = self.command_profiler.list_profiles()
+                profile_name = profile_names[int(profile_name) - 1] if 0 < int(profile_name) <= len(profile_names) else None
+            profile_path = self.command_profiler.profile_path(profile_name) if profile_name is not None else None
+            if profile_path is None:
+                return "No such profile!"
+            await self.outbound_queue.send(message.author, profile_name, file=discord.File(profile_path, filename=profile_name))
+            return "Sent!" if not isinstance(message.channel, discord.DMChannel) else None
+
+        if subcommand in ["command", "guild", "threshold"]:
+            if len(command_args) < 2:
+                return "Improper syntax (your message should look like this: {}profiles {} [value])".format(self.command_prefix, subcommand)
+            try:
+                if subcommand == "command":
+                    self.command_profiler.commands.add(command_args[1].lower())
+                elif subcommand == "guild":
+                    self.command_profiler.guild_ids.add(int(command_args[1]))
+                else:
+                    self.command_profiler.latency_threshold = float(command_args[1])
+            except ValueError:
+                return "Couldn't parse {} as a {}!".format(command_args[1], "guild ID" if subcommand == "guild" else "number of seconds")
+            self.bot_log.info("Now profiling commands: {}, guilds: {}, anything slower than: {}s".format(self.command_profiler.commands, self.command_profiler.guild_ids, self.command_profiler.latency_threshold))
+            return "Profiling {} {}!".format("commands slower than" if subcommand == "threshold" else subcommand, command_args[1])
+
+        if subcommand == "off":
+            self.command_profiler.commands = set()
+            self.command_profiler.guild_ids = set()
+            self.command_profiler.latency_threshold = 0
+            return "Stopped profiling commands."
+
+        try:
+            n_profiles = int(subcommand) if subcommand is not None else c.PROFILES_LISTED
+        except ValueError:
+            return "Improper syntax (try {}help profiles)".format(self.command_prefix)
+        profile_names = self.command_profiler.list_profiles()[:n_profiles]
+        if len(profile_names) == 0:
+            return "No profiles saved!"
+        return "{} most recent profiles:\n".format(len(profile_names)) + "\n".join(["{}. {}".format(i, profile_name) for i, profile_name in enumerate(profile_names, 1)])
+
     async def help(self, _, message, command_args, session):
         if len(command_args) == 0:
             commands = [keyword for keyword in self.command_dict]
             commands.sort() # alphabetize list so it's easier to find specific commands
             message_lines = ["Must run {}help with a specific command! Here's a list of commands:".format(self.command_prefix)] + commands
-            await send_lines(message.author, message_lines)
+            await self.outbound_queue.send_lines(message.author, message_lines)
             return
 
         keyword = command_args[0]
         keyword_is_function = self.command_dict.get(keyword)
         if keyword_is_function is None:
-            aliased_command = session.query(Alias).filter(db.and_(Alias.server_id == message.guild.id, Alias.alias == keyword)).first()
+            aliased_command = self.alias_cache.get(message.guild.id, keyword, session)
             if aliased_command is None:
                 return "This server doesn't have that command!"
             else:
-                keyword = aliased_command.true_function.split(" ")[0]
+                keyword = aliased_command.keyword
 
-        await message.author.send(self.help_messages[keyword])
+        await self.outbound_queue.send(message.author, self.help_messages[keyword])
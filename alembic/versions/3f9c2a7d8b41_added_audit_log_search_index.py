@@ -0,0 +1,49 @@
+"""added audit log search index
+
+Revision ID: 3f9c2a7d8b41
+Revises: 1d0d96b152df
+Create Date: 2026-10-18 07:20:11.482913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9c2a7d8b41'
+down_revision = '1d0d96b152df'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # substring (trigram) full-text index over auditlog.message_content for !auditlog searches; SQLite-only, and needs FTS5 + SQLite 3.34+
+    # everything is IF NOT EXISTS because fresh databases get the same index from database_utils.init_audit_log_search
+    if op.get_bind().dialect.name != "sqlite":
+        return
+
+    try:
+        index_existed = op.get_bind().execute(sa.text("SELECT 1 FROM sqlite_master WHERE name = 'auditlog_fts'")).first() is not None
+        op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS auditlog_fts USING fts5(message_content, content='auditlog', content_rowid='message_id', tokenize='trigram')")
+    except sa.exc.OperationalError: # no FTS5/trigram support; !auditlog falls back to scanning
+        return
+
+    op.execute("CREATE TRIGGER IF NOT EXISTS auditlog_fts_insert AFTER INSERT ON auditlog BEGIN "
+               "INSERT INTO auditlog_fts(rowid, message_content) VALUES (new.message_id, new.message_content); END")
+    op.execute("CREATE TRIGGER IF NOT EXISTS auditlog_fts_delete AFTER DELETE ON auditlog BEGIN "
+               "INSERT INTO auditlog_fts(auditlog_fts, rowid, message_content) VALUES ('delete', old.message_id, old.message_content); END")
+    op.execute("CREATE TRIGGER IF NOT EXISTS auditlog_fts_update AFTER UPDATE ON auditlog BEGIN "
+               "INSERT INTO auditlog_fts(auditlog_fts, rowid, message_content) VALUES ('delete', old.message_id, old.message_content); "
+               "INSERT INTO auditlog_fts(rowid, message_content) VALUES (new.message_id, new.message_content); END")
+    if not index_existed:
+        op.execute("INSERT INTO auditlog_fts(auditlog_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != "sqlite":
+        return
+
+    op.execute("DROP TRIGGER IF EXISTS auditlog_fts_insert")
+    op.execute("DROP TRIGGER IF EXISTS auditlog_fts_delete")
+    op.execute("DROP TRIGGER IF EXISTS auditlog_fts_update")
+    op.execute("DROP TABLE IF EXISTS auditlog_fts")
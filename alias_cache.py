@@ -0,0 +1,71 @@
+from database_utils import Alias
+from sqlalchemy import event
+
+PENDING_ALIAS_CHANGES_KEY = "pending_alias_changes"
+
+
+class CachedAlias:
+    def __init__(self, alias, true_function, command_dict):
+        self.alias = alias
+        self.true_function = true_function
+        self.function_parts = true_function.split(" ")
+        self.keyword = self.function_parts[0]
+        self.args = self.function_parts[1:] # the arguments baked into the alias, e.g. ["AAAAAAAAAAUGH"] for "echo AAAAAAAAAAUGH"
+        self.function = command_dict.get(self.keyword)
+
+
+class AliasCache:
+    """In-memory copy of the aliases table, keyed by guild ID
+
+    Changes made through add()/remove() are staged on the session and only applied once that session commits,
+    so a rolled back !addalias never shows up in the cache."""
+    def __init__(self, command_dict):
+        self.command_dict = command_dict
+        self.guild_aliases = {} # guild id -> {alias: CachedAlias}, in the same (id) order as the table
+        self.loaded_all = False # once load_all has run, a guild that isn't in guild_aliases just has no aliases
+
+    def listen_to(self, session_builder):
+        event.listen(session_builder, "after_commit", self.__apply_pending_changes)
+        event.listen(session_builder, "after_soft_rollback", self.__discard_pending_changes)
+
+    def load_all(self, session):
+        guild_aliases = {}
+        for alias in session.query(Alias).order_by(Alias.id).all():
+            guild_aliases.setdefault(alias.server_id, {})[alias.alias] = CachedAlias(alias.alias, alias.true_function, self.command_dict)
+        self.guild_aliases = guild_aliases
+        self.loaded_all = True
+
+    def aliases_for(self, guild_id, session):
+        if guild_id not in self.guild_aliases:
+            if self.loaded_all: # the bulk load saw every alias, so there's nothing to query (and no query on the event loop)
+                return {}
+            # we haven't bulk loaded yet, so lazily load just this guild
+            self.guild_aliases[guild_id] = {alias.alias: CachedAlias(alias.alias, alias.true_function, self.command_dict)
+                                            for alias in session.query(Alias).filter(Alias.server_id == guild_id).order_by(Alias.id).all()}
+        return self.guild_aliases[guild_id]
+
+    def get(self, guild_id, alias, session):
+        return self.aliases_for(guild_id, session).get(alias)
+
+    def add(self, server, alias, true_function, session):
+        session.add(Alias(alias=alias, true_function=true_function, server=server))
+        session.info.setdefault(PENDING_ALIAS_CHANGES_KEY, []).append((server.id, alias, true_function))
+
+    def remove(self, guild_id, alias, session):
+        session.query(Alias).filter(Alias.server_id == guild_id, Alias.alias == alias).delete(synchronize_session=False)
+        session.info.setdefault(PENDING_ALIAS_CHANGES_KEY, []).append((guild_id, alias, None))
+
+    def __apply_pending_changes(self, session):
+        for guild_id, alias, true_function in session.info.pop(PENDING_ALIAS_CHANGES_KEY, []):
+            if guild_id not in self.guild_aliases:
+                if not self.loaded_all: # will be loaded (with this change) the next time it's needed
+                    continue
+                self.guild_aliases[guild_id] = {}
+            if true_function is None:
+                self.guild_aliases[guild_id].pop(alias, None)
+            else:
+                self.guild_aliases[guild_id][alias] = CachedAlias(alias, true_function, self.command_dict)
+
+    @staticmethod
+    def __discard_pending_changes(session, _):
+        session.info.pop(PENDING_ALIAS_CHANGES_KEY, None)
@@ -0,0 +1,128 @@
+import constants as c
+import datetime as dt
+import gzip
+import json
+import os
+
+from asyncio import sleep
+from collections import deque
+from database_utils import AuditLogEntry
+
+
+class AuditLogArchiver:
+    """Moves audit log entries older than their guild's retention horizon out of the database and into gzipped JSONL files
+
+    Archives are split per guild and per month (archive_dir/[guild id]/[YYYY-MM].jsonl.gz). Entries are always written to their
+    archive before they're deleted from the table, so a crash in between can only ever duplicate an entry, never lose one."""
+    def __init__(self, retention_days=c.DEFAULT_AUDIT_LOG_RETENTION_DAYS, guild_retention_days=None, archive_dir=c.AUDIT_LOG_ARCHIVE_DIR):
+        self.retention_days = retention_days # 0 keeps entries forever
+        self.guild_retention_days = guild_retention_days if guild_retention_days is not None else {} # guild id -> days, overriding retention_days
+        self.archive_dir = archive_dir
+
+    @property
+    def enabled(self):
+        return self.retention_days > 0 or any([days > 0 for days in self.guild_retention_days.values()])
+
+    def archive_batch(self, client, now):
+        """Archives up to AUDIT_LOG_ARCHIVE_BATCH_SIZE expired entries in one short transaction; returns how many it archived"""
+        session = client.db_session_builder()
+        try:
+            expired_entries = []
+            for guild_filter, retention_days in self.__retention_filters():
+                batch_room = c.AUDIT_LOG_ARCHIVE_BATCH_SIZE - len(expired_entries)
+                if batch_room <= 0:
+                    break
+                cutoff = now - dt.timedelta(days=retention_days)
+                expired_entries += session.query(AuditLogEntry).filter(guild_filter, AuditLogEntry.timestamp < cutoff).order_by(AuditLogEntry.timestamp).limit(batch_room).all()
+
+            if len(expired_entries) == 0:
+                return 0
+
+            self.__append_to_archives(expired_entries)
+            session.query(AuditLogEntry).filter(AuditLogEntry.message_id.in_([entry.message_id for entry in expired_entries])).delete(synchronize_session=False)
+            session.commit()
+            return len(expired_entries)
+        except Exception as e:
+            client.bot_log.error("Failed to archive audit log entries; error was: {}".format(e))
+            session.rollback()
+            return 0
+        finally:
+            session.close()
+
+    def search(self, guild_id, search_term, n_entries):
+        """Returns the message_content of the n_entries most recent archived entries for a guild that contain search_term, oldest first"""
+        guild_archive_dir = os.path.join(self.archive_dir, str(guild_id))
+        if not os.path.isdir(guild_archive_dir):
+            return []
+
+        search_term = search_term.lower() if search_term is not None else None
+        found_entries = []
+        for archive_name in sorted(os.listdir(guild_archive_dir), reverse=True): # newest month first, so we can stop early
+            month_entries = deque(maxlen=n_entries - len(found_entries)) # only keeps the newest matches in the file
+            with gzip.open(os.path.join(guild_archive_dir, archive_name), "rt", encoding="utf-8") as archive_file:
+                for line in archive_file:
+                    entry = json.loads(line)
+                    if search_term is None or search_term in entry["message_content"].lower():
+                        month_entries.append(entry["message_content"])
+            found_entries = list(month_entries) + found_entries
+            if len(found_entries) >= n_entries:
+                break
+
+        return found_entries
+
+    @staticmethod
+    def vacuum(client):
+        """Gives back some of the pages freed by archiving; only works on databases made with auto_vacuum = INCREMENTAL"""
+        if client.db_engine.dialect.name != "sqlite":
+            return
+        connection = client.db_engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("PRAGMA incremental_vacuum({})".format(c.AUDIT_LOG_VACUUM_PAGES))
+            cursor.fetchall() # each step of the pragma frees one page, so it has to be run to completion
+            connection.commit()
+        finally:
+            connection.close()
+
+    async def retention_loop(self, client):
+        if not self.enabled:
+            return
+
+        while True:
+            n_archived = await client.database_executor.run(self.archive_batch, client, dt.datetime.utcnow()) # message.created_at (and so the timestamps) are in UTC
+            if n_archived > 0:
+                client.bot_log.info("Archived {} audit log entries".format(n_archived))
+                await client.database_executor.run(self.vacuum, client)
+            if n_archived == c.AUDIT_LOG_ARCHIVE_BATCH_SIZE: # there's probably more, but give everything else a turn at the database first
+                await sleep(c.AUDIT_LOG_ARCHIVE_BATCH_DELAY)
+            else:
+                await sleep(c.AUDIT_LOG_ARCHIVE_LOOP_TIME)
+
+    def __retention_filters(self):
+        overridden_guilds = list(self.guild_retention_days.keys())
+        if self.retention_days > 0:
+            yield (~AuditLogEntry.guild_id.in_(overridden_guilds) if len(overridden_guilds) else AuditLogEntry.guild_id.isnot(None)), self.retention_days
+        for guild_id, retention_days in self.guild_retention_days.items():
+            if retention_days > 0:
+                yield AuditLogEntry.guild_id == guild_id, retention_days
+
+    def __append_to_archives(self, entries):
+        archive_lines = {} # archive path -> lines to append
+        for entry in entries:
+            month = entry.timestamp.strftime("%Y-%m") if entry.timestamp is not None else "undated"
+            archive_path = os.path.join(self.archive_dir, str(entry.guild_id), "{}.jsonl.gz".format(month))
+            archive_lines.setdefault(archive_path, []).append(json.dumps({
+                "message_id": entry.message_id,
+                "user_id": entry.user_id,
+                "guild_id": entry.guild_id,
+                "message_content": entry.message_content,
+                "timestamp": entry.timestamp.isoformat() if entry.timestamp is not None else None
+            }))
+
+        for archive_path, lines in archive_lines.items():
+            os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+            with open(archive_path, "ab") as archive_file:
+                with gzip.GzipFile(fileobj=archive_file, mode="ab") as compressed_file: # appending adds another gzip member, which gzip.open reads back transparently
+                    compressed_file.write(("\n".join(lines) + "\n").encode("utf-8"))
+                archive_file.flush()
+                os.fsync(archive_file.fileno()) # the entries get deleted from the database right after this, so they'd better be on disk
@@ -0,0 +1,178 @@
+import constants as c
+import logging
+import os
+
+from asyncio import Lock, get_event_loop, shield
+from collections import OrderedDict
+from PIL import Image
+
+
+class AvatarCache:
+    """Avatars, already cropped into circles, for quotes: decoded in memory, and as PNGs on disk under a size budget
+
+    Both tiers drop their least recently used avatar first; files' modification times are bumped when they're used, so
+    the disk tier's order survives restarts. A miss downloads the avatar with the client's ImageFetcher and crops it in the
+    client's RenderPool (crop is the function that does it: bytes -> Image, or None). Concurrent requests for the same
+    avatar share one download. Avatars that aren't stored (store=False) skip the cache entirely, since only Discord's
+    avatar URLs have unique file names."""
+    def __init__(self, crop, directory=c.PFPS_FOLDER_PATH, max_images=c.AVATAR_MEMORY_CACHE_SIZE, max_disk_bytes=c.AVATAR_DISK_CACHE_BYTES):
+        self.crop = crop
+        self.directory = directory
+        self.max_images = max_images # 0 turns the memory tier off
+        self.max_disk_bytes = max_disk_bytes # 0 turns the disk tier off
+        self.log = logging.getLogger(__name__)
+        self.images = OrderedDict() # avatar id -> cropped Image, least recently used first
+        self.files = None # avatar id -> file size, least recently used first; read from the directory on first use
+        self.disk_bytes = 0
+        self.index_lock = None # made on first use, so it's bound to the loop the bot actually runs on
+        self.pending = {} # avatar id -> future for an avatar that's being loaded right now
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.deduplicated = 0 # requests that waited on another request's download instead of starting their own
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+
+    async def get(self, client, avatar_url, store=True):
+        """Returns the cropped avatar at avatar_url, or None if it couldn't be downloaded or read; store=False leaves it out of the cache"""
+        if not store: # e.g. !testavatar uploads, which are nearly all called image.png, so nothing keyed by avatar_id can be trusted for them
+            return await self.__download(client, avatar_url)
+
+        avatar_id = self.avatar_id(avatar_url)
+        avatar_img = self.images.get(avatar_id)
+        if avatar_img is not None:
+            self.images.move_to_end(avatar_id)
+            self.memory_hits += 1
+            return avatar_img
+
+        pending_load = self.pending.get(avatar_id)
+        if pending_load is not None:
+            self.deduplicated += 1
+            return await shield(pending_load) # so this request being cancelled doesn't cancel the load for everyone else
+
+        pending_load = self.pending[avatar_id] = get_event_loop().create_future()
+        try:
+            avatar_img = await self.__load(client, avatar_url, avatar_id)
+        except Exception as e:
+            pending_load.set_exception(e)
+            pending_load.exception() # retrieved here, so nobody waiting on it is fine too
+            raise
+        else:
+            pending_load.set_result(avatar_img)
+        finally:
+            if not pending_load.done(): # this request was cancelled (CancelledError isn't an Exception); don't leave the others waiting forever
+                pending_load.cancel()
+            del self.pending[avatar_id]
+
+        if avatar_img is not None and self.max_images > 0:
+            self.images[avatar_id] = avatar_img
+            if len(self.images) > self.max_images:
+                self.images.popitem(last=False)
+                self.memory_evictions += 1
+        return avatar_img
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "images": len(self.images),
+            "max_images": self.max_images,
+            "files": len(self.files) if self.files is not None else 0,
+            "disk_bytes": self.disk_bytes,
+            "max_disk_bytes": self.max_disk_bytes,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "deduplicated": self.deduplicated,
+            "memory_evictions": self.memory_evictions,
+            "disk_evictions": self.disk_evictions,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else None
+        }
+
+    @staticmethod
+    def avatar_id(avatar_url):
+        return str(avatar_url).split("/")[-1].split("?")[0] # Discord's avatar URLs end in <hash>.<extension>
+
+    async def __load(self, client, avatar_url, avatar_id):
+        loop = get_event_loop()
+        await self.__ensure_index()
+        if avatar_id in self.files:
+            avatar_img = await loop.run_in_executor(None, self.__read_file, avatar_id)
+            if avatar_img is not None:
+                self.files.move_to_end(avatar_id)
+                self.disk_hits += 1
+                return avatar_img
+            self.disk_bytes -= self.files.pop(avatar_id) # unreadable, so treat it as a miss and replace it
+
+        avatar_img = await self.__download(client, avatar_url)
+        if avatar_img is not None and self.max_disk_bytes > 0:
+            file_size = await loop.run_in_executor(None, self.__write_file, avatar_id, avatar_img)
+            if file_size is not None:
+                self.files[avatar_id] = file_size
+                self.disk_bytes += file_size
+                await self.__evict_files()
+        return avatar_img
+
+    async def __download(self, client, avatar_url):
+        self.misses += 1
+        avatar_bytes = await client.image_fetcher.fetch(avatar_url, c.MAX_AVATAR_FILESIZE)
+        if avatar_bytes is None:
+            return None
+        return await client.render_pool.run(self.crop, avatar_bytes)
+
+    async def __ensure_index(self):
+        if self.files is not None:
+            return
+        if self.index_lock is None:
+            self.index_lock = Lock()
+        async with self.index_lock:
+            if self.files is None: # another request might've read it while this one waited
+                self.files = await get_event_loop().run_in_executor(None, self.__read_index)
+                self.disk_bytes = sum(self.files.values())
+                await self.__evict_files() # in case the budget shrank since the last run
+
+    async def __evict_files(self):
+        evicted_ids = []
+        while self.disk_bytes > self.max_disk_bytes and len(self.files):
+            avatar_id, file_size = self.files.popitem(last=False)
+            self.disk_bytes -= file_size
+            evicted_ids.append(avatar_id)
+        if len(evicted_ids):
+            self.disk_evictions += len(evicted_ids)
+            await get_event_loop().run_in_executor(None, self.__remove_files, evicted_ids)
+
+    def __read_index(self):
+        if not os.path.exists(self.directory):
+            return OrderedDict()
+        files = []
+        for file_name in os.listdir(self.directory):
+            file_stat = os.stat(os.path.join(self.directory, file_name))
+            files.append((file_stat.st_mtime, file_name, file_stat.st_size))
+        return OrderedDict([(file_name, file_size) for _, file_name, file_size in sorted(files)])
+
+    def __read_file(self, avatar_id):
+        avatar_path = os.path.join(self.directory, avatar_id)
+        try:
+            with Image.open(avatar_path) as avatar_file:
+                avatar_img = avatar_file.convert("RGBA") # loads it, so the file can be closed
+            os.utime(avatar_path) # most recently used, as far as the next restart is concerned
+            return avatar_img
+        except OSError as e:
+            self.log.warning("failed to load avatar (id: {}) from file: {}".format(avatar_id, e))
+            return None
+
+    def __write_file(self, avatar_id, avatar_img):
+        avatar_path = os.path.join(self.directory, avatar_id)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            avatar_img.save(avatar_path, format="png")
+            return os.path.getsize(avatar_path)
+        except OSError as e:
+            self.log.warning("failed to save avatar (id: {}) to file: {}".format(avatar_id, e))
+            return None
+
+    def __remove_files(self, avatar_ids):
+        for avatar_id in avatar_ids:
+            try:
+                os.remove(os.path.join(self.directory, avatar_id))
+            except OSError:
+                pass
@@ -0,0 +1,15 @@
+"""Offline benchmarks: nothing here connects to Discord or the internet
+
+Each module can be run on its own (python -m benchmarks.<module>, from the repository root) and prints its results as a
+JSON list, one object per case, each with a unique "name". python -m benchmarks runs all of them, writes the results (plus
+the commit and Python version they came from) to one JSON file, and can compare them with an earlier run's file to catch
+regressions. Shared fakes (messages, guilds, an Akrasia on a temporary database, a local image server) are in fakes.py."""
+
+BENCHMARKS = [ # modules run by python -m benchmarks, in order
+    "dispatch",
+    "hooks",
+    "quotes",
+    "reminders",
+    "message_wrapper",
+    "event_loop_lag"
+]
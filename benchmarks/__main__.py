@@ -0,0 +1,103 @@
+"""Runs every benchmark (or the ones named) and writes their results to one JSON file
+
+A metric counts as a regression when it's worse than the compared run's by more than the threshold: times (*_ms, *_us,
+seconds) and sizes (bytes_*) are better lower, rates (*_per_second) are better higher, and anything else (counts, sizes of
+inputs) isn't compared. Exits with status 1 if there were any regressions.
+
+Usage (from the repository root): python -m benchmarks [benchmark ...] [--output results.json] [--compare old_results.json] [--threshold 0.2]"""
+import constants # before any benchmark: constants imports the default modules, which import message_utils
+import argparse
+import datetime as dt
+import json
+import platform
+import subprocess
+import sys
+
+from benchmarks import BENCHMARKS
+from importlib import import_module
+from io import StringIO
+from contextlib import redirect_stdout
+
+DEFAULT_THRESHOLD = 0.2 # benchmarks on a shared machine are noisy; 20% worse is worth a look
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def lower_is_better(metric):
+    """True/False for metrics that can regress, None for ones that aren't compared"""
+    if metric.endswith("_per_second"):
+        return False
+    if metric.endswith("_ms") or metric.endswith("_us") or metric == "seconds" or metric.startswith("bytes_"):
+        return True
+    return None
+
+
+def compare(results, old_results, threshold):
+    """Returns [(benchmark, case name, metric, old value, new value)] for every metric that got worse by more than threshold"""
+    regressions = []
+    for benchmark, cases in results.items():
+        old_cases = {case["name"]: case for case in old_results.get(benchmark, [])}
+        for case in cases:
+            old_case = old_cases.get(case["name"])
+            if old_case is None:
+                continue
+            for metric, value in case.items():
+                direction = lower_is_better(metric)
+                old_value = old_case.get(metric)
+                if direction is None or not isinstance(value, (int, float)) or not isinstance(old_value, (int, float)) or old_value == 0:
+                    continue
+                change = (value - old_value) / old_value
+                if (change > threshold) if direction else (change < -threshold):
+                    regressions.append((benchmark, case["name"], metric, old_value, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Runs Akrasia's offline benchmarks")
+    parser.add_argument("benchmarks", nargs="*", help="benchmarks to run, out of {} (all of them if none are given)".format(", ".join(BENCHMARKS)))
+    parser.add_argument("--output", help="file to write the results to (stdout if not given)")
+    parser.add_argument("--compare", help="results file from an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="fraction a metric can get worse by before it's a regression")
+    args = parser.parse_args()
+    unknown_benchmarks = [benchmark for benchmark in args.benchmarks if benchmark not in BENCHMARKS]
+    if len(unknown_benchmarks):
+        parser.error("unknown benchmarks: {}".format(", ".join(unknown_benchmarks)))
+
+    run = {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started_at": dt.datetime.now().isoformat(),
+        "results": {}
+    }
+    for benchmark in args.benchmarks or BENCHMARKS:
+        print("Running {}...".format(benchmark), file=sys.stderr)
+        with redirect_stdout(StringIO()): # anything a benchmark prints would end up in the JSON
+            run["results"][benchmark] = import_module("benchmarks.{}".format(benchmark)).run()
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as old_results_file:
+            old_run = json.load(old_results_file)
+        regressions = compare(run["results"], old_run["results"], args.threshold)
+        run["compared_with"] = old_run.get("commit")
+        run["regressions"] = [{"benchmark": benchmark, "name": name, "metric": metric, "old": old_value, "new": value} for benchmark, name, metric, old_value, value in regressions]
+        for benchmark, name, metric, old_value, value in regressions:
+            print("REGRESSION {} / {}: {} went from {} to {}".format(benchmark, name, metric, old_value, value), file=sys.stderr)
+        print("{} regressions compared with {}".format(len(regressions), args.compare), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as results_file:
+            json.dump(run, results_file, indent=4)
+    else:
+        print(json.dumps(run, indent=4))
+    return 1 if len(regressions) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""Measures commands end to end, from Akrasia.on_message to the reply being sent
+
+Each command is sent n times from n_users different users spread over n_guilds guilds, each message to its own channel (so
+replies aren't coalesced), with every message handed to on_message at once like a burst from the gateway. Latency is the
+time from on_message to that message's reply going out; throughput is commands per second over the whole burst. Built-in,
+module (argument schema plus a database write) and aliased commands are all measured, against a temporary SQLite database.
+
+Usage (from the repository root): python -m benchmarks.dispatch [n_messages] [n_users] [n_guilds]"""
+import constants as c
+import asyncio
+import json
+import sys
+
+from benchmarks.fakes import BenchmarkAkrasia, FakeGuild, FakeMember, FakeMessage, latency_stats
+from time import perf_counter
+
+AUTHOR_ID = 1
+COMMANDS = [ # (name, message content)
+    ("builtin echo", "!echo benchmark"),
+    ("builtin aliases", "!aliases"),
+    ("module remindme", "!remindme in 5 minutes stretch your legs"),
+    ("module join (bad argument)", "!join"),
+    ("alias say", "!say benchmark")
+]
+
+
+async def run_burst(bot, guilds, users, name, content, first_id, n_messages):
+    messages = [FakeMessage(first_id + i, content, users[i % len(users)], guilds[i % len(guilds)]) for i in range(n_messages)]
+    n_dropped = bot.command_scheduler.n_dropped
+    sent_at = {}
+    start = perf_counter()
+    for message in messages:
+        sent_at[message.id] = perf_counter()
+        await bot.on_message(message)
+    while bot.command_scheduler.n_running or bot.command_scheduler.n_queued or len(bot.outbound_queue.senders):
+        await asyncio.sleep(0.001)
+    elapsed = perf_counter() - start
+
+    latencies = [message.channel.sent[0][0] - sent_at[message.id] for message in messages if len(message.channel.sent)]
+    return dict({
+        "name": name,
+        "messages": n_messages,
+        "replied": len(latencies),
+        "dropped": bot.command_scheduler.n_dropped - n_dropped,
+        "seconds": round(elapsed, 4),
+        "commands_per_second": round(n_messages / elapsed, 1)
+    }, **latency_stats(latencies))
+
+
+async def run_all(bot, guilds, users, n_messages):
+    bot.start()
+    await run_burst(bot, guilds, users, "warmup", "!echo warmup", 10**9, len(users) * len(guilds)) # creates every user's and server's row, so the first benchmark isn't the only one paying for it
+    for i, guild in enumerate(guilds):
+        await run_burst(bot, [guild], users[:1], "setup", "!addalias echo say", 2 * 10**9 + i, 1)
+
+    results = []
+    for i, (name, content) in enumerate(COMMANDS):
+        results.append(await run_burst(bot, guilds, users, name, content, (i + 1) * 10**6, n_messages))
+    await bot.close_benchmark()
+    return results
+
+
+def run(n_messages=500, n_users=50, n_guilds=25):
+    users = [FakeMember(AUTHOR_ID + i, "user {}".format(i)) for i in range(n_users)]
+    guilds = [FakeGuild(guild_id=100 + i, name="guild {}".format(i), members=users) for i in range(n_guilds)]
+    bot = BenchmarkAkrasia(users)
+    c.AUTHOR_ID = AUTHOR_ID # echo only answers the bot's owner; the other users get a permissions error, which is still a reply
+    bot.bot_log.disabled = True # logging every command would be most of what's measured
+    return bot.loop.run_until_complete(run_all(bot, guilds, users, n_messages))
+
+
+def main(n_messages=500, n_users=50, n_guilds=25):
+    results = run(n_messages, n_users, n_guilds)
+    print(json.dumps(results, indent=4))
+    return results
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:4]])
@@ -0,0 +1,107 @@
+"""Measures how long the event loop stalls while many commands write to SQLite at once
+
+Runs the same burst of (get user, add audit log row, commit) "commands" twice: once with the database calls made directly on the
+event loop (how every command used to work), and once through DatabaseExecutor. Meanwhile, a probe coroutine wakes up every
+PROBE_INTERVAL seconds and records how late it was; that lateness is how long a gateway heartbeat would have been delayed.
+
+Usage (from the repository root): python -m benchmarks.event_loop_lag [n_commands] [concurrency]"""
+import asyncio
+import datetime as dt
+import json
+import os
+import sqlalchemy as db
+import sys
+import tempfile
+import time
+
+from database_executor import DatabaseExecutor, ExecutorSession
+from database_utils import AuditLogEntry, User, init_databases
+from sqlalchemy.orm import sessionmaker
+
+PROBE_INTERVAL = 0.005
+
+
+def write_command(session, command_id):
+    user = session.query(User).filter(User.id == command_id % 50).first()
+    if user is None:
+        user = User(id=command_id % 50, name="user {}".format(command_id % 50))
+        session.add(user)
+    session.add(AuditLogEntry(message_id=command_id, user=user, guild_id=1, message_content="[benchmark] command {}".format(command_id), timestamp=dt.datetime.now()))
+    session.commit()
+
+
+async def run_command(session_builder, command_id, use_executor):
+    session = session_builder()
+    try:
+        if use_executor:
+            await session.run(write_command, session, command_id)
+        else:
+            write_command(session, command_id)
+    finally:
+        session.close()
+    await asyncio.sleep(0) # hand control back like a real command would while it sends its reply
+
+
+async def probe_lag(lags, stop):
+    while not stop.is_set():
+        expected_wake = time.perf_counter() + PROBE_INTERVAL
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(max(0.0, time.perf_counter() - expected_wake))
+
+
+async def run_burst(session_builder, n_commands, concurrency, use_executor, first_id):
+    lags = []
+    stop = asyncio.Event()
+    probe = asyncio.ensure_future(probe_lag(lags, stop))
+    slots = asyncio.Semaphore(concurrency)
+
+    async def limited(command_id):
+        async with slots:
+            await run_command(session_builder, command_id, use_executor)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[limited(first_id + i) for i in range(n_commands)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe
+
+    lags.sort()
+    return {
+        "name": "executor" if use_executor else "inline",
+        "mode": "executor" if use_executor else "inline",
+        "commands": n_commands,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 4),
+        "commands_per_second": round(n_commands / elapsed, 1),
+        "probe_samples": len(lags),
+        "lag_p50_ms": round(1000 * lags[len(lags) // 2], 3) if lags else None,
+        "lag_p99_ms": round(1000 * lags[min(len(lags) - 1, int(len(lags) * 0.99))], 3) if lags else None,
+        "lag_max_ms": round(1000 * lags[-1], 3) if lags else None
+    }
+
+
+def run(n_commands=500, concurrency=50):
+    with tempfile.TemporaryDirectory() as database_dir:
+        engine = db.create_engine("sqlite:///{}".format(os.path.join(database_dir, "benchmark.db")), connect_args={"check_same_thread": False})
+        init_databases(engine)
+        database_executor = DatabaseExecutor()
+        session_builder = sessionmaker(bind=engine, class_=ExecutorSession, database_executor=database_executor)
+
+        loop = asyncio.get_event_loop()
+        results = [
+            loop.run_until_complete(run_burst(session_builder, n_commands, concurrency, False, 0)),
+            loop.run_until_complete(run_burst(session_builder, n_commands, concurrency, True, n_commands))
+        ]
+        database_executor.shutdown()
+        engine.dispose()
+    return results
+
+
+def main(n_commands=500, concurrency=50):
+    results = run(n_commands, concurrency)
+    print(json.dumps(results, indent=4))
+    return results
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
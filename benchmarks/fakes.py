@@ -0,0 +1,223 @@
+"""Stand-ins for the parts of Discord the benchmarks touch, and an Akrasia that runs against a temporary database
+
+Nothing here talks to Discord: messages, guilds, members and channels are plain objects with just the attributes Akrasia reads,
+sends are recorded instead of made, and images are served from a local HTTP server."""
+import constants as c # before anything that imports message_utils: constants imports the default modules, which import message_utils
+import asyncio
+import datetime as dt
+import discord
+import logging
+import os
+import sqlalchemy as db
+import tempfile
+import threading
+
+from akrasia import Akrasia
+from cooldowns import CooldownLimiter
+from database_executor import ExecutorSession
+from database_utils import init_audit_log_search, init_databases
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from PIL import Image
+from sqlalchemy.orm import sessionmaker
+from time import perf_counter
+
+
+class FakeState: # just enough of discord.py's ConnectionState to build a Message or Attachment offline
+    http = None
+
+    def store_user(self, data):
+        return discord.User(state=self, data=data)
+
+
+class FakePermissions:
+    def __init__(self, administrator):
+        self.administrator = administrator
+
+
+class FakeMember:
+    def __init__(self, user_id, name, nick=None, administrator=True, avatar_url=None):
+        self.id = user_id
+        self.name = name
+        self.nick = nick
+        self.display_name = nick if nick is not None else name
+        self.bot = False
+        self.guild_permissions = FakePermissions(administrator)
+        self.avatar_url = avatar_url
+        self.sent = [] # (time sent, content) for every DM
+
+    async def send(self, content=None, **_):
+        self.sent.append((perf_counter(), content))
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.sent = [] # (time sent, content) for every message sent here
+
+    async def send(self, content=None, **_):
+        self.sent.append((perf_counter(), content))
+
+
+class FakeGuild:
+    def __init__(self, guild_id=4, name="benchmark guild", members=()):
+        self.id = guild_id
+        self.name = name
+        self.members = list(members)
+        self.member_ids = {member.id: member for member in self.members}
+
+    def get_channel(self, _):
+        return None
+
+    def get_member(self, member_id):
+        return self.member_ids.get(member_id)
+
+    def get_role(self, _):
+        return None
+
+
+class FakeMessage:
+    """A guild message, as far as on_message/handle_command and the hooks need one"""
+    def __init__(self, message_id, content, author, guild, channel=None):
+        self.id = message_id
+        self.content = content
+        self.clean_content = content
+        self.author = author
+        self.guild = guild
+        self.channel = channel if channel is not None else FakeChannel(message_id)
+        self.created_at = dt.datetime.utcnow()
+        self.attachments = []
+        self.embeds = []
+
+
+class FakeQuoteMessage:
+    """A message as make_quote sees it (the same attributes as quotes.QuoteMessage, with attachments)"""
+    def __init__(self, message_id, author, created_at, clean_content, attachments=()):
+        self.id = message_id
+        self.author = author
+        self.created_at = created_at
+        self.clean_content = clean_content
+        self.attachments = list(attachments)
+        self.embeds = []
+
+
+class BenchmarkAkrasia(Akrasia):
+    """Akrasia on a temporary SQLite database, with no cooldowns, that never connects to Discord
+
+    Call start() from inside the event loop before sending it messages, and close_benchmark() when done."""
+    def __init__(self, users=(), **kwargs):
+        self.database_dir = tempfile.TemporaryDirectory()
+        logging.getLogger("discord").setLevel(logging.ERROR) # e.g. the warning about voice support, which would end up in the JSON on stdout
+        super().__init__(modules=c.DEFAULT_MODULES, **kwargs)
+        self.cooldown_limiter = CooldownLimiter({"command": 0, "hook": 0}) # every fake user would otherwise be stopped after one command
+        self.fake_users = {user.id: user for user in users}
+        c.DEFAULT_RETURN_MESSAGE = "Something went wrong"
+
+    def init_db_connection(self):
+        engine = db.create_engine("sqlite:///{}".format(os.path.join(self.database_dir.name, c.MAIN_DATABASE_NAME)), connect_args={"check_same_thread": False})
+        init_databases(engine)
+        self.audit_log_search_enabled = init_audit_log_search(engine)
+        session_builder = sessionmaker(bind=engine, class_=ExecutorSession, database_executor=self.database_executor)
+        return engine, session_builder
+
+    def get_user(self, user_id):
+        return self.fake_users.get(user_id)
+
+    def start(self):
+        self.audit_logger.start(self) # batched, like in production
+
+    async def close_benchmark(self):
+        await self.command_scheduler.close()
+        await self.audit_logger.close()
+        self.database_executor.shutdown()
+        self.db_engine.dispose()
+        self.database_dir.cleanup()
+
+
+class ImageServer:
+    """Serves generated PNGs on localhost, so code that downloads images can be timed without the internet
+
+    GET /<width>x<height>/<anything>.png returns a PNG of that size."""
+    def __init__(self):
+        self.images = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.__handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def url(self, width, height, name="image"):
+        return "{}/{}x{}/{}.png".format(self.base_url, width, height, name)
+
+    def png(self, width, height):
+        with self.lock:
+            image_bytes = self.images.get((width, height))
+            if image_bytes is None:
+                with BytesIO() as image_buffer:
+                    Image.new("RGBA", (width, height), (width % 256, height % 256, 128, 255)).save(image_buffer, format="png")
+                    image_bytes = self.images[(width, height)] = image_buffer.getvalue()
+        return image_bytes
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __handler(self):
+        image_server = self
+
+        class ImageRequestHandler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self.__respond(False)
+
+            def do_GET(self):
+                self.__respond(True)
+
+            def log_message(self, *_): # don't print every request
+                pass
+
+            def __respond(self, with_body):
+                try:
+                    width, height = [int(n) for n in self.path.split("/")[1].split("x")]
+                except ValueError:
+                    self.send_error(404)
+                    return
+                image_bytes = image_server.png(width, height)
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(image_bytes)))
+                self.end_headers()
+                if with_body:
+                    self.wfile.write(image_bytes)
+
+        return ImageRequestHandler
+
+
+def make_attachment(attachment_id, url, width, height):
+    return discord.Attachment(state=FakeState(), data={"id": attachment_id, "size": width * height, "height": height, "width": width,
+                                                       "filename": url.split("/")[-1], "url": url, "proxy_url": url})
+
+
+async def probe_lag(lags, stop, interval=0.005):
+    """Records how late the event loop wakes this up, every interval seconds, until stop is set"""
+    while not stop.is_set():
+        expected_wake = perf_counter() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, perf_counter() - expected_wake))
+
+
+def latency_stats(seconds):
+    """Summarizes a list of latencies (in seconds) as milliseconds"""
+    if len(seconds) == 0:
+        return {}
+    seconds = sorted(seconds)
+    return {
+        "latency_p50_ms": round(1000 * seconds[len(seconds) // 2], 3),
+        "latency_p99_ms": round(1000 * seconds[min(len(seconds) - 1, int(len(seconds) * 0.99))], 3),
+        "latency_max_ms": round(1000 * seconds[-1], 3)
+    }
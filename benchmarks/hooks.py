@@ -0,0 +1,117 @@
+"""Measures hook matching with different numbers of hooks
+
+For each number of hooks, builds a HookMatcher over that many hooks (the default ones plus generated trigger phrases, a few of
+them regexes with alternations, which defeat the prefix filter) and runs a mix of chat messages through it the way on_message
+does: could_match on the raw content, then match on the lowered content if that passed. Most messages match nothing, as in
+real chat; a few match the first or the last hook. The per-message time of the old approach (re.match against every hook in
+turn) is reported next to it for comparison, timed over at most ONE_BY_ONE_MAX_MESSAGES messages.
+
+Usage (from the repository root): python -m benchmarks.hooks [n_messages]"""
+import constants # before hooks: constants imports the default modules, which import message_utils
+import json
+import re
+import sys
+
+from hook_matcher import HookMatcher
+from hooks import default_hooks
+from time import perf_counter
+
+HOOK_COUNTS = [1, 10, 100, 1000]
+ONE_BY_ONE_MAX_MESSAGES = 500 # past a few hundred hooks, re's pattern cache thrashes and the old approach takes milliseconds a message
+CHAT_MESSAGES = [
+    "lol did anyone see the game last night",
+    "<@1234> can you check this out when you get a chance?",
+    "brb getting food",
+    "akrasia, will it rain tomorrow?",
+    "I have come here to chew bubblegum and kick ass",
+    "https://example.com/some/very/long/link?with=parameters&and=more",
+    "ok",
+    "that's what she said"
+]
+
+
+def make_hooks(n_hooks):
+    hooks = dict(default_hooks)
+    for i in range(n_hooks - len(hooks)):
+        if i % 25 == 24:
+            hooks["(hey|hi|yo) bot{}".format(i)] = None # an alternation at the start means there's no literal prefix to filter on
+        else:
+            hooks["trigger phrase {}\\b".format(i)] = None
+    return hooks
+
+
+def make_messages(hooks, n_messages):
+    hook_triggers = [hook_regex.replace("\\b", "") for hook_regex in hooks if "|" not in hook_regex]
+    messages = []
+    for i in range(n_messages):
+        if i % 20 == 0:
+            messages.append(hook_triggers[-1] + " and then some") # worst case: only the last hook matches
+        elif i % 20 == 1:
+            messages.append(hook_triggers[0] + " what's up")
+        else:
+            messages.append(CHAT_MESSAGES[i % len(CHAT_MESSAGES)])
+    return messages
+
+
+def match_like_on_message(hook_matcher, messages):
+    n_matched = 0
+    for content in messages:
+        if hook_matcher.could_match(content) and hook_matcher.match(content.lower()) is not None:
+            n_matched += 1
+    return n_matched
+
+
+def match_one_by_one(hooks, messages):
+    n_matched = 0
+    for content in messages:
+        lowered_content = content.lower()
+        for hook_regex in hooks:
+            if re.match(hook_regex, lowered_content):
+                n_matched += 1
+                break
+    return n_matched
+
+
+def measure(n_hooks, n_messages):
+    hooks = make_hooks(n_hooks)
+    messages = make_messages(hooks, n_messages)
+
+    start = perf_counter()
+    hook_matcher = HookMatcher(hooks)
+    build_seconds = perf_counter() - start
+
+    start = perf_counter()
+    n_matched = match_like_on_message(hook_matcher, messages)
+    match_seconds = perf_counter() - start
+
+    one_by_one_messages = messages[:ONE_BY_ONE_MAX_MESSAGES]
+    start = perf_counter()
+    n_matched_one_by_one = match_one_by_one(hooks, one_by_one_messages)
+    one_by_one_seconds = perf_counter() - start
+
+    return {
+        "name": "{} hooks".format(len(hooks)),
+        "hooks": len(hooks),
+        "messages": n_messages,
+        "matched": n_matched,
+        "one_by_one_messages": len(one_by_one_messages),
+        "one_by_one_matched": n_matched_one_by_one,
+        "build_ms": round(1000 * build_seconds, 3),
+        "match_us": round(10**6 * match_seconds / n_messages, 3),
+        "one_by_one_match_us": round(10**6 * one_by_one_seconds / len(one_by_one_messages), 3),
+        "prefilter_hit_rate": round(hook_matcher.prefilter_hit_rate, 3)
+    }
+
+
+def run(n_messages=20000):
+    return [measure(n_hooks, n_messages) for n_hooks in HOOK_COUNTS]
+
+
+def main(n_messages=20000):
+    results = run(n_messages)
+    print(json.dumps(results, indent=4))
+    return results
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
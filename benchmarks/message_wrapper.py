@@ -0,0 +1,99 @@
+"""Compares the old copying MessageWrapper with the current proxy one
+
+For each, builds n wrappers around the same DM message (like handle_command does for every DM command from a user with a home
+server) and reports the time per construction, the time to then read the attributes a typical command reads, and the memory each
+wrapper holds on to (measured with tracemalloc while all n are alive).
+
+Usage (from the repository root): python -m benchmarks.message_wrapper [n_wrappers]"""
+import constants # before message_utils: constants imports the default modules, which import message_utils
+import discord
+import json
+import sys
+import time
+import tracemalloc
+
+from benchmarks.fakes import FakeGuild, FakeState
+from discord import Message
+from message_utils import MessageWrapper
+
+
+class CopyingMessageWrapper(Message): # the wrapper as it was, kept here for comparison
+    def __init__(self, message, guild, author):
+        for property_name in [prop for prop in message.__slots__ if "cs" not in prop]:
+            try:
+                property_value = getattr(message, property_name)
+                if not callable(property_value):
+                    self.__setattr__(property_name, property_value)
+            except AttributeError:
+                self.__setattr__(property_name, None)
+        self.guild = guild
+        self.author = author
+
+
+def make_dm_message():
+    author_data = {"id": 2, "username": "benchmark user", "discriminator": "0001", "avatar": None}
+    return Message(state=FakeState(), channel=discord.Object(id=3), data={
+        "id": 1,
+        "channel_id": 3,
+        "content": "!remindme 5 minutes stretch <@2>",
+        "attachments": [],
+        "embeds": [],
+        "type": 0,
+        "pinned": False,
+        "mention_everyone": False,
+        "tts": False,
+        "author": author_data,
+        "mentions": [author_data],
+        "mention_roles": [],
+        "timestamp": "2020-01-01T00:00:00+00:00",
+        "edited_timestamp": None
+    })
+
+
+def read_like_a_command(message):
+    return message.id, message.content, message.created_at, message.author.id, message.guild.id, message.clean_content, message.attachments
+
+
+def measure(wrapper_class, message, guild, author, n_wrappers):
+    start = time.perf_counter()
+    for _ in range(n_wrappers):
+        wrapper_class(message, guild, author)
+    construct_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(n_wrappers):
+        read_like_a_command(wrapper_class(message, guild, author))
+    construct_and_read_seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    wrappers = [wrapper_class(message, guild, author) for _ in range(n_wrappers)]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del wrappers
+
+    return {
+        "name": wrapper_class.__name__,
+        "wrapper": wrapper_class.__name__,
+        "wrappers": n_wrappers,
+        "construct_us": round(10**6 * construct_seconds / n_wrappers, 3),
+        "construct_and_read_us": round(10**6 * construct_and_read_seconds / n_wrappers, 3),
+        "bytes_per_wrapper": round((after - before) / n_wrappers, 1)
+    }
+
+
+def run(n_wrappers=20000):
+    message = make_dm_message()
+    guild = FakeGuild() # the home guild
+    author = discord.Object(id=2)
+    return [measure(wrapper_class, message, guild, author, n_wrappers) for wrapper_class in [CopyingMessageWrapper, MessageWrapper]]
+
+
+def main(n_wrappers=20000):
+    results = run(n_wrappers)
+    print(json.dumps(results, indent=4))
+    return results
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,178 @@
+"""Measures quote rendering, text wrapping and quote search
+
+make_quote is run on 1 to 10 messages from alternating authors, some of them with image attachments; avatars and attachments
+are downloaded from a local image server, so the time includes fetching them (but not the internet). It's run once with the
+render pool's default workers and once rendering on the event loop, with how long the loop was blocked each time, then
+once more with the avatars cached, and once with the whole quote cached. wrap_text
+is run on a few typical message shapes. __search_quotes is run over n_quotes quotes with each kind of search it falls back through.
+
+Usage (from the repository root): python -m benchmarks.quotes [n_repeats] [n_quotes]"""
+import constants as c
+import asyncio
+import datetime as dt
+import json
+import logging
+import sqlalchemy as db
+import sys
+import tempfile
+import warnings
+
+from avatar_cache import AvatarCache
+from benchmarks.fakes import FakeGuild, FakeMember, FakeQuoteMessage, ImageServer, make_attachment, probe_lag
+from database_utils import Quote, init_databases
+from default_modules import quotes
+from image_fetcher import ImageFetcher
+from io import BytesIO
+from PIL import Image
+from quote_cache import QuoteCache
+from render_pool import RenderPool
+from time import perf_counter
+
+QUOTE_MESSAGE_COUNTS = [1, 3, 10]
+WRAP_TEXTS = { # name -> text
+    "short": "brb getting food",
+    "paragraph": c.AVATAR_TEST_MESSAGES[2],
+    "long word": "https://example.com/" + "a" * 300,
+    "many lines": "\n".join(["line {}".format(i) for i in range(20)])
+}
+QUOTE_SEARCHES = { # name -> command_args, for a guild whose members are named "member i" with nicknames "nick i"
+    "all": [],
+    "user id": ["1003"],
+    "user id and text": ["1003", "quote"],
+    "username": ["member 7"],
+    "nickname": ["nick 7"],
+    "text fallback": ["quote", "number", "42"],
+    "no match": ["nobody", "said", "this"]
+}
+
+
+class FakeClient:
+    def __init__(self):
+        self.bot_log = logging.getLogger("benchmark")
+        self.bot_log.disabled = True
+        self.image_fetcher = ImageFetcher()
+        self.render_pool = None
+        self.avatar_directory = tempfile.TemporaryDirectory()
+        self.avatar_cache = AvatarCache(quotes.crop_avatar, directory=self.avatar_directory.name)
+        self.quote_cache = QuoteCache(max_bytes=0) # off, except where a benchmark turns it on
+
+
+class FakeServer:
+    def __init__(self):
+        self.id = 4
+        self.name = "benchmark guild"
+
+
+def make_messages(image_server, n_messages):
+    now = dt.datetime.now()
+    authors = [FakeMember(1000 + i, "member {}".format(i), avatar_url=image_server.url(128, 128, "avatar{}".format(i))) for i in range(2)]
+    messages = []
+    for i in range(n_messages):
+        attachments = [make_attachment(i, image_server.url(800, 600, "attachment{}".format(i)), 800, 600)] if i % 3 == 2 else []
+        messages.append(FakeQuoteMessage(i, authors[i // 2 % 2], now - dt.timedelta(minutes=n_messages - i), c.AVATAR_TEST_MESSAGES[i % len(c.AVATAR_TEST_MESSAGES)], attachments))
+    return messages
+
+
+def measure_make_quote(client, image_server, n_messages, n_repeats, store_avatar=False, quote_cache_bytes=0):
+    messages = make_messages(image_server, n_messages)
+    client.quote_cache = QuoteCache(quote_cache_bytes)
+
+    async def make_quotes():
+        for _ in range(2): # warm up (every worker, the image server's PNGs, the fetcher's connections)
+            await asyncio.gather(*[quotes.make_quote(client, messages, store_avatar) for _ in range(max(1, client.render_pool.n_workers))])
+        lags = []
+        stop = asyncio.Event()
+        probe = asyncio.ensure_future(probe_lag(lags, stop))
+        start = perf_counter()
+        for _ in range(n_repeats):
+            quote_png = await quotes.make_quote(client, messages, store_avatar)
+        elapsed = perf_counter() - start
+        stop.set()
+        await probe
+        return elapsed, quote_png, lags
+
+    elapsed, quote_png, lags = asyncio.get_event_loop().run_until_complete(make_quotes())
+    return {
+        "name": "make_quote {} messages{}{}{}".format(n_messages, "" if client.render_pool.n_workers else " (on the event loop)", " (avatars cached)" if store_avatar else "",
+                                                     " (quote cached)" if quote_cache_bytes else ""),
+        "messages": n_messages,
+        "images": len([message for message in messages if len(message.attachments)]),
+        "image_size": list(Image.open(BytesIO(quote_png)).size),
+        "render_workers": client.render_pool.n_workers,
+        "repeats": n_repeats,
+        "ms": round(1000 * elapsed / n_repeats, 3),
+        "lag_max_ms": round(1000 * max(lags, default=0), 3)
+    }
+
+
+def measure_wrap_text(name, text, n_repeats):
+    _, _, content_font = quotes.load_fonts()
+    start = perf_counter()
+    for _ in range(n_repeats):
+        lines = quotes.wrap_text(text, content_font, c.MAX_CONTENT_WIDTH)
+    elapsed = perf_counter() - start
+    return {
+        "name": "wrap_text {}".format(name),
+        "characters": len(text),
+        "lines": len(lines),
+        "repeats": n_repeats,
+        "us": round(10**6 * elapsed / n_repeats, 3)
+    }
+
+
+def measure_search_quotes(name, command_args, n_quotes, n_repeats):
+    members = [FakeMember(1000 + i, "member {}".format(i), nick="nick {}".format(i)) for i in range(50)]
+    guild = FakeGuild(members=members)
+    quote_list = [Quote(image_url="https://example.com/quotes/{}.png".format(i), server_id=4,
+                        user_ids=" ".join([str(members[(i + j) % len(members)].id) for j in range(1 + i % 3)]), text="quote number {} {}".format(i, c.AVATAR_TEST_MESSAGES[i % len(c.AVATAR_TEST_MESSAGES)]))
+                  for i in range(n_quotes)]
+    server = FakeServer()
+    client = FakeClient()
+    search_quotes = getattr(quotes, "__search_quotes") # module-level, so it's only private by convention
+
+    async def search():
+        start = perf_counter()
+        for _ in range(n_repeats):
+            found = await search_quotes(client, guild, server, quote_list, command_args)
+        return perf_counter() - start, found
+
+    elapsed, found = asyncio.get_event_loop().run_until_complete(search())
+    found_quotes = found[0] if isinstance(found, tuple) else None
+    return {
+        "name": "search_quotes {}".format(name),
+        "quotes": n_quotes,
+        "found": len(found_quotes) if found_quotes is not None else 0,
+        "repeats": n_repeats,
+        "us": round(10**6 * elapsed / n_repeats, 3)
+    }
+
+
+def run(n_repeats=5, n_quotes=600):
+    client = FakeClient()
+    results = []
+    with ImageServer() as image_server:
+        for n_workers in [c.RENDER_WORKERS, 0]:
+            client.render_pool = RenderPool(n_workers, initializer=quotes.load_render_resources)
+            results += [measure_make_quote(client, image_server, n_messages, n_repeats) for n_messages in QUOTE_MESSAGE_COUNTS]
+            if n_workers:
+                results.append(measure_make_quote(client, image_server, QUOTE_MESSAGE_COUNTS[-1], n_repeats, store_avatar=True))
+                results.append(measure_make_quote(client, image_server, QUOTE_MESSAGE_COUNTS[-1], n_repeats, quote_cache_bytes=c.QUOTE_CACHE_BYTES))
+            client.render_pool.shutdown()
+    asyncio.get_event_loop().run_until_complete(client.image_fetcher.close())
+    client.avatar_directory.cleanup()
+    results += [measure_wrap_text(name, text, n_repeats * 10) for name, text in WRAP_TEXTS.items()]
+    with warnings.catch_warnings(): # re-setting up the relationships (after benchmarks.dispatch, say) warns about replacing them
+        warnings.simplefilter("ignore", db.exc.SAWarning)
+        init_databases(db.create_engine("sqlite://")) # sets up the models' relationships, which Quote needs before it can be made
+    results += [measure_search_quotes(name, command_args, n_quotes, n_repeats * 20) for name, command_args in QUOTE_SEARCHES.items()]
+    return results
+
+
+def main(n_repeats=5, n_quotes=600):
+    results = run(n_repeats, n_quotes)
+    print(json.dumps(results, indent=4))
+    return results
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
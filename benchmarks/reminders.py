@@ -0,0 +1,83 @@
+"""Measures how long the reminder loop takes to work through a backlog of due reminders
+
+Fills a temporary database with n_reminders reminders that are all due (spread over n_users users), then runs
+start_remind_loop until every one of them has been sent and deleted. Meanwhile, a probe coroutine records how late it wakes
+up, like benchmarks.event_loop_lag does, since a backlog like this is when the loop is most likely to stall everything else.
+
+Usage (from the repository root): python -m benchmarks.reminders [n_reminders] [n_users]"""
+import constants as c
+import asyncio
+import datetime as dt
+import json
+import sys
+
+from benchmarks.fakes import BenchmarkAkrasia, FakeMember, latency_stats, probe_lag
+from database_utils import Reminder
+from default_modules.reminders import start_remind_loop
+from time import perf_counter
+
+def add_reminders(session, users, n_reminders):
+    now = dt.datetime.now()
+    session.bulk_insert_mappings(Reminder, [{"message": "reminder {}".format(i), "send_at": now - dt.timedelta(seconds=1), "sent_at": now - dt.timedelta(days=1),
+                                             "user_id": users[i % len(users)].id, "failures": 0} for i in range(n_reminders)])
+    session.commit()
+
+
+def count_reminders(session):
+    return session.query(Reminder).count()
+
+
+async def run_backlog(bot, users, n_reminders):
+    session = bot.db_session_builder()
+    await session.run(add_reminders, session, users, n_reminders)
+
+    lags = []
+    stop = asyncio.Event()
+    probe = asyncio.ensure_future(probe_lag(lags, stop))
+    start = perf_counter()
+    remind_loop = asyncio.ensure_future(start_remind_loop(bot))
+    while await session.run(count_reminders, session) > 0:
+        await asyncio.sleep(0.01)
+    while len(bot.outbound_queue.senders):
+        await asyncio.sleep(0.001)
+    elapsed = perf_counter() - start
+    remind_loop.cancel()
+    stop.set()
+    await probe
+    session.close()
+
+    lag_stats = latency_stats(lags)
+    return {
+        "name": "{} due reminders".format(n_reminders),
+        "reminders": n_reminders,
+        "users": len(users),
+        "messages_sent": sum([len(user.sent) for user in users]), # reminders to the same user are coalesced into fewer messages
+        "seconds": round(elapsed, 4),
+        "reminders_per_second": round(n_reminders / elapsed, 1),
+        "lag_p50_ms": lag_stats.get("latency_p50_ms"),
+        "lag_p99_ms": lag_stats.get("latency_p99_ms"),
+        "lag_max_ms": lag_stats.get("latency_max_ms")
+    }
+
+
+async def run_all(bot, users, n_reminders):
+    results = [await run_backlog(bot, users, n_reminders)]
+    await bot.close_benchmark()
+    return results
+
+
+def run(n_reminders=10000, n_users=1000):
+    users = [FakeMember(1 + i, "user {}".format(i)) for i in range(n_users)]
+    bot = BenchmarkAkrasia(users)
+    bot.bot_log.disabled = True # the loop logs every reminder it sends
+    return bot.loop.run_until_complete(run_all(bot, users, n_reminders))
+
+
+def main(n_reminders=10000, n_users=1000):
+    results = run(n_reminders, n_users)
+    print(json.dumps(results, indent=4))
+    return results
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,137 @@
+import re
+
+SNOWFLAKE_PATTERN = re.compile(r"^(?:<(?:@[!&]?|#))?(\d+)>?$") # 1234, <@1234>, <@!1234>, <@&1234> or <#1234>
+CHANNEL_PATTERN = re.compile(r"^(?:<#)?(\d+)>?$") # 1234 or <#1234>
+
+
+def split_command_args(words):
+    """Joins the space-split words of a command back into arguments, keeping "quoted phrases" together as one argument"""
+    command_args = []
+    current_arg = []
+    in_quotes = False
+    for word in words:
+        if len(word) == 0:
+            continue
+        if word[0] == '"' and len(word) > 2:
+            word = word[1:]
+            in_quotes = True
+        if word[-1] == '"':
+            word = word[:-1]
+            in_quotes = False
+        current_arg.append(word)
+        if not in_quotes:
+            command_args.append(" ".join(current_arg))
+            current_arg = []
+    if len(current_arg) > 0: # clean up any unclosed quotes
+        command_args.append(" ".join(current_arg))
+
+    return command_args
+
+
+class ArgumentError(Exception): # the message is sent straight back to the user, so keep it friendly
+    pass
+
+
+class Argument:
+    """One typed argument of a command; subclasses turn tokens (from message splitting) into a value"""
+    def __init__(self, name, required=True, default=None, error=None):
+        self.name = name
+        self.required = required
+        self.default = default # used when an optional argument is missing or doesn't convert (in which case its token is left for the next argument)
+        self.error = error if error is not None else "Missing or invalid {}!".format(name)
+
+    def consume(self, tokens, index): # returns (value, index of the next unused token)
+        return self.convert(tokens[index]), index + 1
+
+    def convert(self, token):
+        return token
+
+
+class Word(Argument):
+    pass
+
+
+class Integer(Argument):
+    def convert(self, token):
+        try:
+            return int(token)
+        except ValueError:
+            raise ArgumentError(self.error)
+
+
+class Snowflake(Argument): # a Discord ID, either bare or as a user/role/channel mention
+    def convert(self, token):
+        snowflake_match = SNOWFLAKE_PATTERN.match(token)
+        if snowflake_match is None:
+            raise ArgumentError(self.error)
+        return int(snowflake_match.group(1))
+
+
+class ChannelMention(Argument):
+    def convert(self, token):
+        channel_match = CHANNEL_PATTERN.match(token)
+        if channel_match is None:
+            raise ArgumentError(self.error)
+        return int(channel_match.group(1))
+
+
+class Duration(Argument):
+    """Any number of tokens understood by parse_function, which takes the remaining tokens and returns (value, n_tokens_used)
+
+    The value handed to the command is (parsed value, [tokens that made it up])."""
+    def __init__(self, name, parse_function, prefix=None, **kwargs):
+        super().__init__(name, **kwargs)
+        self.parse_function = parse_function
+        self.prefix = prefix # an optional word to skip before the duration (like "in" for "in 5 minutes")
+
+    def consume(self, tokens, index):
+        if self.prefix is not None and tokens[index].lower() == self.prefix:
+            index += 1
+        if index >= len(tokens):
+            raise ArgumentError(self.error)
+
+        try:
+            value, n_tokens_used = self.parse_function(tokens[index:])
+        except ArgumentError:
+            raise
+        except Exception as e: # parse functions raise with messages meant for the user
+            raise ArgumentError("{}".format(e))
+        return (value, tokens[index:index + n_tokens_used]), index + n_tokens_used
+
+
+class RestOfLine(Argument): # everything left, joined back together with spaces; must be last
+    def consume(self, tokens, index):
+        rest_of_line = " ".join(tokens[index:])
+        if rest_of_line == "":
+            raise ArgumentError(self.error)
+        return rest_of_line, len(tokens)
+
+
+class ArgumentSchema:
+    """A command's arguments, compiled once (when the command is registered) into a list of steps that parse() runs in one pass"""
+    def __init__(self, arguments):
+        arguments = list(arguments)
+        for argument in arguments[:-1]:
+            if isinstance(argument, RestOfLine):
+                raise ValueError("RestOfLine argument {} must be the last argument in its schema".format(argument.name))
+        self.steps = tuple([(argument.consume, argument.required, argument.default, argument.error) for argument in arguments])
+
+    def parse(self, tokens):
+        values = []
+        index = 0
+        for consume, required, default, error in self.steps:
+            if index >= len(tokens):
+                if required:
+                    raise ArgumentError(error)
+                values.append(default)
+                continue
+
+            try:
+                value, index = consume(tokens, index)
+            except ArgumentError:
+                if required:
+                    raise
+                value = default
+            values.append(value)
+
+        return values # like before, extra tokens past the last argument are ignored
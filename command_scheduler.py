@@ -0,0 +1,121 @@
+import constants as c
+
+from asyncio import ensure_future, gather
+from collections import deque
+
+
+class CommandScheduler:
+    """Sits between on_message and handle_command so that one busy guild can't slow commands down for every other one
+
+    Commands wait in per-guild queues (DMs are queued per user), split into priority classes (0 runs first). Whenever a slot
+    frees up, the highest-priority class with anything waiting is served, taking turns round-robin between the guilds waiting
+    in it; guilds already running guild_limit commands are skipped until one of theirs finishes."""
+    def __init__(self, client, global_limit=c.COMMAND_GLOBAL_CONCURRENCY, guild_limit=c.COMMAND_GUILD_CONCURRENCY,
+                 max_queued_per_guild=c.COMMAND_MAX_QUEUED_PER_GUILD, priorities=None):
+        self.client = client
+        self.global_limit = global_limit
+        self.guild_limit = guild_limit
+        self.max_queued_per_guild = max_queued_per_guild
+        self.priorities = priorities if priorities is not None else c.COMMAND_PRIORITIES # keyword -> priority class
+        self.queues = {} # guild key -> [deque of messages for each priority class]
+        self.ready_guilds = [deque() for _ in range(c.N_COMMAND_PRIORITIES)] # for each priority class, the guild keys with commands waiting in it, in turn order
+        self.guild_running = {} # guild key -> commands currently running
+        self.tasks = set()
+
+        self.n_queued = 0
+        self.n_running = 0
+        self.n_submitted = 0
+        self.n_completed = 0
+        self.n_dropped = 0
+        self.max_queued = 0 # high-water mark of n_queued
+
+    def submit(self, message, keyword):
+        """Queues a command message to be handled when there's room; returns False if its guild's queue was full and it was dropped"""
+        guild_key = message.guild.id if message.guild is not None else message.author.id
+        guild_queues = self.queues.get(guild_key)
+        if guild_queues is None:
+            guild_queues = self.queues[guild_key] = [deque() for _ in range(c.N_COMMAND_PRIORITIES)]
+        elif sum([len(queue) for queue in guild_queues]) >= self.max_queued_per_guild:
+            self.n_dropped += 1
+            return False
+
+        priority = self.priorities.get(keyword, c.DEFAULT_COMMAND_PRIORITY)
+        if len(guild_queues[priority]) == 0:
+            self.ready_guilds[priority].append(guild_key)
+        guild_queues[priority].append(message)
+
+        self.n_submitted += 1
+        self.n_queued += 1
+        self.max_queued = max(self.max_queued, self.n_queued)
+        self.dispatch()
+        return True
+
+    def dispatch(self):
+        while self.n_running < self.global_limit:
+            next_command = self.__next_command()
+            if next_command is None:
+                return
+            guild_key, message = next_command
+            self.guild_running[guild_key] = self.guild_running.get(guild_key, 0) + 1
+            self.n_running += 1
+            task = ensure_future(self.__run(guild_key, message))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def queue_depths(self):
+        """Returns {guild key: commands waiting} for every guild with anything queued"""
+        return {guild_key: sum([len(queue) for queue in guild_queues]) for guild_key, guild_queues in self.queues.items()}
+
+    def stats(self):
+        deepest_guilds = sorted(self.queue_depths().items(), key=lambda depth: depth[1], reverse=True)[:c.COMMAND_STATS_TOP_GUILDS]
+        return {
+            "queued": self.n_queued,
+            "max_queued": self.max_queued,
+            "running": self.n_running,
+            "submitted": self.n_submitted,
+            "completed": self.n_completed,
+            "dropped": self.n_dropped,
+            "queued_by_priority": [sum([len(self.queues[guild_key][priority]) for guild_key in ready_guilds]) for priority, ready_guilds in enumerate(self.ready_guilds)],
+            "deepest_guilds": deepest_guilds
+        }
+
+    async def close(self):
+        """Drops everything that hasn't started yet and waits for the commands that have"""
+        self.n_dropped += self.n_queued
+        self.n_queued = 0
+        self.queues = {}
+        self.ready_guilds = [deque() for _ in range(c.N_COMMAND_PRIORITIES)]
+        await gather(*self.tasks, return_exceptions=True)
+
+    def __next_command(self):
+        for priority, ready_guilds in enumerate(self.ready_guilds):
+            for _ in range(len(ready_guilds)):
+                guild_key = ready_guilds.popleft()
+                if self.guild_running.get(guild_key, 0) >= self.guild_limit:
+                    ready_guilds.append(guild_key) # keeps its place in the rotation, but it'll have to wait for one of its commands to finish
+                    continue
+
+                guild_queues = self.queues[guild_key]
+                message = guild_queues[priority].popleft()
+                if len(guild_queues[priority]) > 0:
+                    ready_guilds.append(guild_key) # back of the line
+                elif not any(guild_queues):
+                    del self.queues[guild_key]
+                self.n_queued -= 1
+                return guild_key, message
+
+        return None
+
+    async def __run(self, guild_key, message):
+        try:
+            await self.client.handle_command(message)
+        except Exception as e: # handle_command catches nearly everything itself, but a stray error here mustn't leak a slot
+            self.client.bot_log.error("Unhandled error while running command {}; error was: {}".format(message.content, e))
+        finally:
+            self.n_running -= 1
+            self.n_completed += 1
+            if self.guild_running[guild_key] == 1:
+                del self.guild_running[guild_key]
+            else:
+                self.guild_running[guild_key] -= 1
+            self.dispatch()
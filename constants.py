@@ -7,6 +7,8 @@ from default_modules.statuses import status_loop
 # main.py
 DIRECTORIES = [
     "databases",
+    "databases/auditlog_archive",
+    "databases/profiles",
     # "logs",
     "quotes/servers",
     "quotes/resources/avatars"
@@ -44,13 +46,16 @@ MAX_REMINDERS_PER_USER = 100
 MESSAGE_TRUNCATOR = "[truncated]"
 TRUNCATED_MESSAGE_LENGTH = 2000 - len(MESSAGE_TRUNCATOR)
 MAX_CHARS_PER_MESSAGE = 2000
-SEND_CYCLE_WAIT_TIME = 0.5
 AMBIGUOUS_ERROR = -1
 QUOTES_COOLDOWN = 2
 AVATAR_TEST_COOLDOWN = 5
 GUILD_REQUIRED_MESSAGE = "Can't call `{}{}` in a DM (unless you set your home server using `{}setserver`)"
 DEFAULT_AUDIT_LOG_ENTRIES = 5
 MAX_AUDIT_LOG_ENTRIES = 100
+AUDIT_LOG_EXPORT_THRESHOLD = 1000 # requests for more entries than this are sent as a file instead of as messages
+AUDIT_LOG_EXPORT_PAGE_SIZE = 1000 # entries read from the database at a time while exporting
+MAX_UPLOAD_FILESIZE = 8 * 10**6 # Discord's attachment limit for bots
+MIN_INDEXED_SEARCH_LENGTH = 3 # the audit log's trigram index can't search for anything shorter
 
 MAGIC_8_BALL_RESPONSES = [
     "Without a doubt.",
@@ -96,11 +101,31 @@ DEFAULT_HELP_DICT = {
                             "auditlog": "**auditlog** *[search term] [number of results to find]*\n"
                             "*auditlog [number of results to find]*\n"
                             "*auditlog [search term]*\n"
+                            "*auditlog archive [search term] [number of results to find]*\n"
                             "*Permissions required: administrator*\n"
                             "    Displays the most recent *n* commands run on this server that match a given search term\n"
                             "    Search term can be any of (username, user ID, part of message)\n"
+                            "    Starting with `archive` searches old commands that have been moved out of the database instead\n"
                             "    `!auditlog addalias 10`\n"
-                            "    `!auditlog Crowfeather`",
+                            "    `!auditlog Crowfeather`\n"
+                            "    `!auditlog archive Crowfeather 20`",
+                            "stats": "**stats**\n"
+                            "*stats lag*\n"
+                            "*Permissions required: bot instance owner*\n"
+                            "    Shows command latencies, error counts and database, queue and cache statistics since the bot started.\n"
+                            "    `lag` instead lists what has blocked the event loop for the longest, and where.",
+                            "profiles": "**profiles** *[number of profiles to list]*\n"
+                            "*profiles get [profile name or number]*\n"
+                            "*profiles command [keyword]*\n"
+                            "*profiles guild [guild ID]*\n"
+                            "*profiles threshold [seconds]*\n"
+                            "*profiles off*\n"
+                            "*Permissions required: bot instance owner*\n"
+                            "    Lists the most recent command profiles (newest first), or sends one as a collapsed stack file (for flamegraph.pl or speedscope).\n"
+                            "    `command`, `guild` and `threshold` start profiling a command, every command in a guild, or every command slower than the threshold; `off` stops all of them.\n"
+                            "    `!profiles get 1`\n"
+                            "    `!profiles command quote`\n"
+                            "    `!profiles threshold 2.5`",
                             "setserver": "**setserver** *[home server ID]*\n"
                             "*setserver [home server name]*\n"
                             "*Permissions required: none*\n"
@@ -113,8 +138,95 @@ DEFAULT_HELP_DICT = {
 
 
 }
+# audit_archive.py
+DEFAULT_AUDIT_LOG_RETENTION_DAYS = 0 # 0 keeps audit log entries in the database forever
+AUDIT_LOG_ARCHIVE_DIR = "databases/auditlog_archive"
+AUDIT_LOG_ARCHIVE_BATCH_SIZE = 500 # entries moved per transaction; small enough that the write lock is only held briefly
+AUDIT_LOG_ARCHIVE_BATCH_DELAY = 1 # seconds between batches while there's a backlog
+AUDIT_LOG_ARCHIVE_LOOP_TIME = 3600 # seconds between checks once everything expired has been archived
+AUDIT_LOG_VACUUM_PAGES = 1000 # pages given back to the filesystem per archived batch
+AUDIT_LOG_ARCHIVE_KEYWORD = "archive" # !auditlog archive [search term] [n] searches the archives instead of the database
+
+# avatar_cache.py
+AVATAR_MEMORY_CACHE_SIZE = 2000 # cropped avatars kept decoded in memory (about 6 KB each; 0 turns this tier off)
+AVATAR_DISK_CACHE_BYTES = 50 * 10**6 # total size of the cropped avatars saved in PFPS_FOLDER_PATH (0 turns this tier off)
+
+# command_scheduler.py
+COMMAND_GLOBAL_CONCURRENCY = 16 # commands running at once across every guild
+COMMAND_GUILD_CONCURRENCY = 2 # commands running at once in any one guild (or one user's DMs)
+COMMAND_MAX_QUEUED_PER_GUILD = 50 # commands waiting in one guild past this are dropped
+N_COMMAND_PRIORITIES = 3
+DEFAULT_COMMAND_PRIORITY = 1
+COMMAND_PRIORITIES = { # 0 for quick lookups, 2 for anything that renders images; everything else (including aliases) is DEFAULT_COMMAND_PRIORITY
+    "aliases": 0,
+    "help": 0,
+    "join": 0,
+    "leave": 0,
+    "listrole": 0,
+    "reminders": 0,
+    "getquote": 2,
+    "getquotes": 2,
+    "quote": 2,
+    "testavatar": 2
+}
+COMMAND_STATS_TOP_GUILDS = 5 # guilds listed in the scheduler's queue-depth stats
+
+# cooldowns.py
+DEFAULT_COOLDOWN_BURST = 1 # how many actions a user can save up; 1 means one action per cooldown, like it's always been
+DEFAULT_COOLDOWN_PERSIST_INTERVAL = 300 # seconds between saving cooldown times to the users table (0 to never save them)
+COOLDOWN_PRUNE_THRESHOLD = 10000 # number of tracked users before buckets that have fully refilled get thrown out
+
+# database_executor.py
+DATABASE_THREADS = 1 # SQLite only allows one writer at a time anyway
+DATABASE_MAX_PENDING_CALLS = 256
+
+# identity_cache.py
+IDENTITY_CACHE_SIZE = 10000 # user and server rows kept in memory (0 to turn the cache off)
+
+# image_fetcher.py
+IMAGE_FETCH_MAX_CONCURRENT = 8 # downloads in flight at once, across every quote being made
+IMAGE_FETCH_TIMEOUT = 15 # seconds for a whole download, connecting included
+IMAGE_FETCH_CHUNK_SIZE = 64 * 1024 # bytes read at a time while checking a download against its size limit
+
 # logging.py
 LOG_SLEEP_TIME = {"audit": 1, "log": 0.5}
+AUDIT_LOG_BATCH_SIZE = 200 # audit log entries are flushed once this many are buffered, or LOG_SLEEP_TIME["audit"] seconds after the first one
+AUDIT_LOG_MAX_QUEUED_ENTRIES = 10000 # past this, commands wait for the writer to catch up before they run
+
+# loop_monitor.py
+LOOP_LAG_THRESHOLD = 0.1 # seconds the event loop can be blocked before the blocker is tracked down (0 turns the monitor off)
+LOOP_LAG_CHECK_INTERVAL = 0.05 # seconds between checks
+LOOP_LAG_MAX_OFFENDERS = 200 # distinct (command, blocking line) pairs remembered
+LOOP_LAG_REPORT_SIZE = 10 # offenders listed by !stats lag
+LOOP_LAG_STACK_DEPTH = 12 # innermost frames kept from each blocking stack
+
+# metrics.py
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30) # seconds
+METRICS_STATEMENT_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100) # SQL statements per command
+METRICS_SUMMARY_COMMANDS = 15 # commands listed by !stats, busiest first
+METRICS_HOST = "127.0.0.1" # only reachable from this machine unless the config says otherwise
+METRICS_PORT = 0 # 0 doesn't start the HTTP endpoint at all
+
+# outbound.py
+OUTBOUND_MAX_RETRIES = 3 # times a message is resent after a 429 that discord.py gave up on
+OUTBOUND_DEFAULT_RETRY_AFTER = 1 # seconds, if a 429 somehow comes without a Retry-After header
+
+# profiler.py
+PROFILE_SAMPLE_INTERVAL = 0.005 # seconds between stack samples while a command is being profiled
+PROFILE_DIR = "databases/profiles"
+MAX_PROFILES = 100 # the oldest profiles are deleted past this
+PROFILES_LISTED = 10 # profiles listed by !profiles
+
+# quote_cache.py
+QUOTE_CACHE_BYTES = 50 * 10**6 # rendered quotes kept in memory, by total PNG size (0 turns the cache off)
+QUOTE_RENDER_SETTINGS = [ # constants that change how a quote looks; changing any of them empties the cache
+    "DEFAULT_V_MARGIN", "DEFAULT_LEFT_MARGIN", "DEFAULT_RIGHT_MARGIN", "PFP_TO_TEXT_MARGIN", "PFP_DIAMETER", "NAME_TO_TIMESTAMP_MARGIN",
+    "NAME_TO_MESSAGE_MARGIN", "BETWEEN_LINES_MARGIN", "BETWEEN_MESSAGES_MARGIN", "BETWEEN_AUTHORS_MARGIN", "AUTHOR_SIZE", "TIMESTAMP_SIZE",
+    "MESSAGE_SIZE", "AUTHOR_COLOR", "TIMESTAMP_COLOR", "MESSAGE_COLOR", "BACKGROUND_COLOR", "PFP_MASK_PATH", "DISCORD_BOLD_FONT",
+    "DISCORD_NORMAL_FONT", "WEEKDAY_NAMES", "TIMESTAMP_TOP_OFFSET", "IMAGE_WIDTH", "MAX_EMBED_DIMENSIONS", "SUPPORTED_IMAGE_FILETYPES",
+    "MAX_EMBED_FILESIZE", "MAX_AVATAR_FILESIZE", "SECONDS_FOR_SEPERATED_MESSAGES", "TIMEZONE", "TEXT_TO_IMAGE_MARGIN", "MAX_CONTENT_WIDTH"
+]
+QUOTE_RENDER_FILES = ["DISCORD_BOLD_FONT", "DISCORD_NORMAL_FONT", "PFP_MASK_PATH"] # constants naming files that change how a quote looks
 
 # quotes.py
 DEFAULT_V_MARGIN = 8 # 2 for the actual margin, 3 for the 3 pixels of space above the text, 3 for the 3 pixels of space below the previous text
@@ -166,6 +278,18 @@ AVATAR_TEST_MESSAGES = [
 ]
 
 MAX_CONTENT_WIDTH = IMAGE_WIDTH - DEFAULT_LEFT_MARGIN - PFP_DIAMETER - PFP_TO_TEXT_MARGIN - DEFAULT_RIGHT_MARGIN # personal choice
+TEXT_WIDTH_CACHE_SIZE = 50000 # distinct (font, word) widths remembered by each process that renders quotes
+TEXT_KERNING_SLACK = 2 # pixels a line's width can differ from the sum of its words' widths by, per space, because of kerning
+
+# render_pool.py
+RENDER_WORKERS = 2 # processes rendering quotes (0 renders them on the event loop thread)
+RENDER_MAX_PENDING = 32 # renders queued up at once; past this, !quote waits for a free slot
+
+# reactions.py
+REACTION_EVENT_TTL = 24 * 60 * 60 # seconds before a reaction event stops working, unless it's registered with ttl=0
+MAX_REACTION_EVENTS = 5000 # past this, the least recently used events are dropped
+REACTION_EVENT_SWEEP_INTERVAL = 300 # seconds between sweeps for expired events
+REACTION_EVENTS_PATH = "databases/reaction_events.json" # where persistent events are saved
 
 # reminders.py
 SECONDS_ALIAS = ["second", "sec", "secs", "seconds"]
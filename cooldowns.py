@@ -0,0 +1,71 @@
+import constants as c
+
+from asyncio import sleep
+from database_utils import User
+
+COOLDOWN_COLUMNS = {"command": "last_command_time", "hook": "last_hook_time"} # action class -> the users column it's persisted to
+
+
+class CooldownLimiter:
+    """Per-user, per-action token buckets, kept in memory instead of in the users table
+
+    With a burst of 1 (the default), this behaves exactly like the old last_command_time/last_hook_time checks:
+    an action is allowed once at least cooldown seconds have passed since the user's last allowed action."""
+    def __init__(self, cooldowns, burst=c.DEFAULT_COOLDOWN_BURST, persist_interval=c.DEFAULT_COOLDOWN_PERSIST_INTERVAL):
+        self.cooldowns = cooldowns # action class -> seconds per token
+        self.burst = burst
+        self.persist_interval = persist_interval # seconds between batched writes to the users table; 0 to never write them
+        self.buckets = {action: {} for action in cooldowns} # action class -> {user id: (tokens, time of last update)}
+        self.unsaved_times = {} # user id -> {column: time of last allowed action} that hasn't been written to the database yet
+
+    def try_acquire(self, action, user_id, now):
+        cooldown = self.cooldowns[action]
+        if cooldown <= 0:
+            return True
+
+        action_buckets = self.buckets[action]
+        if user_id in action_buckets:
+            tokens, last_update = action_buckets[user_id]
+            tokens = min(self.burst, tokens + (now - last_update).total_seconds() / cooldown)
+        else:
+            tokens = self.burst
+
+        if tokens < 1:
+            action_buckets[user_id] = (tokens, now)
+            return False
+
+        action_buckets[user_id] = (tokens - 1, now)
+        if self.persist_interval:
+            self.unsaved_times.setdefault(user_id, {})[COOLDOWN_COLUMNS[action]] = now
+        if len(action_buckets) > c.COOLDOWN_PRUNE_THRESHOLD:
+            self.prune(action, now)
+        return True
+
+    def prune(self, action, now):
+        """Drops every bucket that has refilled completely, since those act the same as users we've never seen"""
+        cooldown = self.cooldowns[action]
+        full_after = self.burst * cooldown
+        self.buckets[action] = {user_id: bucket for user_id, bucket in self.buckets[action].items() if (now - bucket[1]).total_seconds() + bucket[0] * cooldown < full_after}
+
+    def persist(self, client):
+        if len(self.unsaved_times) == 0:
+            return
+
+        unsaved_times, self.unsaved_times = self.unsaved_times, {}
+        session = client.db_session_builder()
+        try: # users that aren't in the table yet are skipped by the bulk update; they're added by get_or_init_user anyway
+            user_rows = [dict(id=user_id, **columns) for user_id, columns in unsaved_times.items()]
+            session.bulk_update_mappings(User, user_rows)
+            session.commit()
+            client.identity_cache.update_rows(User, user_rows) # bulk updates skip the ORM events the cache normally learns from
+            client.bot_log.info("Saved cooldown times for {} users".format(len(unsaved_times)))
+        except Exception as e:
+            client.bot_log.error("Failed to save cooldown times for {} users; error was: {}".format(len(unsaved_times), e))
+            session.rollback()
+        finally:
+            session.close()
+
+    async def persist_loop(self, client):
+        while True:
+            await sleep(self.persist_interval)
+            await client.database_executor.run(self.persist, client)
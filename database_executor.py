@@ -0,0 +1,40 @@
+import constants as c
+
+from asyncio import Semaphore, get_event_loop
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from sqlalchemy.orm import Session
+
+
+class DatabaseExecutor:
+    """Runs blocking SQLAlchemy calls on a dedicated thread so that a slow fsync can't stall the event loop
+
+    At most max_pending calls can be queued up at once; anything past that waits (asynchronously) for a free slot."""
+    def __init__(self, n_threads=c.DATABASE_THREADS, max_pending=c.DATABASE_MAX_PENDING_CALLS):
+        self.thread_pool = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix="akrasia-db")
+        self.max_pending = max_pending
+        self.pending_slots = None # made on first use, so it's bound to the loop the bot actually runs on
+
+    async def run(self, function, *args, **kwargs):
+        if self.pending_slots is None:
+            self.pending_slots = Semaphore(self.max_pending)
+
+        async with self.pending_slots:
+            return await get_event_loop().run_in_executor(self.thread_pool, partial(function, *args, **kwargs))
+
+    def shutdown(self):
+        self.thread_pool.shutdown(wait=True)
+
+
+class ExecutorSession(Session):
+    """A normal Session (so module functions can keep using it synchronously) that can also push work onto the database thread
+
+    e.g. reminders = await session.run(session.query(Reminder).filter(Reminder.user_id == user_id).all)"""
+    def __init__(self, database_executor=None, **kwargs):
+        super().__init__(**kwargs)
+        self.database_executor = database_executor
+
+    async def run(self, function, *args, **kwargs):
+        if self.database_executor is None: # no executor means no thread to hand this off to, so just block
+            return function(*args, **kwargs)
+        return await self.database_executor.run(function, *args, **kwargs)
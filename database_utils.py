@@ -1,12 +1,25 @@
 import constants as c
 import datetime as dt
 
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy_utils.functions import database_exists
 BaseTable = declarative_base()
 
+AUDIT_LOG_SEARCH_TABLE = "auditlog_fts"
+AUDIT_LOG_SEARCH_SQL = [ # keep in sync with the 3f9c2a7d8b41 migration
+    "CREATE VIRTUAL TABLE IF NOT EXISTS auditlog_fts USING fts5(message_content, content='auditlog', content_rowid='message_id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS auditlog_fts_insert AFTER INSERT ON auditlog BEGIN "
+    "INSERT INTO auditlog_fts(rowid, message_content) VALUES (new.message_id, new.message_content); END",
+    "CREATE TRIGGER IF NOT EXISTS auditlog_fts_delete AFTER DELETE ON auditlog BEGIN "
+    "INSERT INTO auditlog_fts(auditlog_fts, rowid, message_content) VALUES ('delete', old.message_id, old.message_content); END",
+    "CREATE TRIGGER IF NOT EXISTS auditlog_fts_update AFTER UPDATE ON auditlog BEGIN "
+    "INSERT INTO auditlog_fts(auditlog_fts, rowid, message_content) VALUES ('delete', old.message_id, old.message_content); "
+    "INSERT INTO auditlog_fts(rowid, message_content) VALUES (new.message_id, new.message_content); END"
+]
+
 
 class Server(BaseTable):
     __tablename__ = "servers"
@@ -86,9 +99,28 @@ def init_databases(engine):
     Server.quotes = relationship("Quote", back_populates="server")
     User.audit_log_entries = relationship(AuditLogEntry, back_populates="user")
 
+    if engine.dialect.name == "sqlite": # only takes effect on new databases, but lets audit log archiving give space back without a full VACUUM
+        engine.execute("PRAGMA auto_vacuum = INCREMENTAL")
     BaseTable.metadata.create_all(engine)
 
 
+def init_audit_log_search(engine):
+    """Makes sure the full-text index over audit log entries exists; returns False if this backend can't have one"""
+    if engine.dialect.name != "sqlite":
+        return False
+
+    try:
+        with engine.begin() as connection:
+            index_existed = connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"), name=AUDIT_LOG_SEARCH_TABLE).first() is not None
+            for statement in AUDIT_LOG_SEARCH_SQL:
+                connection.execute(text(statement))
+            if not index_existed: # index every entry written before the index was
+                connection.execute(text("INSERT INTO auditlog_fts(auditlog_fts) VALUES ('rebuild')"))
+        return True
+    except OperationalError: # SQLite was built without FTS5, or is too old for the trigram tokenizer (3.34+)
+        return False
+
+
 async def setup(message, _, session, log, doesnt_exist=False):
     if message.guild is None:
         return "Can't call setup in a DM!" # flat-out return here since there's no point in contacting the database
@@ -114,9 +146,20 @@ async def setup(message, _, session, log, doesnt_exist=False):
     return "Setup successful!"
 
 
+def get_server_quotes(server):
+    """Every quote on server (up to c.MAX_QUOTES_PER_SERVER rows); it's a lazy load, so run it with session.run"""
+    return list(server.quotes)
+
+
 def get_or_init_server(client, guild, session):
+    server = client.identity_cache.get(Server, guild.id, session)
+    if server is not None:
+        return server
+
     server = session.query(Server).filter(Server.id == guild.id).first()
-    if server is None:
+    if server is not None:
+        client.identity_cache.put(server)
+    else:
         try:
             server = Server(id=guild.id, name=guild.name, last_quotes_time=dt.datetime.now() - dt.timedelta(seconds=c.QUOTES_COOLDOWN))
             session.add(server)
@@ -129,8 +172,14 @@ def get_or_init_server(client, guild, session):
 
 
 def get_or_init_user(client, message, session):
+    user = client.identity_cache.get(User, message.author.id, session)
+    if user is not None:
+        return user
+
     user = session.query(User).filter(User.id == message.author.id).first()
-    if user is None:
+    if user is not None:
+        client.identity_cache.put(user)
+    else:
         try:
             user = User(id=message.author.id, name=message.author.name, last_test_avatar_time=dt.datetime.now() - dt.timedelta(seconds=c.AVATAR_TEST_COOLDOWN))
             session.add(user)
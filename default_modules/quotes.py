@@ -1,10 +1,11 @@
 import sqlalchemy as db
 
-from database_utils import Quote, get_or_init_server, get_or_init_user
+from asyncio import gather
+from functools import partial
+from database_utils import Quote, get_or_init_server, get_or_init_user, get_server_quotes
 from discord import DMChannel, File
 from discord.errors import HTTPException
 from message_utils import get_time_text
-from multiprocessing.pool import ThreadPool
 from random import choice
 
 # Asynchronous (Discord) functions
@@ -30,8 +31,7 @@ async def quote(client, message, command_args, session):
                     next_messages = await message.channel.history(limit=(n_messages - 1), after=first_message.created_at).flatten()
                     messages.extend(next_messages)
 
-            quote_img = make_quote(messages, message.guild)
-            quote_img_link = await __upload_quote(client, message.guild.id, quote_img)
+            quote_img_link = await __upload_quote(client, message.guild.id, messages)
             return await __add_quote_to_database(client, message, messages, quote_img_link, session)
         except HTTPException:  # this means the first word wasn't a message ID; we can still try to find it in word search
             pass
@@ -63,8 +63,7 @@ async def quote(client, message, command_args, session):
                                                       after=matching_message.created_at).flatten()
         messages.extend(next_messages)
 
-    quote_img = make_quote(messages, message.guild)
-    quote_img_link = await __upload_quote(client, message.guild.id, quote_img)
+    quote_img_link = await __upload_quote(client, message.guild.id, messages)
 
     return await __add_quote_to_database(client, message, messages, quote_img_link, session)
 
@@ -76,10 +75,15 @@ async def __add_quote_to_database(client, message, messages, quote_img_link, ses
         if m.clean_content is not None and len(m.clean_content) > 0:
             text_in_quote += m.clean_content
     user_id_string = " ".join(users_in_quote)
+    existing_quote = await session.run(session.query(Quote).filter(Quote.image_url == quote_img_link).first) # the link is reused if the same quote was uploaded before
+    if existing_quote is not None:
+        client.bot_log.info("Didn't add quote in {} (id: {}); it already exists at {}".format(messages[0].guild.name, messages[0].guild.id, quote_img_link))
+        return "That quote already exists!\n{}".format(quote_img_link)
     try:
-        server = get_or_init_server(client, messages[0].guild, session)
-        if len(server.quotes) > c.MAX_QUOTES_PER_SERVER:
-            await message.channel.send(
+        server = await session.run(get_or_init_server, client, messages[0].guild, session)
+        server_quotes = await session.run(get_server_quotes, server)
+        if len(server_quotes) > c.MAX_QUOTES_PER_SERVER:
+            await client.outbound_queue.send(message.channel,
                 "Maximum number of quotes per server exceeded ({})! To increase your maximum, please contact `SyIvan#1334` via PMs.".format(
                     c.MAX_QUOTES_PER_SERVER))
             raise Exception("max number of quotes exceeded")
@@ -92,7 +96,15 @@ async def __add_quote_to_database(client, message, messages, quote_img_link, ses
     return "Quote added!\n{}".format(quote_img_link)
 
 
-async def __upload_quote(client, server_id, quote_img):
+async def __upload_quote(client, server_id, messages):
+    """Makes the quote of messages and uploads it to the home server (unless that exact quote was uploaded already); returns its link"""
+    quote_key = get_quote_key(messages)
+    quote_img_link = client.quote_cache.get_link(quote_key)
+    if quote_img_link is not None:
+        return quote_img_link
+
+    quote_png = await make_quote(client, messages, quote_key=quote_key)
+
     home_server = client.get_guild(c.HOME_SERVER_ID)
     server_quote_channel = [channel for channel in home_server.text_channels if channel.name == str(server_id)]
     if len(server_quote_channel) == 0:
@@ -100,23 +112,23 @@ async def __upload_quote(client, server_id, quote_img):
     else:
         server_quote_channel = server_quote_channel[0]
 
-    with BytesIO() as file_buffer:
-        quote_img.save(file_buffer, format="png")
-        file_buffer.seek(0)  # reset the pointer to the beginning so we don't send 0 bytes
+    with BytesIO(quote_png) as file_buffer:
         msg_with_file = await server_quote_channel.send(file=File(file_buffer, filename="quote.png"))
+    client.quote_cache.set_link(quote_key, msg_with_file.attachments[0].url)
     return msg_with_file.attachments[0].url
 
 
 async def get_quote(client, message, command_args, session):
     if message.guild is None:
         return c.GUILD_REQUIRED_MESSAGE.format(client.command_prefix, "getquote", client.command_prefix)
-    server = get_or_init_server(client, message.guild, session)
+    server = await session.run(get_or_init_server, client, message.guild, session)
+    server_quotes = await session.run(get_server_quotes, server)
 
-    relevant_quotes, error = await __search_quotes(client, message.guild, server, command_args, only_one=True)
+    relevant_quotes, error = await __search_quotes(client, message.guild, server, server_quotes, command_args, only_one=True)
     if error is not None and error != c.AMBIGUOUS_ERROR: # ambiguity is fine here; we just send one of the ambiguous quotes
-        await message.channel.send(error)
+        await client.outbound_queue.send(message.channel, error)
     else:
-        await message.channel.send(choice(relevant_quotes).image_url)
+        await client.outbound_queue.send(message.channel, choice(relevant_quotes).image_url)
 
 
 async def delete_quote(client, message, command_args, session):
@@ -126,12 +138,12 @@ async def delete_quote(client, message, command_args, session):
     if not message.author.guild_permissions.administrator:
         return "You don't have permissions to run that command! (required permissions: administrator)"
 
-    server = get_or_init_server(client, message.guild, session)
+    server = await session.run(get_or_init_server, client, message.guild, session)
 
     if len(command_args) == 1 and command_args[0][
                                   :39] == "https://cdn.discordapp.com/attachments/":  # before text searching, try to remove the quote by URL
-        matching_quote = session.query(Quote).filter(
-            db.and_(Quote.server_id == message.guild.id, Quote.image_url == command_args[0])).first()
+        matching_quote = await session.run(session.query(Quote).filter(
+            db.and_(Quote.server_id == message.guild.id, Quote.image_url == command_args[0])).first)
         if matching_quote is None:
             client.bot_log.info("couldn't find a quote to delete in server {} (id: {}) with url {}".format(message.guild.name, message.guild.id, command_args[0]))
             return "Couldn't find a quote at that URL!"
@@ -140,12 +152,13 @@ async def delete_quote(client, message, command_args, session):
             session.delete(matching_quote)
             return "Quote deleted!"
 
-    relevant_quotes, error = await __search_quotes(client, message.guild, server, command_args, only_one=True)
+    server_quotes = await session.run(get_server_quotes, server)
+    relevant_quotes, error = await __search_quotes(client, message.guild, server, server_quotes, command_args, only_one=True)
     if error is not None:
         if error == c.AMBIGUOUS_ERROR:
             return "\n".join(["Ambiguous text search term. Found {} results:".format(len(relevant_quotes))] + [rquote.image_url for rquote in relevant_quotes])
         else:
-            await message.channel.send(error)
+            await client.outbound_queue.send(message.channel, error)
     else:
         client.bot_log.info("Successfully deleted quote with id {} from server {} (id: {})".format(relevant_quotes[0].id, message.guild.name, message.guild.id))
         session.delete(relevant_quotes[0])
@@ -156,14 +169,15 @@ async def get_quotes(client, message, command_args, session):
     if message.guild is None:
         return c.GUILD_REQUIRED_MESSAGE.format(client.command_prefix, "getquotes", client.command_prefix)
 
-    server = get_or_init_server(client, message.guild, session)
+    server = await session.run(get_or_init_server, client, message.guild, session)
     remaining_cooldown_time = c.QUOTES_COOLDOWN - (dt.datetime.now() - server.last_quotes_time).total_seconds()
     if remaining_cooldown_time > 0:
         return "Quotes is on cooldown (try again in {} seconds!)".format(remaining_cooldown_time)
 
-    relevant_quotes, error = await __search_quotes(client, message.guild, server, command_args)
+    server_quotes = await session.run(get_server_quotes, server)
+    relevant_quotes, error = await __search_quotes(client, message.guild, server, server_quotes, command_args)
     if error is not None:
-        await message.channel.send(error)
+        await client.outbound_queue.send(message.channel, error)
     else:
         server.last_quotes_time = dt.datetime.now()
 
@@ -183,20 +197,20 @@ async def get_quotes(client, message, command_args, session):
         if len(ret) > 3: # if more than 15 quotes have to be sent, send them in DMs
             client.bot_log.info("Returning {} quotes to user {} (id: {}) in DMs".format(len(relevant_quotes), message.author.name, message.author.id))
             if not isinstance(message.channel, DMChannel):
-                await message.channel.send("Check your DMs!")
-            for ret_message in ret:
-                await message.author.send(ret_message)
+                await client.outbound_queue.send(message.channel, "Check your DMs!")
+            quotes_destination = message.author
         else: # otherwise, just reply in the channel like normal
             client.bot_log.info("Returning {} quotes to user {} (id: {}) in the request channel".format(len(relevant_quotes), message.author.name, message.author.id))
-            for ret_message in ret:
-                await message.channel.send(ret_message)
+            quotes_destination = message.channel
+        await gather(*[client.outbound_queue.enqueue(quotes_destination, ret_message, coalesce=False) for ret_message in ret]) # queued all at once (so they go out back-to-back), but never merged, or links past the fifth lose their previews
 
 
-async def __search_quotes(client, guild, server, command_args, only_one=False):
+async def __search_quotes(client, guild, server, server_quotes, command_args, only_one=False):
+    """server_quotes is every quote on server, already loaded (see get_server_quotes)"""
     if len(command_args) == 0:
-        if len(server.quotes):
+        if len(server_quotes):
             client.bot_log.info("Returning all quotes on server {} (id: {}) to parameter-less quote search".format(server.name, server.id))
-            return server.quotes, None
+            return server_quotes, None
         else:
             client.bot_log.info("Couldn't list quotes for server {} (id: {}) because it doesn't have any".format(server.name, server.id))
             return None, "No quotes exist on this server!"
@@ -205,7 +219,7 @@ async def __search_quotes(client, guild, server, command_args, only_one=False):
     client.bot_log.info("searching for quotes on server {} (id: {}) with search params (user: {}, text: {})".format(server.name, server.id, user_search_string, text_search_string))
     # first, try to search for user by ID, then user by name, then user by nickname
     try:  # note that this allows searching by user ID for quotes from users who've since left the server
-        relevant_quotes = [rquote for rquote in server.quotes if user_search_string in rquote.user_ids]
+        relevant_quotes = [rquote for rquote in server_quotes if user_search_string in rquote.user_ids]
         if text_search_string:
             relevant_quotes = [rquote for rquote in relevant_quotes if text_search_string in rquote.text]
 
@@ -228,7 +242,7 @@ async def __search_quotes(client, guild, server, command_args, only_one=False):
         return "Ambiguous user. Did you mean:" + "\n".join(
             ["{} (nickname: {}, id: {})".format(user.name, user.nick, user.id) for user in relevant_users])
     elif len(relevant_users) == 1:
-        relevant_quotes = [rquote for rquote in server.quotes if str(relevant_users[0].id) in rquote.user_ids]
+        relevant_quotes = [rquote for rquote in server_quotes if str(relevant_users[0].id) in rquote.user_ids]
         if text_search_string:
             relevant_quotes = [rquote for rquote in relevant_quotes if text_search_string in rquote.text]
 
@@ -255,7 +269,7 @@ async def __search_quotes(client, guild, server, command_args, only_one=False):
         return "Ambiguous user. Did you mean:" + "\n".join(
             ["{} (nickname: {}, id: {})".format(user.name, user.nick, user.id) for user in relevant_users])
     elif len(relevant_users) == 1:
-        relevant_quotes = [rquote for rquote in server.quotes if str(relevant_users[0].id) in rquote.user_ids]
+        relevant_quotes = [rquote for rquote in server_quotes if str(relevant_users[0].id) in rquote.user_ids]
         if text_search_string:
             relevant_quotes = [rquote for rquote in relevant_quotes if text_search_string in rquote.text]
         if len(relevant_quotes):
@@ -272,7 +286,7 @@ async def __search_quotes(client, guild, server, command_args, only_one=False):
         text_search_string = user_search_string + " " + text_search_string
     else:
         text_search_string = user_search_string
-    relevant_quotes = [rquote for rquote in server.quotes if text_search_string.lower() in rquote.text.lower()]
+    relevant_quotes = [rquote for rquote in server_quotes if text_search_string.lower() in rquote.text.lower()]
     if len(relevant_quotes):
         client.bot_log.info("Found last-resort quotes matching the parameters (text: {}) on server {} (id: {})".format(
             text_search_string, server.name, server.id))
@@ -295,91 +309,184 @@ async def test_avatar(client, message, __, session):
         client.bot_log.info("failed to preview avatar for user {} (id: {}); no or unsupported attachment".format(message.author.name, message.author.id))
         return "Must include an attachment or embed of an image of one of these filetypes: {}\n\nNote that linking the image doesn't always work, but uploading it does.".format(c.SUPPORTED_IMAGE_FILETYPES)
 
-    user = get_or_init_user(client, message, session)
+    user = await session.run(get_or_init_user, client, message, session)
     cooldown_time_remaining = c.AVATAR_TEST_COOLDOWN - (dt.datetime.now() - user.last_test_avatar_time).total_seconds()
     if cooldown_time_remaining > 0:
         client.bot_log.info("failed to preview avatar at {} for user {} (id: {}); {} seconds left on cooldown time".format(avatar_url, message.author.name, message.author.id, cooldown_time_remaining))
         return "You tested another avatar too recently (try again in {} seconds)".format(cooldown_time_remaining)
 
-    test_img = avatar_test_message(message.author.display_name, avatar_url, dt.datetime.now(), choice(c.AVATAR_TEST_MESSAGES))
-    with BytesIO() as file_buffer:
-        test_img.save(file_buffer, format="png")
-        file_buffer.seek(0) # reset the pointer to the beginning so we don't send 0 bytes
-        await message.channel.send(file=File(file_buffer, filename="avatar_test.png"))
+    test_png = await avatar_test_message(client, message.author.display_name, avatar_url, dt.datetime.now())
+    if test_png is None:
+        client.bot_log.info("failed to preview avatar at {} for user {} (id: {}); couldn't download it".format(avatar_url, message.author.name, message.author.id))
+        return "Couldn't get the avatar (it has to be an image under {} Mb)".format(c.MAX_AVATAR_FILESIZE // 10**6)
+    with BytesIO(test_png) as file_buffer:
+        await client.outbound_queue.send(message.channel, file=File(file_buffer, filename="avatar_test.png"))
     client.bot_log.info("previewed avatar at {} for user {} (id: {});".format(avatar_url, message.author.name, message.author.id))
     user.last_test_avatar_time = dt.datetime.now()
 
+
+async def make_quote(client, messages, store_avatar=True, quote_key=None):
+    """Returns the quote of messages as PNG bytes, from client.quote_cache or rendered in client.render_pool"""
+    return await client.quote_cache.get(quote_key or get_quote_key(messages), partial(__render_quote, client, messages, store_avatar))
+
+
+async def avatar_test_message(client, author_name, avatar_url, created_at):
+    """The quote for !testavatar as PNG bytes, or None if the avatar couldn't be downloaded (or was over c.MAX_AVATAR_FILESIZE) or read
+
+    Uploads get a new URL every time, so the avatar is always downloaded, but the quote is keyed by (and its test message
+    picked from) the avatar's contents; testing the same image again within the minute reuses the render."""
+    avatar_bytes = await client.image_fetcher.fetch(avatar_url, c.MAX_AVATAR_FILESIZE)
+    if avatar_bytes is None:
+        return None
+    avatar_digest = hashlib.sha256(avatar_bytes).hexdigest()
+    clean_content = c.AVATAR_TEST_MESSAGES[int(avatar_digest, 16) % len(c.AVATAR_TEST_MESSAGES)]
+    messages = [QuoteMessage(1, QuoteAuthor(0, author_name, avatar_digest), created_at, clean_content)] # the digest stands in for the avatar's URL; only one of these will be in draw_quote() at a time, so the ids are safe
+    return await client.quote_cache.get(get_quote_key(messages), partial(__render_avatar_test, client, messages, avatar_bytes))
+
+
+async def __render_quote(client, messages, store_avatar):
+    image_bytes, avatars = await fetch_quote_images(client, messages, store_avatar)
+    quote_messages = [QuoteMessage.from_message(message) for message in messages]
+    return await client.render_pool.run(render_quote_png, quote_messages, image_bytes, avatars)
+
+
+async def __render_avatar_test(client, messages, avatar_bytes):
+    avatar_img = await client.render_pool.run(crop_avatar, avatar_bytes)
+    if avatar_img is None:
+        return None
+    return await client.render_pool.run(render_quote_png, messages, {}, {messages[0].author.avatar_url: avatar_img})
+
+
+async def fetch_quote_images(client, messages, store_avatar=True):
+    """Downloads every attachment and embed image in messages, and gets every avatar from client.avatar_cache, all at once
+
+    Returns ({message id: [image bytes]}, {avatar url: cropped avatar Image, or None if it couldn't be downloaded}). messages
+    can be discord.Messages or QuoteMessages; store_avatar=False keeps new avatars out of the cache."""
+    for message in messages:
+        if len(message.attachments) > 2: # hard cap attachments and embeds at 2 so my hard drive doesn't blow up
+            message.attachments = message.attachments[:2]
+        if len(message.embeds) > 2:
+            message.embeds = message.embeds[:2]
+
+    image_objects = [DiscordImage(attachment_or_embed, message.id) for message in messages for attachment_or_embed in (message.attachments + message.embeds)]
+    avatar_urls = list(dict.fromkeys([str(message.author.avatar_url) for message in messages]))
+    fetched_images, *avatars = await gather(client.image_fetcher.fetch_all([image_object.url for image_object in image_objects], c.MAX_EMBED_FILESIZE),
+                                            *[client.avatar_cache.get(client, avatar_url, store_avatar) for avatar_url in avatar_urls])
+
+    image_bytes = {}
+    for image_object, fetched_image in zip(image_objects, fetched_images):
+        if fetched_image is not None:
+            image_bytes.setdefault(image_object.message_id, []).append(fetched_image)
+    return image_bytes, dict(zip(avatar_urls, avatars))
+
 # Synchronous (client-side) functions
 import datetime as dt
-import requests
 import os
 import constants as c
 
+import hashlib
+import logging
+
+from collections import OrderedDict
 from discord import Attachment, Embed
+from functools import lru_cache
 from io import BytesIO
 from PIL import Image, ImageChops, ImageDraw, ImageFont
 
+text_widths = OrderedDict() # (font, text) -> width in pixels, for text_width; each render worker has its own
+log = logging.getLogger(__name__) # warnings still reach stderr from render workers, where logging isn't configured
 
-class TestMessage: # imitates discord.Message for !testavatar
-    def __init__(self, author_name, avatar_url, created_at, clean_content):
-        self.id = 1 # only one of these will be in draw_quote() at a time, so this is safe
-        self.author = TestAuthor(author_name, avatar_url)
+
+class QuoteMessage: # the parts of a discord.Message that a quote shows; unlike a discord.Message, it can be pickled into a render worker
+    def __init__(self, message_id, author, created_at, clean_content):
+        self.id = message_id
+        self.author = author
         self.created_at = created_at
         self.clean_content = clean_content
-        self.attachments = []
+        self.attachments = [] # images are passed to the renderer separately, as bytes
         self.embeds = []
 
+    @classmethod
+    def from_message(cls, message):
+        return cls(message.id, QuoteAuthor(message.author.id, message.author.display_name, str(message.author.avatar_url)), message.created_at, message.clean_content)
+
 
-class TestAuthor:
-    def __init__(self, display_name, avatar_url):
+class QuoteAuthor:
+    def __init__(self, author_id, display_name, avatar_url):
+        self.id = author_id
         self.display_name = display_name
         self.avatar_url = avatar_url
 
+    def __eq__(self, other): # like discord.User, so consecutive messages from one author are grouped even though each has its own QuoteAuthor
+        return isinstance(other, QuoteAuthor) and other.id == self.id
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.id)
+
 
-def avatar_test_message(author_name, avatar_url, created_at, clean_content):
-    headers_response = requests.head(avatar_url)
-    if int(headers_response.headers.get("content-length", c.MAX_AVATAR_FILESIZE + 1)) > c.MAX_AVATAR_FILESIZE:
-        return "Avatar filesize is too big!"
+def get_quote_key(messages):
+    """Identifies everything a quote of messages would show (as of now), for client.quote_cache
 
-    messages = [TestMessage(author_name, avatar_url, created_at, clean_content)]
-    return make_quote(messages, None, store_avatar=False)
+    Message ids stand in for their timestamps (they're snowflakes), and the timestamps' text is included since "Today" turns
+    into "Yesterday"; edits, name changes, new avatars and different attachments all make a different key."""
+    now = dt.datetime.now() # the same as parse_quote and draw_quote use
+    key_parts = []
+    for message in messages:
+        key_parts.append((message.id, str(getattr(message, "edited_at", None)), message.author.id, message.author.display_name, str(message.author.avatar_url),
+                          get_time_text(message.created_at, now), message.clean_content,
+                          [str(DiscordImage(attachment_or_embed, message.id).url) for attachment_or_embed in (message.attachments + message.embeds)]))
+    return hashlib.sha256(repr(key_parts).encode()).hexdigest()
+
+
+def render_quote(messages, image_bytes, avatars):
+    """Draws the quote from images and avatars that were already downloaded by fetch_quote_images"""
+    quote_img_size, quote_imgs, fonts, text_lines = parse_quote(messages, image_bytes)
+    return draw_quote(messages, quote_img_size, quote_imgs, fonts, text_lines, avatars)
+
+
+def render_quote_png(messages, image_bytes, avatars):
+    """render_quote, encoded as PNG; this is what runs in the render pool's workers"""
+    with BytesIO() as file_buffer:
+        render_quote(messages, image_bytes, avatars).save(file_buffer, format="png")
+        return file_buffer.getvalue()
 
 
-def make_quote(messages, _, store_avatar=True):
-    """quote_is_possible, error = ensure_quote(server, messages[0].id, len(messages))
-    if not quote_is_possible:
-        return error"""
+def load_render_resources():
+    """Loads the fonts and avatar mask every quote needs, so the first quote a render worker draws doesn't pay for it"""
+    load_fonts()
+    load_pfp_mask()
 
-    quote_img_size, quote_imgs, fonts = parse_quote(messages)
-    return draw_quote(messages, quote_img_size, quote_imgs, fonts, store_avatar)
 
-def parse_quote(messages):
+def parse_quote(messages, image_bytes):
     now = dt.datetime.now() # used for timestamping messages relative to when they're quoted
     name_font, timestamp_font, content_font = load_fonts()
     last_user_to_talk = None
     last_message = None
-    image_objects = []
+    text_lines = {} # message id -> its content, wrapped, so draw_quote doesn't have to wrap it again
     image_size = [c.DEFAULT_LEFT_MARGIN + c.PFP_DIAMETER + c.PFP_TO_TEXT_MARGIN, c.DEFAULT_V_MARGIN - c.BETWEEN_AUTHORS_MARGIN] # when we set the first last_user_to_talk, this will make the initial vertical offset = c.BEGINNING_TOP_OFFSET
     for message in messages:
-        if len(message.attachments) > 2: # hard cap attachments and embeds at 2 so my hard drive doesn't blow up
-            message.attachments = message.attachments[:2]
-        if len(message.embeds) > 2:
-            message.attachments = message.embeds[:2]
-
         if message.author != last_user_to_talk or (message.created_at - last_message.created_at).total_seconds() > c.SECONDS_FOR_SEPERATED_MESSAGES:
             last_user_to_talk = message.author
             image_size[1] += c.BETWEEN_AUTHORS_MARGIN + c.AUTHOR_SIZE + c.NAME_TO_MESSAGE_MARGIN # switching authors has the effect of adding another c.BETWEEN_MESSAGES_MARGIN
-            name_plus_timestamp_width = name_font.getsize(message.author.display_name)[0] + timestamp_font.getsize(get_time_text(message.created_at, now))[0]
+            name_plus_timestamp_width = text_width(name_font, message.author.display_name) + timestamp_font.getsize(get_time_text(message.created_at, now))[0]
         else:
             name_plus_timestamp_width = 0 # no need to calculate this again if we adjusted for it in this user's first message
 
-        for attachment_or_embed in (message.attachments + message.embeds):
-            image_objects.append(DiscordImage(attachment_or_embed, message.id))
+        content_width = 0
+        if message.clean_content is not None and len(message.clean_content) > 0:
+            lines = text_lines[message.id] = wrap_text(message.clean_content, content_font, c.MAX_CONTENT_WIDTH)
+            image_size[1] += len(lines) * (c.MESSAGE_SIZE + c.BETWEEN_LINES_MARGIN)
+            if "\n" in message.clean_content or "  " in message.clean_content or message.clean_content.strip(" ") != message.clean_content: # wrap_text breaks lines at these too, and getsize counts them differently
+                content_width = content_font.getsize(message.clean_content)[0]
+            elif len(lines) > 1: # so it only wrapped because it was too wide, and it's clamped below anyway
+                content_width = c.MAX_CONTENT_WIDTH
+            else: # the one line is the whole message, and wrap_text just measured its words
+                content_width = text_width(content_font, lines[0])
+        image_size[1] += c.BETWEEN_MESSAGES_MARGIN
 
-        if len(message.clean_content) > 0:
-            content_width = content_font.getsize(message.clean_content)[0]
-        else:
-            content_width = 0
         message_width = max(name_plus_timestamp_width, content_width)
         if message_width > image_size[0]:
             if message_width > c.MAX_CONTENT_WIDTH:
@@ -387,32 +494,22 @@ def parse_quote(messages):
             else:
                 image_size[0] = message_width
 
-        if message.clean_content is not None and len(message.clean_content) > 0:
-            text_lines = len(wrap_text(message.clean_content, content_font, c.MAX_CONTENT_WIDTH))
-            image_size[1] += text_lines * (c.MESSAGE_SIZE + c.BETWEEN_LINES_MARGIN)
-        image_size[1] += c.BETWEEN_MESSAGES_MARGIN
-
         last_message = message
 
-    image_threadpool = ThreadPool()
-    image_threadpool.map(lambda i: i.fetch_image(), image_objects)
-    image_threadpool.close()
-
     images = {}
-    for image_object in [i for i in image_objects if i.image is not None]:
-        if image_object.message_id in images:
-            images[image_object.message_id] += [image_object.image]
-        else:
-            images[image_object.message_id] = [image_object.image]
-
-        image_size[0] = max(image_size[0], image_object.image.size[0])
-        image_size[1] += image_object.image.size[1] + c.BETWEEN_LINES_MARGIN
+    for message_id, message_image_bytes in image_bytes.items():
+        for image in [open_image(i) for i in message_image_bytes]:
+            if image is None:
+                continue
+            images.setdefault(message_id, []).append(image)
+            image_size[0] = max(image_size[0], image.size[0])
+            image_size[1] += image.size[1] + c.BETWEEN_LINES_MARGIN
     image_size[0] += c.DEFAULT_LEFT_MARGIN + c.PFP_DIAMETER + c.PFP_TO_TEXT_MARGIN + c.DEFAULT_RIGHT_MARGIN # set this afterwards so we can do image_size[0] > c.MAX_CONTENT_WIDTH comparisons earlier
     image_size[1] += c.DEFAULT_V_MARGIN # add bottom margin
-    return (image_size[0], image_size[1]), images, {"name": name_font, "timestamp": timestamp_font, "content": content_font}
+    return (image_size[0], image_size[1]), images, {"name": name_font, "timestamp": timestamp_font, "content": content_font}, text_lines
 
 
-def draw_quote(messages, image_size, images, fonts, store_avatar):
+def draw_quote(messages, image_size, images, fonts, text_lines, avatars):
     background = Image.new("RGBA", image_size, c.BACKGROUND_COLOR)
     background_draw = ImageDraw.Draw(background)
 
@@ -426,24 +523,22 @@ def draw_quote(messages, image_size, images, fonts, store_avatar):
             last_user_to_talk = message.author
             vertical_offset += c.BETWEEN_AUTHORS_MARGIN
 
-            avatar_img = get_avatar_img(message.author, store_avatar)
+            avatar_img = avatars.get(str(message.author.avatar_url))
             if avatar_img is not None: # sometimes we won't get the avatar for some reason; this is fine
                 background.paste(avatar_img, (c.DEFAULT_LEFT_MARGIN, vertical_offset), avatar_img)
 
             background_draw.text((c.DEFAULT_LEFT_MARGIN + c.PFP_DIAMETER + c.PFP_TO_TEXT_MARGIN, vertical_offset), message.author.display_name, c.AUTHOR_COLOR, fonts["name"])
-            background_draw.text((c.DEFAULT_LEFT_MARGIN + c.PFP_DIAMETER + c.PFP_TO_TEXT_MARGIN + fonts["name"].getsize(message.author.display_name)[0] + c.NAME_TO_TIMESTAMP_MARGIN, vertical_offset + c.TIMESTAMP_TOP_OFFSET), get_time_text(message.created_at, now), c.TIMESTAMP_COLOR, fonts["timestamp"])
+            background_draw.text((c.DEFAULT_LEFT_MARGIN + c.PFP_DIAMETER + c.PFP_TO_TEXT_MARGIN + text_width(fonts["name"], message.author.display_name) + c.NAME_TO_TIMESTAMP_MARGIN, vertical_offset + c.TIMESTAMP_TOP_OFFSET), get_time_text(message.created_at, now), c.TIMESTAMP_COLOR, fonts["timestamp"])
             vertical_offset += c.AUTHOR_SIZE + c.NAME_TO_MESSAGE_MARGIN
 
-        if message.clean_content is not None and len(message.clean_content) > 0:
-            for line in wrap_text(message.clean_content, fonts["content"], c.MAX_CONTENT_WIDTH):
-                background_draw.text((c.DEFAULT_LEFT_MARGIN + c.PFP_DIAMETER + c.PFP_TO_TEXT_MARGIN, vertical_offset), line, c.MESSAGE_COLOR, fonts["content"])
-                vertical_offset += c.BETWEEN_LINES_MARGIN + c.MESSAGE_SIZE
+        for line in text_lines.get(message.id, []): # none for messages without any text
+            background_draw.text((c.DEFAULT_LEFT_MARGIN + c.PFP_DIAMETER + c.PFP_TO_TEXT_MARGIN, vertical_offset), line, c.MESSAGE_COLOR, fonts["content"])
+            vertical_offset += c.BETWEEN_LINES_MARGIN + c.MESSAGE_SIZE
 
-        if len(message.attachments) or len(message.embeds):
-            for image in images[message.id]:
-                vertical_offset += c.TEXT_TO_IMAGE_MARGIN
-                background.paste(image, (c.DEFAULT_LEFT_MARGIN + c.PFP_DIAMETER + c.PFP_TO_TEXT_MARGIN, vertical_offset), image)
-                vertical_offset += image.size[1] + c.BETWEEN_LINES_MARGIN
+        for image in images.get(message.id, []): # only messages with attachments or embeds that could be downloaded have any
+            vertical_offset += c.TEXT_TO_IMAGE_MARGIN
+            background.paste(image, (c.DEFAULT_LEFT_MARGIN + c.PFP_DIAMETER + c.PFP_TO_TEXT_MARGIN, vertical_offset), image)
+            vertical_offset += image.size[1] + c.BETWEEN_LINES_MARGIN
 
         last_message = message
 
@@ -466,110 +561,126 @@ def ensure_quote(server, first_message_id, n_messages):
         return True, None
 
 
-def get_avatar_img(user, store_avatar):
-    avatar_id = str(user.avatar_url).split("/")[-1].split("?")[0]
-    avatar_path = "{}/{}".format(c.PFPS_FOLDER_PATH, avatar_id)
-    if not os.path.exists(avatar_path):
-        try:
-            img_response = requests.get(user.avatar_url)
-        except Exception as e:
-            print("failed to get avatar (id: {}) from link: {}".format(avatar_id, e))
-            return None
-
-        base_avatar_img = Image.open(BytesIO(img_response.content)).convert("RGBA")
-        avatar_img = circular_crop_avatar(base_avatar_img)
-        if store_avatar:
-            try:
-                avatar_img.save(avatar_path)
-            except Exception as e:
-                print("failed to save avatar (id: {}) to file: {}".format(avatar_id, e))
-        return avatar_img
-    else:
-        try:
-            return Image.open(avatar_path)
-        except Exception as e:
-            print("failed to load avatar (id: {}) from file: {}".format(avatar_id, e))
-            return None
-
-
+@lru_cache(maxsize=None)
 def load_fonts():
     return ImageFont.truetype(c.DISCORD_BOLD_FONT, c.AUTHOR_SIZE), ImageFont.truetype(c.DISCORD_NORMAL_FONT, c.TIMESTAMP_SIZE), ImageFont.truetype(c.DISCORD_NORMAL_FONT, c.MESSAGE_SIZE)
 
 
-def get_image(attachment_or_embed):
-    if isinstance(attachment_or_embed, Attachment):
-        if attachment_or_embed.filename.split(".")[-1] in c.SUPPORTED_IMAGE_FILETYPES:
-            file_link = attachment_or_embed.url
-        else:
-            return None
-    elif isinstance(attachment_or_embed, Embed):
-        file_link = attachment_or_embed.thumbnail.url
-    else:
-        return None
+@lru_cache(maxsize=None)
+def load_pfp_mask():
+    return Image.open(c.PFP_MASK_PATH).convert("RGBA")
 
-    headers_response = requests.head(file_link)
-    if int(headers_response.headers.get("content-length", c.MAX_EMBED_FILESIZE + 1)) > c.MAX_EMBED_FILESIZE:
-        return None
 
+def open_image(image_bytes):
+    """Decodes a downloaded attachment or embed and shrinks it to fit in a quote; None if it isn't an image PIL can read"""
     try:
-        img_response = requests.get(file_link)
-    except Exception as e:
-        print("failed to get image from link: {}".format(e))
-        return
-
-    base_img = Image.open(BytesIO(img_response.content)).convert("RGBA")
+        base_img = Image.open(BytesIO(image_bytes)).convert("RGBA")
+    except OSError as e:
+        log.warning("failed to read image: {}".format(e))
+        return None
     base_img.thumbnail(c.MAX_EMBED_DIMENSIONS, Image.ANTIALIAS)
     return base_img
 
 
 def wrap_text(text, font, max_width):
+    """Breaks text into lines no wider than max_width
+
+    Each distinct word is measured once (text_width caches it across quotes), and a line's width is the sum of its words and
+    spaces. That sum can be off by a pixel or so from measuring the whole line when the font kerns across word boundaries, so
+    whenever it lands within c.TEXT_KERNING_SLACK pixels per unmeasured join of max_width, the line is measured for real."""
     sentences = text.split("\n")
     words = []
     for sentence in sentences:
         words.extend(sentence.split(" "))
     lines = []
+    space_width = text_width(font, " ")
 
     current_line = ""
+    current_width = 0
+    unmeasured_joins = 0 # spaces in current_line since its width was last measured as a whole
     for word in words:
-
-        extended = current_line + " " + word if len(current_line) else word
-        if font.getsize(extended)[0] > max_width or len(word) == 0 or word[-1] == "\n": # len(word) == 0 checks for consecutive newlines leaving an empty string in the words list
+        word_width = text_width(font, word)
+        if len(current_line):
+            extended = current_line + " " + word
+            extended_width = current_width + space_width + word_width
+            extended_joins = unmeasured_joins + 1
+        else:
+            extended = word
+            extended_width = word_width
+            extended_joins = 0
+        if extended_joins and abs(extended_width - max_width) <= extended_joins * c.TEXT_KERNING_SLACK: # too close to call from the sum
+            extended_width = font.getsize(extended)[0]
+            extended_joins = 0
+
+        if extended_width > max_width or len(word) == 0: # len(word) == 0 checks for consecutive newlines leaving an empty string in the words list
             if current_line == "":
                 lines.append(" ") # space makes sure the line has normal height, and is drawn properly as an empty line
             else:
                 lines.append(current_line)
 
-            if font.getsize(word)[0] > max_width: # single words that are over the length limit are wrapped on a character-by-character basis
+            if word_width > max_width: # single words that are over the length limit are wrapped on a character-by-character basis
                 word_lines = wrap_word(word, font, max_width)
                 lines.extend(word_lines[:-1])
                 current_line = word_lines[-1] # handles this bullshit: https://imgur.com/lrR1ItN
+                current_width = text_width(font, current_line)
             else:
                 current_line = word
+                current_width = word_width
+            unmeasured_joins = 0
         else:
             current_line = extended
+            current_width = extended_width
+            unmeasured_joins = extended_joins
     lines.append(current_line)
 
     return lines
 
 
 def wrap_word(word, font, max_width):
+    """Breaks a word that's wider than max_width into lines, each as many characters as fit (found by binary search)"""
     lines = []
 
-    current_line = ""
-    for character in word:
-        extended = current_line + character
-        if font.getsize(extended)[0] > max_width:
-            lines.append(current_line)
-            current_line = "{}".format(character) # don't convert it to a char type
-        else:
-            current_line = extended
-    lines.append(current_line)
+    line_start = 0
+    while line_start < len(word):
+        fits, doesnt_fit = line_start, len(word) + 1 # word[line_start:fits] fits, word[line_start:doesnt_fit] doesn't (or is past the end)
+        while doesnt_fit - fits > 1:
+            middle = (fits + doesnt_fit) // 2
+            if font.getsize(word[line_start:middle])[0] > max_width:
+                doesnt_fit = middle
+            else:
+                fits = middle
+        line_end = max(fits, line_start + 1) # a character that's too wide on its own still gets its own line
+        lines.append(word[line_start:line_end])
+        line_start = line_end
+
+    return lines if len(lines) else [""]
+
+
+def text_width(font, text):
+    """font.getsize(text)[0], remembered (least recently used first out); fonts come from load_fonts, so each one is the same object for every quote"""
+    key = (font, text)
+    width = text_widths.get(key)
+    if width is None:
+        width = text_widths[key] = font.getsize(text)[0]
+        if len(text_widths) > c.TEXT_WIDTH_CACHE_SIZE:
+            text_widths.popitem(last=False)
+    else:
+        text_widths.move_to_end(key)
+    return width
 
-    return lines
+
+def crop_avatar(avatar_bytes):
+    """Decodes a downloaded avatar and crops it into a circle, for AvatarCache (in the render pool); None if it isn't an image PIL can read"""
+    try:
+        base_avatar_img = Image.open(BytesIO(avatar_bytes)).convert("RGBA")
+    except OSError as e:
+        log.warning("failed to read avatar: {}".format(e))
+        return None
+    return circular_crop_avatar(base_avatar_img)
 
 
 def circular_crop_avatar(avatar_img):
-    circle_mask = Image.open(c.PFP_MASK_PATH).convert("RGBA")
+    circle_mask = load_pfp_mask()
     if avatar_img.size != circle_mask.size:
         avatar_img = avatar_img.resize(circle_mask.size, Image.ANTIALIAS)
 
@@ -579,31 +690,14 @@ def circular_crop_avatar(avatar_img):
 
 class DiscordImage:
     def __init__(self, attachment_or_embed, message_id):
-        self.image = None
         self.message_id = message_id
+        self.url = None
 
         if isinstance(attachment_or_embed, Attachment):
             if attachment_or_embed.filename.split(".")[-1] in c.SUPPORTED_IMAGE_FILETYPES:
                 self.url = attachment_or_embed.url
         elif isinstance(attachment_or_embed, Embed):
             self.url = attachment_or_embed.thumbnail.url
-        else:
-            self.url = None
-
-    def fetch_image(self):
-        headers_response = requests.head(self.url)
-        if int(headers_response.headers.get("content-length", c.MAX_EMBED_FILESIZE + 1)) > c.MAX_EMBED_FILESIZE:
-            self.image = None
-
-        try:
-            img_response = requests.get(self.url)
-        except Exception as e:
-            print("failed to get image from link: {}".format(e))
-            return
-
-        base_img = Image.open(BytesIO(img_response.content)).convert("RGBA")
-        base_img.thumbnail(c.MAX_EMBED_DIMENSIONS, Image.ANTIALIAS)
-        self.image = base_img
 
 
 quote_module = {
@@ -2,11 +2,12 @@ import constants as c
 import sqlalchemy as db
 
 from asyncio import gather, sleep
+from command_args import Duration, RestOfLine
 from database_utils import Reminder
 from datetime import datetime as dt
 from datetime import timedelta as td
 from dateutil.relativedelta import relativedelta
-from message_utils import send_lines
+from time import perf_counter
 from default_modules.quotes import get_time_text
 
 # Asynchronous (Discord) stuff
@@ -14,35 +15,20 @@ async def remind_me(client, message, command_args, session):
     if message.author.bot:
         return "Robots can't receive reminders!"
 
-    if len(command_args) and command_args[0].lower() == "in":
-        command_args = command_args[1:]
-
-    if len(command_args) < 2:
-        return "Must include a time (8 seconds, 16 hours, 04/17/2020, etc) and a message!"
-
-    try:
-        remind_at, n_time_arguments = parse_time(command_args)
-    except Exception as e:
-        client.bot_log.warning("Failed to parse time in !remindme for user {} (id: {}); error was: {}".format(message.author.name, message.author.id, e))
-        return "{}".format(e)
-
-    remind_message = " ".join(command_args[n_time_arguments:])
-    if remind_message == "":
-        client.bot_log.warning("!remind_me called by user {} (id: {}) without a message".format(message.author.name, message.author.id))
-        return "No message found!"
+    (remind_at, time_args), remind_message = command_args # parsed by REMIND_ME_SCHEMA
 
     return_message = c.DEFAULT_RETURN_MESSAGE
     try:
-        reminders_for_user = session.query(Reminder).filter(Reminder.user_id == message.author.id).all()
+        reminders_for_user = await session.run(session.query(Reminder).filter(Reminder.user_id == message.author.id).all)
         if len(reminders_for_user) > c.MAX_REMINDERS_PER_USER:
             client.bot_log.error("Couldn't set reminder for user {} (id: {}) to fire on {}; user exceeded max reminders\nreminder was:{}".format(message.author.name, message.author.id, remind_at, remind_message))
             return "You're at the maximum number of reminders ({}). Hopefully they aren't too long away!".format(
                 c.MAX_REMINDERS_PER_USER)
         session.add(Reminder(message=remind_message, send_at=remind_at, sent_at=message.created_at, user_id=message.author.id, failures=0))
-        if n_time_arguments == 1:
-            return_message = "Reminder set for {}!".format(command_args[0])
+        if len(time_args) == 1:
+            return_message = "Reminder set for {}!".format(time_args[0])
         else:
-            return_message = "Reminder set for {} from now!".format(" ".join(command_args[:n_time_arguments]))
+            return_message = "Reminder set for {} from now!".format(" ".join(time_args))
         client.bot_log.info("Set reminder for user {} (id: {}) to fire on {}; text: {}".format(message.author.name, message.author.id, remind_at, remind_message))
     except Exception as e:
         client.bot_log.error("Couldn't set reminder for user {} (id: {}) to fire on {}; error was {}\nreminder was:{}".format(message.author.name, message.author.id, remind_at, e, remind_message))
@@ -59,7 +45,7 @@ async def delete_reminder(client, message, command_args, session):
         try:
             reminder_id = int(command_args[0])
 
-            reminder = session.query(Reminder).filter(db.and_(Reminder.user_id == message.author.id, Reminder.id == reminder_id)).first()
+            reminder = await session.run(session.query(Reminder).filter(db.and_(Reminder.user_id == message.author.id, Reminder.id == reminder_id)).first)
             if reminder is not None:
                 session.delete(reminder)
                 return_string = "Reminder with ID {} deleted!\nText was: ".format(reminder_id)
@@ -72,42 +58,41 @@ async def delete_reminder(client, message, command_args, session):
             client.bot_log.info("Failed to delete reminder for user {} (id: {}) with given ID {}; trying substring search...".format(message.author.name, message.author.id, command_args[0]))
 
     search_string = " ".join(command_args)
-    matching_reminders = session.query(Reminder).filter(db.and_(Reminder.user_id == message.author.id, Reminder.message.ilike(search_string))).all()
+    matching_reminders = await session.run(session.query(Reminder).filter(db.and_(Reminder.user_id == message.author.id, Reminder.message.ilike(search_string))).all)
     if len(matching_reminders) == 0:
         client.bot_log.info("No matching reminders found for user {} (id: {}) for search term {}".format(message.author.name, message.author.id, search_string))
         return "No reminders matching that ID or substring found! Try listing your reminders with !reminders and removing by ID."
     elif len(matching_reminders) > 1:
         client.bot_log.info("Couldn't remove reminder for user {} (id: {}); search term {} was ambiguous".format(message.author.name, message.author.id, search_string))
-        message.author.send("Ambiguous search term (found {} matching reminders:)\n".format(len(matching_reminders)))
-        await __list_reminders(message.author, matching_reminders)
+        await __list_reminders(client, message.author, matching_reminders, "Ambiguous search term (found {} matching reminders:)".format(len(matching_reminders)))
     else:
         session.delete(matching_reminders[0])
         client.bot_log.info("Removed reminder for user {} (id: {})".format(message.author.name, message.author.id))
-        await message.author.send("Reminder deleted!")
+        await client.outbound_queue.send(message.author, "Reminder deleted!")
 
 
 async def reminders(client, message, _, session):
-    reminders_for_user = session.query(Reminder).filter(Reminder.user_id == message.author.id).all()
+    reminders_for_user = await session.run(session.query(Reminder).filter(Reminder.user_id == message.author.id).all)
     if len(reminders_for_user) == 0 or reminders_for_user is None:
         return "No reminders found!"
 
-    await message.author.send("{} reminders found:\n".format(len(reminders_for_user)))
     client.bot_log.info("Listing reminders to user {} (id: {})".format(message.author.name, message.author.id))
-    await __list_reminders(message.author, reminders_for_user)
+    await __list_reminders(client, message.author, reminders_for_user, "{} reminders found:".format(len(reminders_for_user)))
 
 
-async def __list_reminders(user, reminder_list):
+async def __list_reminders(client, user, reminder_list, header):
     reminder_strings = ["[ID: {}] [{}] {}".format(reminder.id, reminder.send_at.strftime("%m/%d/%Y %I:%M %p"), reminder.message) for reminder in reminder_list]
-    await send_lines(user, reminder_strings)
+    await client.outbound_queue.send_lines(user, [header, ""] + reminder_strings)
 
 
 async def start_remind_loop(client):
     session = client.db_session_builder()  # might need to initiate a new session every once in a while if old ones time out, but i have no evidence that they do
     while True:
         loop_start_time = dt.now()
+        loop_start_counter = perf_counter()
 
         try:
-            reminders_to_fire = session.query(Reminder).filter(Reminder.send_at <= loop_start_time).all()
+            reminders_to_fire = await session.run(session.query(Reminder).filter(Reminder.send_at <= loop_start_time).all)
         except Exception as e:
             client.bot_log.error("Couldn't check for reminders in database; error was {}".format(e))
             await async_sleep_n_seconds(c.REMINDER_LOOP_TIME_INCREMENT, loop_start_time)
@@ -115,6 +100,9 @@ async def start_remind_loop(client):
         if len(reminders_to_fire) > 0:
             reminder_tasks = [remind_user(client, reminder) for reminder in reminders_to_fire]
             results = await gather(*reminder_tasks)
+            n_sent = len([result for result in results if result[1]])
+            client.metrics.increment("akrasia_reminders_sent_total", n_sent)
+            client.metrics.increment("akrasia_reminders_failed_total", len(results) - n_sent)
 
             reminders_to_remove = []
             reminders_to_delay = []
@@ -127,8 +115,7 @@ async def start_remind_loop(client):
 
             if len(reminders_to_remove):
                 try:
-                    print()
-                    session.query(Reminder).filter(Reminder.id.in_([reminder.id for reminder in reminders_to_remove])).delete(synchronize_session=False)
+                    await session.run(session.query(Reminder).filter(Reminder.id.in_([reminder.id for reminder in reminders_to_remove])).delete, synchronize_session=False)
                 except Exception as e:
                     client.bot_log.error("Failed to delete sent reminders from the database; error was: {}".format(e))
             if len(reminders_to_delay):
@@ -137,8 +124,8 @@ async def start_remind_loop(client):
                     if reminder.failures == c.MAX_REMINDER_FAILURES:
                         client.bot_log.warning("Reminder to user with ID {} failed too main times; deleting it\ntext was: {}".format(reminder.user_id, reminder.message))
                         try:
-                            session.query(Reminder).filter(Reminder.id == reminder.id).delete(
-                                synchronize_session="evaluate")
+                            await session.run(session.query(Reminder).filter(Reminder.id == reminder.id).delete,
+                                              synchronize_session="evaluate")
                         except Exception as e:
                             client.bot_log.error("Failed to delete failed reminders from the database; error was: {}".format(e))
                     else:
@@ -146,11 +133,12 @@ async def start_remind_loop(client):
                         client.bot_log.warning("Reminder to user with ID {} failed (failure count: {}); text was {}".format(reminder.user_id, reminder.failures, reminder.message))
 
             try:
-                session.commit()
+                await session.run(session.commit)
             except Exception as e:
                 client.bot_log.error("Failed to commit reminder session to database; trying to restart session (error was: {})".format(e))
                 session.close()
                 session = client.db_session_builder()
+        client.metrics.observe("akrasia_reminder_loop_duration_seconds", perf_counter() - loop_start_counter)
         await async_sleep_n_seconds(c.REMINDER_LOOP_TIME_INCREMENT, loop_start_time)
 
 
@@ -164,7 +152,7 @@ async def remind_user(client, reminder):
         except:
             reminder_text = "Ugh... when did you send this again?"
 
-        await client.get_user(reminder.user_id).send("{}\n(in response to your reminder set {}{})".format(reminder.message, reminder_text[0:1].lower(), reminder_text[1:]))
+        await client.outbound_queue.send(client.get_user(reminder.user_id), "{}\n(in response to your reminder set {}{})".format(reminder.message, reminder_text[0:1].lower(), reminder_text[1:]))
         client.bot_log.info("Successfully reminded user with ID {} with message: {}".format(reminder.user_id, reminder.message))
         return reminder, True
     except Exception as e:
@@ -244,13 +232,18 @@ async def async_sleep_n_seconds(n, loop_start_time):
     if time_elapsed.total_seconds() < n: # if it's been n seconds already, no need to sleep at all
         await sleep(n - time_elapsed.total_seconds() - (time_elapsed.microseconds/10**6))
 
+REMIND_ME_SCHEMA = [
+    Duration("time", parse_time, prefix="in", error="Must include a time (8 seconds, 16 hours, 04/17/2020, etc) and a message!"),
+    RestOfLine("message", error="No message found!")
+]
+
 reminders_module = {
     "remindme": (remind_me, "**remindme** [timespan] [message]\n"
                             "*remindme [date] [message]*\n"
                             "*Permissions needed: none:*\n"
                             "    Sends the user a DM with a given message on the given date, or after the given time has elapsed.\n"
                             "    `!remindme 30 minutes way to spend 30 minutes` will send the user the message after 30 minutes\n"
-                            "    `!remindme 5/01/2020 iron the gimp` will send the user the message at midnight on October 30th, 2020"),
+                            "    `!remindme 5/01/2020 iron the gimp` will send the user the message at midnight on October 30th, 2020", REMIND_ME_SCHEMA),
     "reminders": (reminders, "**reminders**\n"
                              "*Permissions needed: none*\n"
                              "    DM's the user a list of their current reminders and their IDs\n"
@@ -1,6 +1,7 @@
 import constants as c
 import sqlalchemy as db
 
+from command_args import RestOfLine
 from database_utils import Role, get_or_init_server
 
 async def add_role(client, message, command_args, session):
@@ -12,16 +13,14 @@ async def add_role(client, message, command_args, session):
             message.author.name, message.author.id, command_args, message.guild.name, message.guild.id))
         return "You don't have permissions to edit roles!"
 
-    if command_args is None:
-        return "No role given!"
-    role_name = " ".join(command_args)
+    role_name = command_args[0]
 
     server_roles = [role for role in message.guild.roles if role.name.lower() == role_name.lower()]
     if len(server_roles) != 0:
         client.bot_log.info("Didn't add role {} to server {} (id: {}) because such a role already existed".format(role_name, message.guild.name, message.guild.id))
         return "A role with that name exists on this server!"
 
-    db_role_already_exists = session.query(Role).filter(db.and_(Role.server_id == message.guild.id, Role.name == role_name.lower())).first()
+    db_role_already_exists = await session.run(session.query(Role).filter(db.and_(Role.server_id == message.guild.id, Role.name == role_name.lower())).first)
     if db_role_already_exists is not None:
         client.bot_log.info("Didn't add role {} to server {} (id: {}) because the role was already in the database".format(role_name, message.guild.name, message.guild.id))
         return "That role is already in the database! (you can delete it from both the server and database using !deleterole)"
@@ -32,7 +31,7 @@ async def add_role(client, message, command_args, session):
         client.bot_log.warning("Failed to add role {} (id: {}) to server {} (id: {}); error was {}".format(server_roles[0].name, server_roles[0].id, message.guild.name, message.guild.id, e))
         return "Couldn't add that role (do I need permissions?)"
 
-    server = get_or_init_server(client, message.guild, session)
+    server = await session.run(get_or_init_server, client, message.guild, session)
     session.add(Role(id=new_role.id, name=role_name.lower(), server=server))
     client.bot_log.info("Added role {} (id: {}) to sever {} (id: {})".format(new_role.name, new_role.id, message.guild.name, message.guild.id))
     return "Added role `{}`!".format(role_name)
@@ -46,9 +45,7 @@ async def delete_role(client, message, command_args, session):
         client.bot_log.warning("User {} (id: {}) called !deleterole {} without manage role permissions on server {} (id: {})!".format(message.author.name, message.author.id, command_args, message.guild.name, message.guild.id))
         return "You don't have permissions to edit roles!"
 
-    if command_args is None:
-        return "No role given!"
-    role_name = " ".join(command_args).lower()
+    role_name = command_args[0].lower()
 
     server_roles = [role for role in message.guild.roles if role.name.lower() == role_name]
     if len(server_roles) == 0:
@@ -56,7 +53,7 @@ async def delete_role(client, message, command_args, session):
         return "No role with that name exists on this server!"
     role_to_delete = server_roles[0]
 
-    db_role_to_delete = session.query(Role).filter(db.and_(Role.server_id == message.guild.id, Role.name == role_name)).first()
+    db_role_to_delete = await session.run(session.query(Role).filter(db.and_(Role.server_id == message.guild.id, Role.name == role_name)).first)
     if db_role_to_delete is not None:
         session.delete(db_role_to_delete)
         client.bot_log.info("Deleted role {} from database on server {} (id: {})".format(role_name, message.guild.name, message.guild.id))
@@ -81,10 +78,8 @@ async def unlist_role(client, message, command_args, session):
         client.bot_log.warning("User {} (id: {}) called !unlistrole {} without manage role permissions on server {} (id: {})!".format(message.author.name, message.author.id, command_args, message.guild.name, message.guild.id))
         return "You don't have permissions to edit roles!"
 
-    if command_args is None:
-        return "No role given!"
-    role_name = " ".join(command_args).lower()
-    db_role_to_delete = session.query(Role).filter(db.and_(Role.server_id == message.guild.id, Role.name == role_name)).first()
+    role_name = command_args[0].lower()
+    db_role_to_delete = await session.run(session.query(Role).filter(db.and_(Role.server_id == message.guild.id, Role.name == role_name)).first)
     if db_role_to_delete is not None:
         session.delete(db_role_to_delete)
         client.bot_log.info("Unlisted role {} (id: {}) from sever {} (id: {})".format(db_role_to_delete.name, db_role_to_delete.id, message.guild.name, message.guild.id))
@@ -98,9 +93,7 @@ async def leave_role(client, message, command_args, __):
     if message.guild is None:
         return c.GUILD_REQUIRED_MESSAGE.format(client.command_prefix, "leave", client.command_prefix)
 
-    if command_args is None:
-        return "No role given!"
-    role_name = " ".join(command_args)
+    role_name = command_args[0]
 
     server_roles = [role for role in message.guild.roles if role.name.lower() == role_name.lower()]
     if len(server_roles) == 0:
@@ -124,9 +117,7 @@ async def join_role(client, message, command_args, session):
     if message.guild is None:
         return c.GUILD_REQUIRED_MESSAGE.format(client.command_prefix, "join", client.command_prefix)
 
-    if command_args is None:
-        return "No role given!"
-    role_name = " ".join(command_args).lower()
+    role_name = command_args[0].lower()
 
     server_roles = [role for role in message.guild.roles if role.name.lower() == role_name]
     if len(server_roles) == 0:
@@ -136,7 +127,7 @@ async def join_role(client, message, command_args, session):
     if len(user_roles) > 0:
         return "You already have that role!"
 
-    role_in_server = session.query(Role).filter(db.and_(Role.server_id == message.guild.id, Role.name == role_name)).first()
+    role_in_server = await session.run(session.query(Role).filter(db.and_(Role.server_id == message.guild.id, Role.name == role_name)).first)
     if role_in_server is None:
         client.bot_log.error("Failed to add role {} (id: {}) to user {} (id: {}) in server {} (id: {}); role was not bot-addable.".format(server_roles[0].name, server_roles[0].id, message.author.name, message.author.id, message.guild.name, message.guild.id))
         return "That role is not !join-able."
@@ -155,16 +146,14 @@ async def list_role(client, message, command_args, session):
     if message.guild is None:
         return c.GUILD_REQUIRED_MESSAGE.format(client.command_prefix, "listrole", client.command_prefix)
 
-    if command_args is None:
-        return "No role given!"
-    role_name = " ".join(command_args).lower()
+    role_name = command_args[0].lower()
 
     server_roles = [role for role in message.guild.roles if role.name.lower() == role_name]
     if len(server_roles) == 0:
         return "No such role exists on this server!"
     role = server_roles[0]
 
-    role_in_server = session.query(Role).filter(db.and_(Role.server_id == message.guild.id, Role.name == role_name)).first()
+    role_in_server = await session.run(session.query(Role).filter(db.and_(Role.server_id == message.guild.id, Role.name == role_name)).first)
     if role_in_server is None:
         client.bot_log.error("Failed to list role {} (id: {}) in server {} (id: {}); role was not bot-addable.".format(server_roles[0].name, server_roles[0].id, message.author.name, message.author.id, message.guild.name, message.guild.id))
         return "That role is not !join-able, and thus cannot be listed."
@@ -178,29 +167,31 @@ async def list_role(client, message, command_args, session):
     return "Members of {}:\n{}".format(role.name, ", ".join(members_list))
 
 
+ROLE_NAME_SCHEMA = [RestOfLine("role name", error="No role given!")]
+
 roles_module = {
     "addrole": (add_role, "**addrole** *[role name]*\n"
                           "*Permissions needed: manage roles*\n"
                           "    Adds the given role to the server, and allows users to join it using !join.\n"
-                          "    `!addrole goon platoon` adds the role \"goon platoon\" to the server."),
+                          "    `!addrole goon platoon` adds the role \"goon platoon\" to the server.", ROLE_NAME_SCHEMA),
     "deleterole": (delete_role, "**deleterole** *[role name]*\n"
                                 "*Permissions needed: manage roles*\n"
                                 "    Deletes the given role from the server.\n"
-                                "    `!deleterole goon platoon` deletes the role \"goon platoon\" from the server."),
+                                "    `!deleterole goon platoon` deletes the role \"goon platoon\" from the server.", ROLE_NAME_SCHEMA),
     "unlistrole": (unlist_role, "**unlistrole** *[role name]*\n"
                                 "*Permissions needed: manage roles*\n"
                                 "    Stops users from joining the role with !join, but leaves the role intact.\n"
-                                "    `!unlist role goon platoon` prevents users from joining \"goon platoon\" via !join."),
+                                "    `!unlist role goon platoon` prevents users from joining \"goon platoon\" via !join.", ROLE_NAME_SCHEMA),
     "join": (join_role, "**join** *[role name]*\n"
                         "*Permissions needed: none*\n"
                         "    Joins the given role, if it's been added with !addrole.\n"
-                        "    `!join goon platoon` joins the role \"goon platoon\""),
+                        "    `!join goon platoon` joins the role \"goon platoon\"", ROLE_NAME_SCHEMA),
     "leave": (leave_role, "**leave** *[role name]*\n"
                           "*Permissions needed: none*\n"
                           "    Leaves the given role.\n"
-                          "    `!leave goon platoon` leaves the role \"goon platoon\""),
+                          "    `!leave goon platoon` leaves the role \"goon platoon\"", ROLE_NAME_SCHEMA),
     "listrole": (list_role, "**listrole** *[role name]*\n"
                             "*Permissions needed: none*\n"
                             "    Lists all users with a given role, if that role is !join-able.\n"
-                            "    `!list goon platoon` lists all players with the role \"goon platoon\"")
+                            "    `!list goon platoon` lists all players with the role \"goon platoon\"", ROLE_NAME_SCHEMA)
 }
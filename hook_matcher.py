@@ -0,0 +1,136 @@
+import re
+
+HOOK_GROUP_PREFIX = "_hook"
+UNCOMBINABLE_PATTERN = re.compile(r"\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)") # numbered/named backreferences and conditionals break once the pattern is wrapped in another group, and global inline flags would apply to every other hook in it
+REGEX_METACHARACTERS = set(".^$*+?{}[]|()\\")
+OPTIONAL_QUANTIFIERS = set("?*{") # quantifiers that can make the character before them disappear
+MENTION_CHARACTERS = ("<", "@") # clean_content only ever rewrites text starting at one of these
+
+
+class HookMatcher:
+    def __init__(self, hooks_dict):
+        self.hooks_dict = hooks_dict
+        self.segments = []
+        self.prefixes = None # None means some hook has no required prefix, so nothing can be filtered out
+        self.max_prefix_length = 0
+        self.prefilter_passed = 0
+        self.prefilter_rejected = 0
+        self.rebuild()
+
+    def rebuild(self): # call this if hooks_dict is changed after the matcher was made
+        self.segments = []
+        pending_patterns = [] # (group name, hook regex) pairs waiting to be compiled into one alternation
+        group_names = {}
+
+        for index, hook_regex in enumerate(self.hooks_dict):
+            group_name = "{}{}".format(HOOK_GROUP_PREFIX, index)
+            if UNCOMBINABLE_PATTERN.search(hook_regex) or not self.__compiles([(group_name, hook_regex)]): # the pattern has to be run on its own (if it's just broken, re.compile raises here instead of on every message)
+                self.__flush(pending_patterns, group_names)
+                pending_patterns = []
+                self.segments.append((re.compile(hook_regex), hook_regex, None))
+                continue
+
+            pending_patterns.append((group_name, hook_regex))
+            group_names[group_name] = hook_regex
+        self.__flush(pending_patterns, group_names)
+
+        prefixes = [self.literal_prefix(hook_regex) for hook_regex in self.hooks_dict]
+        if len(prefixes) == 0 or "" in prefixes:
+            self.prefixes = None
+            self.max_prefix_length = 0
+        else:
+            self.prefixes = tuple(set(prefixes))
+            self.max_prefix_length = max([len(prefix) for prefix in self.prefixes])
+
+    def could_match(self, raw_content):
+        """Cheap check against the raw message.content; False means no hook can match its clean_content, so it needn't be computed"""
+        if not raw_content or len(self.segments) == 0:
+            self.prefilter_rejected += 1
+            return False
+        if self.prefixes is None:
+            self.prefilter_passed += 1
+            return True
+
+        head = raw_content[:self.max_prefix_length].lower() # the prefixes are pure ASCII, so lowering a slice gives the same answer as slicing the lowered string
+        if head.startswith(self.prefixes):
+            self.prefilter_passed += 1
+            return True
+
+        mention_start = min([head.find(character) for character in MENTION_CHARACTERS if character in head], default=-1)
+        if mention_start != -1: # everything past a mention might be rewritten by clean_content, so only the text before it has to agree with a prefix
+            untouched_head = head[:mention_start]
+            if any([prefix.startswith(untouched_head) for prefix in self.prefixes]):
+                self.prefilter_passed += 1
+                return True
+
+        self.prefilter_rejected += 1
+        return False
+
+    @property
+    def prefilter_hit_rate(self):
+        total_checks = self.prefilter_passed + self.prefilter_rejected
+        return self.prefilter_passed / total_checks if total_checks else 0
+
+    @staticmethod
+    def literal_prefix(hook_regex):
+        """Returns the lowercase ASCII literal that every match of hook_regex has to start with ("" if there isn't one)"""
+        if "|" in hook_regex: # a top-level alternation would make any prefix optional; not worth parsing out whether it's nested
+            return ""
+
+        prefix = []
+        index = 1 if hook_regex.startswith("^") else 0 # hooks are already anchored to the start of the message
+        while index < len(hook_regex):
+            character = hook_regex[index]
+            next_index = index + 1
+            if character == "\\":
+                if next_index >= len(hook_regex) or hook_regex[next_index].isalnum(): # \d, \w, \b etc. aren't literals
+                    break
+                character = hook_regex[next_index]
+                next_index += 1
+            elif character in REGEX_METACHARACTERS:
+                break
+
+            if ord(character) > 127: # case folding gets weird outside of ASCII, so stop while we're sure
+                break
+            if next_index < len(hook_regex) and hook_regex[next_index] in OPTIONAL_QUANTIFIERS:
+                break
+            prefix.append(character.lower())
+            if next_index < len(hook_regex) and hook_regex[next_index] == "+": # at least one copy is still guaranteed, but nothing after it is in a fixed place
+                break
+            index = next_index
+
+        return "".join(prefix)
+
+    def match(self, content):
+        """Returns the regex of the first hook (in registration order) that matches the start of content, or None"""
+        for compiled_pattern, hook_regex, group_names in self.segments: # segments are in registration order, so first-match-wins still holds
+            hook_match = compiled_pattern.match(content)
+            if hook_match is not None:
+                if group_names is None: # a lone, uncombined hook
+                    return hook_regex
+                return group_names[hook_match.lastgroup] # the wrapping group always closes last, so it's always lastgroup
+        return None
+
+    def __flush(self, pending_patterns, group_names):
+        if len(pending_patterns) == 0:
+            return
+        try:
+            compiled_pattern = self.__combine(pending_patterns)
+        except re.error: # every hook compiles on its own, so it's a clash between them (e.g. reused group names); split until the halves compile
+            middle = len(pending_patterns) // 2
+            self.__flush(pending_patterns[:middle], group_names)
+            self.__flush(pending_patterns[middle:], group_names)
+            return
+        self.segments.append((compiled_pattern, None, {name: group_names[name] for name, _ in pending_patterns}))
+
+    @staticmethod
+    def __combine(patterns):
+        return re.compile("|".join(["(?P<{}>{})".format(group_name, hook_regex) for group_name, hook_regex in patterns]))
+
+    @staticmethod
+    def __compiles(patterns):
+        try:
+            HookMatcher.__combine(patterns)
+            return True
+        except re.error:
+            return False
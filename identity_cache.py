@@ -0,0 +1,123 @@
+import constants as c
+
+from collections import OrderedDict
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from threading import Lock
+
+PENDING_ROW_CHANGES_KEY = "pending_identity_cache_changes"
+
+
+class IdentityCache:
+    """Process-wide LRU cache of rows (users and servers) that get looked up by primary key on nearly every command
+
+    Rows are kept as plain column values, not ORM objects, so they're never tied to a session. get() hands back a fresh
+    object attached to the caller's session without a SELECT. Changes are written through when the session that made them
+    commits (the same way AliasCache handles aliases), so a rolled back change never reaches the cache."""
+    def __init__(self, models, max_size=c.IDENTITY_CACHE_SIZE):
+        self.models = tuple(models)
+        self.max_size = max_size # 0 turns the cache off
+        self.rows = OrderedDict() # (model, primary key) -> {column: value}, least recently used first
+        self.lock = Lock() # sessions can flush on either the database thread or the event loop
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def listen_to(self, session_builder):
+        event.listen(session_builder, "after_flush", self.__stage_changes)
+        event.listen(session_builder, "after_commit", self.__apply_pending_changes)
+        event.listen(session_builder, "after_soft_rollback", self.__discard_pending_changes)
+
+    def get(self, model, row_id, session):
+        """Returns the row as an object in session (None if it isn't cached), or the session's own copy if it already has one"""
+        in_session = session.identity_map.get(identity_key(model, row_id))
+        if in_session is not None: # don't clobber changes the session hasn't flushed yet
+            return in_session
+
+        with self.lock:
+            values = self.rows.get((model, row_id))
+            if values is None:
+                self.misses += 1
+                return None
+            self.rows.move_to_end((model, row_id))
+            self.hits += 1
+
+        instance = model(**values)
+        make_transient_to_detached(instance) # i.e. "this row already exists", so adding it doesn't INSERT
+        session.add(instance)
+        return instance
+
+    def put(self, instance):
+        """Caches a row that was just loaded from the database"""
+        values = self.__column_values(instance)
+        if values is not None:
+            self.__store(type(instance), values)
+
+    def update_rows(self, model, rows):
+        """Writes through changes made without the ORM (e.g. bulk_update_mappings); rows are dicts that include the primary key"""
+        primary_key = inspect(model).primary_key[0].key
+        with self.lock:
+            for row in rows:
+                values = self.rows.get((model, row[primary_key]))
+                if values is not None:
+                    values.update(row)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.rows),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else None
+        }
+
+    def __store(self, model, values):
+        if self.max_size <= 0:
+            return
+        primary_key = inspect(model).primary_key[0].key
+        with self.lock:
+            self.rows[(model, values[primary_key])] = values
+            self.rows.move_to_end((model, values[primary_key]))
+            while len(self.rows) > self.max_size:
+                self.rows.popitem(last=False)
+                self.evictions += 1
+
+    def __evict(self, model, row_id):
+        with self.lock:
+            self.rows.pop((model, row_id), None)
+
+    @staticmethod
+    def __column_values(instance, inserted=False):
+        state = inspect(instance)
+        values = {}
+        for column in state.mapper.column_attrs:
+            if column.key in state.dict:
+                values[column.key] = state.dict[column.key]
+            elif inserted and column.columns[0].server_default is None: # never set on a row we just inserted, so it's NULL
+                values[column.key] = None
+            else: # expired or never loaded, so we don't actually know it
+                return None
+        return values
+
+    def __stage_changes(self, session, _):
+        pending_changes = session.info.setdefault(PENDING_ROW_CHANGES_KEY, [])
+        inserted = set(session.new)
+        deleted = set(session.deleted)
+        for instance in list(inserted) + list(session.dirty) + list(deleted):
+            if isinstance(instance, self.models): # new rows don't have an identity yet at this point, so go by their primary key
+                row_id = inspect(instance).mapper.primary_key_from_instance(instance)[0]
+                pending_changes.append((type(instance), row_id, None if instance in deleted else self.__column_values(instance, instance in inserted)))
+
+    def __apply_pending_changes(self, session):
+        for model, row_id, values in session.info.pop(PENDING_ROW_CHANGES_KEY, []):
+            if values is not None:
+                self.__store(model, values)
+            else: # deleted, or changed in a way we couldn't snapshot
+                self.__evict(model, row_id)
+
+    @staticmethod
+    def __discard_pending_changes(session, _):
+        session.info.pop(PENDING_ROW_CHANGES_KEY, None)
@@ -0,0 +1,71 @@
+import constants as c
+import logging
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+from asyncio import Semaphore, TimeoutError, gather
+from time import perf_counter
+
+
+class ImageFetcher:
+    """Downloads images (quote attachments, avatars) over one pooled aiohttp session, without blocking the event loop
+
+    At most max_concurrent downloads run at once, across every command. Bodies are streamed and abandoned as soon as they go
+    past the caller's byte cap, so there's no separate HEAD request to check the size first (and a missing or wrong
+    Content-Length can't let a huge file through)."""
+    def __init__(self, metrics=None, max_concurrent=c.IMAGE_FETCH_MAX_CONCURRENT, timeout=c.IMAGE_FETCH_TIMEOUT):
+        self.metrics = metrics # fetch latencies and failures are recorded here, if given
+        self.max_concurrent = max_concurrent
+        self.timeout = ClientTimeout(total=timeout)
+        self.log = logging.getLogger(__name__)
+        self.session = None # made on first use, so it's created inside the running event loop
+        self.semaphore = None
+        self.n_fetched = 0
+        self.n_failed = 0
+
+    async def fetch(self, url, max_bytes):
+        """Returns the body at url as bytes, or None if it couldn't be fetched, wasn't a 200, or was over max_bytes"""
+        if not url: # None, or discord.Embed.Empty
+            return None
+        if self.session is None:
+            self.session = ClientSession(connector=TCPConnector(limit=self.max_concurrent), timeout=self.timeout)
+            self.semaphore = Semaphore(self.max_concurrent)
+
+        start_time = perf_counter()
+        async with self.semaphore:
+            try:
+                async with self.session.get(str(url)) as response:
+                    if response.status != 200:
+                        return self.__fail(url, "status {}".format(response.status), response.status)
+                    if response.content_length is not None and response.content_length > max_bytes:
+                        return self.__fail(url, "{} bytes is over the limit of {}".format(response.content_length, max_bytes), "too_large")
+
+                    body = bytearray()
+                    async for chunk in response.content.iter_chunked(c.IMAGE_FETCH_CHUNK_SIZE):
+                        body += chunk
+                        if len(body) > max_bytes:
+                            return self.__fail(url, "body is over the limit of {} bytes".format(max_bytes), "too_large")
+            except TimeoutError:
+                return self.__fail(url, "timed out", "timeout")
+            except (ClientError, ValueError) as e: # ValueError: not a URL aiohttp can request
+                return self.__fail(url, e, "error")
+
+        self.n_fetched += 1
+        if self.metrics is not None:
+            self.metrics.observe("akrasia_image_fetch_duration_seconds", perf_counter() - start_time)
+        return bytes(body)
+
+    async def fetch_all(self, urls, max_bytes):
+        """fetch() for every url at once; returns their bodies (or None) in the same order"""
+        return await gather(*[self.fetch(url, max_bytes) for url in urls])
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def __fail(self, url, reason, kind):
+        self.log.info("failed to fetch image at {}: {}".format(url, reason))
+        self.n_failed += 1
+        if self.metrics is not None:
+            self.metrics.increment("akrasia_image_fetch_errors_total", reason=kind)
+        return None
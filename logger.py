@@ -1,12 +1,96 @@
-from database_utils import AuditLogEntry, get_or_init_user
+import constants as c
+
+from asyncio import Queue, TimeoutError, ensure_future, get_event_loop, wait_for
+from database_utils import AuditLogEntry
+
 
 class Logger: # kept as class for backwards compatability
+    """Buffers audit log entries and writes them in batches from a background task
+
+    Entries are inserted on their own connection (not the command's session), so they survive the command being rolled back."""
     def __init__(self):
-        pass
+        self.client = None
+        self.queue = None
+        self.flush_task = None
+
+    def start(self, client):
+        self.client = client
+        self.queue = Queue(maxsize=c.AUDIT_LOG_MAX_QUEUED_ENTRIES)
+        self.flush_task = ensure_future(self.flush_loop())
+
+    async def log(self, client, message, _):
+        entry = {
+            "message_id": message.id,
+            "user_id": message.author.id,
+            "guild_id": message.guild.id if message.guild is not None else message.author.id,
+            "message_content": "[{}] {} (id: {}) | {}".format(message.created_at.strftime("%m/%d/%Y %I:%M:%S %p"), message.author.name, message.author.id, message.content),
+            "timestamp": message.created_at
+        }
+
+        if self.queue is None: # not started (e.g. the bot isn't actually running), so there's nothing to flush a buffer
+            await client.database_executor.run(self.write_entries, client, [entry])
+        else:
+            await self.queue.put(entry) # if the writer's fallen too far behind, this makes the command (not the event loop) wait for it
+
+    async def flush_loop(self):
+        loop = get_event_loop()
+        stopping = False
+        while not stopping:
+            entry = await self.queue.get()
+            if entry is None: # close() was called
+                break
+
+            entries = [entry]
+            flush_at = loop.time() + c.LOG_SLEEP_TIME["audit"]
+            while len(entries) < c.AUDIT_LOG_BATCH_SIZE:
+                time_left = flush_at - loop.time()
+                if time_left <= 0:
+                    break
+                try:
+                    entry = await wait_for(self.queue.get(), time_left)
+                except TimeoutError:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                entries.append(entry)
+
+            await self.client.database_executor.run(self.write_entries, self.client, entries)
+
+    async def flush(self):
+        """Writes everything currently in the queue right away (anything the flush loop has already picked up follows shortly)"""
+        if self.queue is None:
+            return
+        entries = []
+        while not self.queue.empty() and len(entries) < c.AUDIT_LOG_MAX_QUEUED_ENTRIES:
+            entry = self.queue.get_nowait()
+            if entry is None: # close() is waiting on the flush loop to see this
+                self.queue.put_nowait(entry)
+                break
+            entries.append(entry)
+        if len(entries):
+            await self.client.database_executor.run(self.write_entries, self.client, entries)
+
+    async def close(self):
+        if self.flush_task is None:
+            return
+        await self.queue.put(None) # goes behind everything that's already queued, so all of it gets written first
+        await self.flush_task
+        self.flush_task = None
+        self.queue = None
 
     @staticmethod
-    def log(client, message, session):
-        user = get_or_init_user(client, message, session)
-        message_content = "[{}] {} (id: {}) | {}".format(message.created_at.strftime("%m/%d/%Y %I:%M:%S %p"), message.author.name, message.author.id, message.content)
-        session.add(AuditLogEntry(message_id=message.id, user=user, guild_id=message.guild.id if message.guild is not None else user.id, message_content=message_content, timestamp=message.created_at))
-        session.commit() # have to commit here; otherwise, errors would cause this log entry to be rolled back in handle_command, which is the opposite of what we want
+    def write_entries(client, entries):
+        try:
+            with client.db_engine.begin() as connection:
+                connection.execute(AuditLogEntry.__table__.insert(), entries)
+            return
+        except Exception as e:
+            client.bot_log.error("Failed to write batch of {} audit log entries; retrying them one at a time (error was: {})".format(len(entries), e))
+
+        for entry in entries: # one bad entry (e.g. a duplicate message ID) shouldn't lose the whole batch
+            try:
+                with client.db_engine.begin() as connection:
+                    connection.execute(AuditLogEntry.__table__.insert(), entry)
+            except Exception as e:
+                client.bot_log.error("Failed to write audit log entry for message {}; error was: {}".format(entry["message_id"], e))
@@ -0,0 +1,131 @@
+import constants as c
+import os
+import sys
+import traceback
+
+from asyncio import current_task, get_event_loop
+from threading import Event, Lock, Thread, get_ident
+from time import perf_counter
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class LoopLagMonitor:
+    """Watches for anything that blocks the event loop (synchronous HTTP, image rendering, database calls made directly...)
+
+    A watchdog thread keeps asking the loop to run a trivial callback and times how long it takes to get to it. If the loop
+    hasn't gotten to it within threshold seconds, something is blocking it right now, so the thread grabs the loop thread's
+    stack on the spot and notes which command or hook was running (handle_command/handle_hook label their tasks). Once the
+    loop catches up, the stall is added to a running tally of offenders, keyed by that label and the innermost line of our
+    own code in the stack, so the worst blockers can be ranked by the total time they've cost."""
+    def __init__(self, client, threshold=c.LOOP_LAG_THRESHOLD, interval=c.LOOP_LAG_CHECK_INTERVAL, max_offenders=c.LOOP_LAG_MAX_OFFENDERS):
+        self.client = client
+        self.threshold = threshold # seconds; 0 turns the monitor off
+        self.interval = interval # seconds between checks
+        self.max_offenders = max_offenders
+        self.task_labels = {} # task -> what it's running, e.g. "command quote"
+        self.offenders = {} # (label, blocking line) -> [stalls, total lag, worst lag, stack of the worst stall]
+        self.lock = Lock() # offenders is written by the watchdog thread and read by !stats
+        self.loop = None
+        self.loop_thread_id = None
+        self.thread = None
+        self.stopped = Event()
+        self.n_stalls = 0
+        self.worst_lag = 0
+
+    async def start(self):
+        if self.threshold <= 0 or self.thread is not None:
+            return
+        self.loop = get_event_loop()
+        self.loop_thread_id = get_ident()
+        self.thread = Thread(target=self.__watch, name="akrasia-loop-monitor", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def label_task(self, label):
+        """Attributes any stall that happens while the current task is running to label"""
+        task = current_task()
+        if task is not None:
+            self.task_labels[task] = label
+
+    def unlabel_task(self):
+        task = current_task()
+        if task is not None:
+            self.task_labels.pop(task, None)
+
+    def worst_offenders(self, n=c.LOOP_LAG_REPORT_SIZE):
+        """Returns [(label, blocking line, stalls, total lag, worst lag, stack)], the most total lag first"""
+        with self.lock:
+            offenders = [(label, blocking_line, stalls, total_lag, worst_lag, stack) for (label, blocking_line), (stalls, total_lag, worst_lag, stack) in self.offenders.items()]
+        offenders.sort(key=lambda offender: offender[3], reverse=True)
+        return offenders[:n]
+
+    def report(self, n=c.LOOP_LAG_REPORT_SIZE):
+        if self.threshold <= 0:
+            return "The event loop lag monitor is turned off."
+
+        lines = ["{} event loop stalls over {:.0f}ms since startup (worst: {:.0f}ms)".format(self.n_stalls, self.threshold * 1000, self.worst_lag * 1000)]
+        for rank, (label, blocking_line, stalls, total_lag, worst_lag, _) in enumerate(self.worst_offenders(n), 1):
+            lines.append("{}. {} at {}: {} stalls, {:.2f}s total, worst {:.0f}ms".format(rank, label, blocking_line, stalls, total_lag, worst_lag * 1000))
+        return "\n".join(lines)
+
+    def __watch(self):
+        loop_answered = Event()
+        while not self.stopped.wait(self.interval):
+            loop_answered.clear()
+            asked_at = perf_counter()
+            try:
+                self.loop.call_soon_threadsafe(loop_answered.set)
+            except RuntimeError: # the loop's been closed
+                return
+
+            stall = None
+            if not loop_answered.wait(self.threshold): # still blocked, so whatever's on the loop thread's stack is the culprit
+                stall = self.__capture()
+                while not loop_answered.wait(self.interval):
+                    if self.stopped.is_set():
+                        return
+            lag = perf_counter() - asked_at
+
+            self.client.metrics.observe("akrasia_event_loop_lag_seconds", lag)
+            if stall is not None:
+                self.__record(stall, lag)
+
+    def __capture(self):
+        task = current_task(self.loop)
+        if task is None:
+            label = "no task (a callback)"
+        else:
+            label = self.task_labels.get(task)
+            if label is None:
+                label = "task {}".format(getattr(task.get_coro(), "__qualname__", task.get_name()))
+
+        frame = sys._current_frames().get(self.loop_thread_id)
+        stack = traceback.extract_stack(frame) if frame is not None else []
+        own_frames = [stack_frame for stack_frame in stack if stack_frame.filename.startswith(SOURCE_DIR) and "site-packages" not in stack_frame.filename]
+        blocking_frame = own_frames[-1] if len(own_frames) > 0 else (stack[-1] if len(stack) > 0 else None)
+        blocking_line = "{}:{} in {}".format(os.path.relpath(blocking_frame.filename, SOURCE_DIR), blocking_frame.lineno, blocking_frame.name) if blocking_frame is not None else "unknown"
+        return label, blocking_line, "".join(traceback.format_list(stack[-c.LOOP_LAG_STACK_DEPTH:]))
+
+    def __record(self, stall, lag):
+        label, blocking_line, stack = stall
+        with self.lock:
+            self.n_stalls += 1
+            self.worst_lag = max(self.worst_lag, lag)
+            offender = self.offenders.get((label, blocking_line))
+            if offender is None:
+                if len(self.offenders) >= self.max_offenders: # make room by forgetting whichever has cost the least so far
+                    del self.offenders[min(self.offenders, key=lambda key: self.offenders[key][1])]
+                offender = self.offenders[(label, blocking_line)] = [0, 0, 0, stack]
+                self.client.bot_log.warning("Event loop blocked for {:.0f}ms by {} at {}; stack was:\n{}".format(lag * 1000, label, blocking_line, stack))
+            offender[0] += 1
+            offender[1] += lag
+            if lag > offender[2]:
+                offender[2] = lag
+                offender[3] = stack
+        self.client.metrics.increment("akrasia_event_loop_stalls_total", culprit=label)
@@ -1,55 +1,80 @@
 import constants as c
 import pytz
 
-from asyncio import sleep
-from discord import Member, Message, User
+from discord import Message
+from discord.utils import CachedSlotProperty
+
+MESSAGE_PROPERTIES = {name: descriptor for message_class in reversed(Message.__mro__) for name, descriptor in vars(message_class).items() if isinstance(descriptor, (property, CachedSlotProperty))}
+
+
+class MessageWrapper:
+    """Stands in for a DM's discord.Message with guild and author swapped for the user's home guild and their member object there
+
+    Nothing is copied: every other attribute is looked up on the wrapped message when it's asked for. Message's properties
+    (clean_content, jump_url, etc) are evaluated against the wrapper instead, so they see the swapped guild and author;
+    the cached ones are cached on the wrapper, never written onto the wrapped message."""
+    __slots__ = ("wrapped_message", "guild", "author", "cached_properties")
 
-class MessageWrapper(Message):
     def __init__(self, message, guild, author):
-        for property_name in [prop for prop in message.__slots__ if "cs" not in prop]: # avert your eyes | "cs" props are avoided because those are functions in disguise
-            try:
-                property_value = getattr(message, property_name)
-                if not callable(property_value):
-                    self.__setattr__(property_name, property_value)
-            except AttributeError: # the fact that this can happen is a vesuvian travesty
-                self.__setattr__(property_name, None)
-        self.guild = guild # overwrite the existing function and make this writable, so we can set it to the user's chosen home guild
-        self.author = author # so we can change the User object that's the author of a DM message to a Member object of the home guild
-
-
-async def send_lines(recipient, lines, code_mode=False):
-    if type(recipient) is User or type(recipient) is Member:
-        if recipient.bot: # can't DM bots
-            return
+        self.wrapped_message = message
+        self.guild = guild
+        self.author = author
+        self.cached_properties = None # made on first use, since most commands never touch a cached property
+
+    def __getattr__(self, name): # only called for names that aren't in __slots__
+        descriptor = MESSAGE_PROPERTIES.get(name)
+        if descriptor is None:
+            return getattr(self.wrapped_message, name)
+        if isinstance(descriptor, property):
+            return descriptor.fget(self)
+
+        if self.cached_properties is None:
+            self.cached_properties = {}
+        if name not in self.cached_properties:
+            self.cached_properties[name] = descriptor.function(self)
+        return self.cached_properties[name]
+
+    def __eq__(self, other):
+        return self.wrapped_message == getattr(other, "wrapped_message", other)
 
+    def __hash__(self):
+        return hash(self.wrapped_message)
+
+    def __repr__(self):
+        return "<MessageWrapper guild={!r} author={!r} message={!r}>".format(self.guild, self.author, self.wrapped_message)
+
+
+def split_lines(lines, code_mode=False):
+    """Packs lines into as few messages as fit under Discord's length limit, truncating any line that's too long on its own"""
     if code_mode:
         send_string = "```"
     else:
         send_string = ""
 
+    max_chars = c.MAX_CHARS_PER_MESSAGE
+    if code_mode:
+        max_chars -= 3 # make room for the ending ```
+
+    messages = []
     for line in lines:
         if len(line) > c.TRUNCATED_MESSAGE_LENGTH:
             new_line = line[:c.TRUNCATED_MESSAGE_LENGTH] + c.MESSAGE_TRUNCATOR
         else:
             new_line = line
 
-        max_chars = c.MAX_CHARS_PER_MESSAGE
-        if code_mode:
-            max_chars -= 3 # make room for the ending ```
-
         if len(send_string) + len(new_line) > max_chars:
             if code_mode:
                 send_string += "```"
 
-            await recipient.send(send_string)
+            messages.append(send_string)
             send_string = new_line + "\n"
-            await sleep(c.SEND_CYCLE_WAIT_TIME)
         else:
             send_string += new_line + "\n"
 
     if code_mode:
         send_string += "```"
-    await recipient.send(send_string)
+    messages.append(send_string)
+    return messages
 
 
 def get_time_text(datetime, now):
@@ -0,0 +1,275 @@
+import constants as c
+import time
+
+from aiohttp import web
+from bisect import bisect_left
+from sqlalchemy import event
+from threading import Lock
+
+STATEMENT_START_TIMES_KEY = "metrics_statement_start_times"
+
+METRIC_DESCRIPTIONS = { # name -> (type, help), for everything recorded through Metrics
+    "akrasia_command_duration_seconds": ("histogram", "Time from a command being picked up to its reply being sent"),
+    "akrasia_command_handler_duration_seconds": ("histogram", "Time spent in a command's own function"),
+    "akrasia_command_db_statements": ("histogram", "SQL statements run per command"),
+    "akrasia_command_errors_total": ("counter", "Commands that failed with an error"),
+    "akrasia_hook_duration_seconds": ("histogram", "Time to handle a hook"),
+    "akrasia_hook_errors_total": ("counter", "Hooks that failed with an error"),
+    "akrasia_event_loop_lag_seconds": ("histogram", "Time the event loop took to get to a callback scheduled from another thread"),
+    "akrasia_event_loop_stalls_total": ("counter", "Times the event loop was blocked past the lag threshold, by the command, hook or task blocking it"),
+    "akrasia_db_statement_duration_seconds": ("histogram", "Time to execute one SQL statement, by kind"),
+    "akrasia_outbound_send_duration_seconds": ("histogram", "Time to send one message, including rate limit retries"),
+    "akrasia_outbound_errors_total": ("counter", "Messages that couldn't be sent, by HTTP status"),
+    "akrasia_image_fetch_duration_seconds": ("histogram", "Time to download one image for a quote"),
+    "akrasia_image_fetch_errors_total": ("counter", "Image downloads that failed or were over their size limit, by reason"),
+    "akrasia_render_duration_seconds": ("histogram", "Time to render one quote image, including time waiting for a worker"),
+    "akrasia_reminder_loop_duration_seconds": ("histogram", "Time taken by one pass of the reminder loop"),
+    "akrasia_reminders_sent_total": ("counter", "Reminders delivered"),
+    "akrasia_reminders_failed_total": ("counter", "Reminder deliveries that failed")
+}
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets # upper bounds, ascending; there's always an implicit +Inf bucket at the end
+        self.counts = [0] * (len(buckets) + 1) # per bucket, not cumulative
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimates the q-th quantile by interpolating inside the bucket it falls in, the way Prometheus' histogram_quantile does"""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count > 0:
+                if i == len(self.buckets): # in the +Inf bucket; the best we can say is "more than the largest bound"
+                    return self.buckets[-1]
+                lower_bound = self.buckets[i - 1] if i > 0 else 0
+                return lower_bound + (self.buckets[i] - lower_bound) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+class Metrics:
+    """Latency histograms and error counters for commands, hooks, SQL statements, outbound sends and the reminder loop
+
+    Everything is kept in memory and read out by !stats or, in Prometheus' text format, by the local HTTP endpoint started
+    with serve(). The scheduler's, caches' and outbound queue's own counters are read when the metrics are rendered instead
+    of being copied in as they change. SQL statements run on the database thread, so recording is guarded by a lock."""
+    def __init__(self, client):
+        self.client = client
+        self.histograms = {} # (name, labels) -> Histogram; labels are a tuple of (label, value) pairs
+        self.counters = {} # (name, labels) -> count
+        self.lock = Lock()
+        self.started_at = time.time()
+        self.runner = None # the HTTP endpoint's, once it's started
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(c.METRICS_STATEMENT_COUNT_BUCKETS if name == "akrasia_command_db_statements" else c.METRICS_LATENCY_BUCKETS)
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def listen_to(self, engine):
+        event.listen(engine, "before_cursor_execute", self.__start_statement)
+        event.listen(engine, "after_cursor_execute", self.__finish_statement)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def summary(self):
+        """The human-readable version, for !stats"""
+        uptime = int(time.time() - self.started_at)
+        lines = ["Up for {}h {}m".format(uptime // 3600, uptime % 3600 // 60), "", "Commands (count, errors, p50, p99, statements/command):"]
+
+        with self.lock:
+            command_histograms = sorted([(dict(labels)["command"], histogram) for (name, labels), histogram in self.histograms.items() if name == "akrasia_command_duration_seconds"],
+                                        key=lambda command: command[1].count, reverse=True)
+            for command, histogram in command_histograms[:c.METRICS_SUMMARY_COMMANDS]:
+                statements = self.histogram("akrasia_command_db_statements", command=command)
+                lines.append("  {}: {}, {}, {}, {}, {}".format(command, histogram.count, self.counter("akrasia_command_errors_total", command=command),
+                                                               self.__format_seconds(histogram.quantile(0.5)), self.__format_seconds(histogram.quantile(0.99)),
+                                                               "{:.1f}".format(statements.sum / statements.count) if statements is not None and statements.count else "-"))
+            if len(command_histograms) == 0:
+                lines.append("  (none yet)")
+
+            statement_histograms = [histogram for (name, _), histogram in self.histograms.items() if name == "akrasia_db_statement_duration_seconds"]
+            n_statements = sum([histogram.count for histogram in statement_histograms])
+            lines.append("")
+            lines.append("Database: {} statements, {:.2f}s total".format(n_statements, sum([histogram.sum for histogram in statement_histograms])))
+
+            send_histogram = self.histogram("akrasia_outbound_send_duration_seconds")
+            n_send_errors = sum([count for (name, _), count in self.counters.items() if name == "akrasia_outbound_errors_total"])
+            lines.append("Outbound: {} sent ({} coalesced, {} rate limited, {} failed), p99 {}".format(
+                self.client.outbound_queue.n_sent, self.client.outbound_queue.n_coalesced, self.client.outbound_queue.n_rate_limited, n_send_errors,
+                self.__format_seconds(send_histogram.quantile(0.99) if send_histogram is not None else None)))
+
+            reminder_histogram = self.histogram("akrasia_reminder_loop_duration_seconds")
+            lines.append("Reminders: {} sent, {} failed, loop p99 {}".format(self.counter("akrasia_reminders_sent_total"), self.counter("akrasia_reminders_failed_total"),
+                                                                              self.__format_seconds(reminder_histogram.quantile(0.99) if reminder_histogram is not None else None)))
+
+            image_histogram = self.histogram("akrasia_image_fetch_duration_seconds")
+            lines.append("Images: {} fetched, {} failed, p99 {}".format(self.client.image_fetcher.n_fetched, self.client.image_fetcher.n_failed,
+                                                                      self.__format_seconds(image_histogram.quantile(0.99) if image_histogram is not None else None)))
+
+            render_histogram = self.histogram("akrasia_render_duration_seconds")
+            lines.append("Renders: {} in {} workers, p99 {}".format(self.client.render_pool.n_rendered, self.client.render_pool.n_workers,
+                                                                     self.__format_seconds(render_histogram.quantile(0.99) if render_histogram is not None else None)))
+
+            lag_histogram = self.histogram("akrasia_event_loop_lag_seconds")
+            n_stalls = sum([count for (name, _), count in self.counters.items() if name == "akrasia_event_loop_stalls_total"])
+            lines.append("Event loop: p99 lag {}, {} stalls (see !stats lag)".format(self.__format_seconds(lag_histogram.quantile(0.99) if lag_histogram is not None else None), n_stalls))
+
+        scheduler_stats = self.client.command_scheduler.stats()
+        lines.append("Scheduler: {} running, {} queued (max {}), {} dropped".format(scheduler_stats["running"], scheduler_stats["queued"], scheduler_stats["max_queued"], scheduler_stats["dropped"]))
+        hook_matcher = self.client.hook_matcher
+        lines.append("Hook prefilter: {} passed, {} rejected (pass rate {})".format(hook_matcher.prefilter_passed, hook_matcher.prefilter_rejected,
+                                                                                 "{:.1%}".format(hook_matcher.prefilter_hit_rate) if hook_matcher.prefilter_passed + hook_matcher.prefilter_rejected else "-"))
+        identity_cache_stats = self.client.identity_cache.stats()
+        lines.append("Identity cache: {}/{} rows, hit rate {}".format(identity_cache_stats["size"], identity_cache_stats["max_size"],
+                                                                     "{:.1%}".format(identity_cache_stats["hit_rate"]) if identity_cache_stats["hit_rate"] is not None else "-"))
+        avatar_cache_stats = self.client.avatar_cache.stats()
+        lines.append("Avatar cache: {}/{} in memory, {} files ({:.1f}/{:.1f} MB), hit rate {} ({} memory, {} disk, {} downloaded, {} shared)".format(
+            avatar_cache_stats["images"], avatar_cache_stats["max_images"], avatar_cache_stats["files"], avatar_cache_stats["disk_bytes"] / 10**6, avatar_cache_stats["max_disk_bytes"] / 10**6,
+            "{:.1%}".format(avatar_cache_stats["hit_rate"]) if avatar_cache_stats["hit_rate"] is not None else "-",
+            avatar_cache_stats["memory_hits"], avatar_cache_stats["disk_hits"], avatar_cache_stats["misses"], avatar_cache_stats["deduplicated"]))
+        quote_cache_stats = self.client.quote_cache.stats()
+        lines.append("Quote cache: {} quotes ({:.1f}/{:.1f} MB), hit rate {} ({} rendered, {} shared), {} invalidations".format(
+            quote_cache_stats["quotes"], quote_cache_stats["bytes"] / 10**6, quote_cache_stats["max_bytes"] / 10**6,
+            "{:.1%}".format(quote_cache_stats["hit_rate"]) if quote_cache_stats["hit_rate"] is not None else "-",
+            quote_cache_stats["misses"], quote_cache_stats["deduplicated"], quote_cache_stats["invalidations"]))
+        lines.append("Reaction events: {} registered".format(len(self.client.reaction_events)))
+        return "\n".join(lines)
+
+    def render(self):
+        """Every metric in Prometheus' text exposition format"""
+        lines = []
+        with self.lock:
+            for metric_name, (metric_type, metric_help) in METRIC_DESCRIPTIONS.items():
+                samples = self.histograms if metric_type == "histogram" else self.counters
+                metric_samples = [(labels, sample) for (name, labels), sample in samples.items() if name == metric_name]
+                if len(metric_samples) == 0:
+                    continue
+                lines.append("# HELP {} {}".format(metric_name, metric_help))
+                lines.append("# TYPE {} {}".format(metric_name, metric_type))
+                for labels, sample in metric_samples:
+                    if metric_type == "histogram":
+                        cumulative_count = 0
+                        for bucket, bucket_count in zip(list(sample.buckets) + ["+Inf"], sample.counts):
+                            cumulative_count += bucket_count
+                            lines.append("{}_bucket{} {}".format(metric_name, self.__format_labels(labels + (("le", bucket),)), cumulative_count))
+                        lines.append("{}_sum{} {}".format(metric_name, self.__format_labels(labels), sample.sum))
+                        lines.append("{}_count{} {}".format(metric_name, self.__format_labels(labels), sample.count))
+                    else:
+                        lines.append("{}{} {}".format(metric_name, self.__format_labels(labels), sample))
+
+        for metric_name, metric_type, metric_help, samples in self.__component_samples():
+            lines.append("# HELP {} {}".format(metric_name, metric_help))
+            lines.append("# TYPE {} {}".format(metric_name, metric_type))
+            for labels, value in samples:
+                lines.append("{}{} {}".format(metric_name, self.__format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host, port):
+        """Starts the HTTP endpoint; GET /metrics returns render()"""
+        app = web.Application()
+        app.router.add_get("/metrics", self.__handle_scrape)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        self.client.bot_log.info("Serving metrics on http://{}:{}/metrics".format(host, port))
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def __handle_scrape(self, _):
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+    def __component_samples(self):
+        """(name, type, help, [(labels, value)]) for the counters other components already keep"""
+        scheduler_stats = self.client.command_scheduler.stats()
+        identity_cache_stats = self.client.identity_cache.stats()
+        avatar_cache_stats = self.client.avatar_cache.stats()
+        quote_cache_stats = self.client.quote_cache.stats()
+        outbound_queue = self.client.outbound_queue
+        reaction_events = self.client.reaction_events
+        unit_of_work_totals = list(self.client.unit_of_work_stats.totals.items())
+        return [
+            ("akrasia_uptime_seconds", "gauge", "Seconds since the bot started", [((), round(time.time() - self.started_at, 3))]),
+            ("akrasia_scheduler_running_commands", "gauge", "Commands currently running", [((), scheduler_stats["running"])]),
+            ("akrasia_scheduler_queued_commands", "gauge", "Commands waiting to run, by priority class",
+             [((("priority", priority),), queued) for priority, queued in enumerate(scheduler_stats["queued_by_priority"])]),
+            ("akrasia_scheduler_submitted_total", "counter", "Commands submitted to the scheduler", [((), scheduler_stats["submitted"])]),
+            ("akrasia_scheduler_dropped_total", "counter", "Commands dropped because their guild's queue was full", [((), scheduler_stats["dropped"])]),
+            ("akrasia_outbound_sent_total", "counter", "Messages sent", [((), outbound_queue.n_sent)]),
+            ("akrasia_outbound_coalesced_total", "counter", "Sends merged into an earlier message", [((), outbound_queue.n_coalesced)]),
+            ("akrasia_outbound_rate_limited_total", "counter", "Sends retried after a 429", [((), outbound_queue.n_rate_limited)]),
+            ("akrasia_outbound_pending_destinations", "gauge", "Destinations with messages waiting to be sent", [((), len(outbound_queue.pending))]),
+            ("akrasia_hook_prefilter_total", "counter", "Messages checked by the hook prefilter, by whether they could match a hook",
+             [((("result", "passed"),), self.client.hook_matcher.prefilter_passed), ((("result", "rejected"),), self.client.hook_matcher.prefilter_rejected)]),
+            ("akrasia_identity_cache_rows", "gauge", "Rows in the identity cache", [((), identity_cache_stats["size"])]),
+            ("akrasia_identity_cache_hits_total", "counter", "Identity cache lookups that avoided a SELECT", [((), identity_cache_stats["hits"])]),
+            ("akrasia_identity_cache_misses_total", "counter", "Identity cache lookups that had to SELECT", [((), identity_cache_stats["misses"])]),
+            ("akrasia_identity_cache_evictions_total", "counter", "Rows evicted from the identity cache", [((), identity_cache_stats["evictions"])]),
+            ("akrasia_avatar_cache_images", "gauge", "Cropped avatars kept in memory", [((), avatar_cache_stats["images"])]),
+            ("akrasia_avatar_cache_disk_bytes", "gauge", "Size of the cropped avatars saved on disk", [((), avatar_cache_stats["disk_bytes"])]),
+            ("akrasia_avatar_cache_hits_total", "counter", "Avatars found in the cache, by tier",
+             [((("tier", "memory"),), avatar_cache_stats["memory_hits"]), ((("tier", "disk"),), avatar_cache_stats["disk_hits"])]),
+            ("akrasia_avatar_cache_misses_total", "counter", "Avatars that had to be downloaded", [((), avatar_cache_stats["misses"])]),
+            ("akrasia_avatar_cache_deduplicated_total", "counter", "Avatar requests that shared a download already in flight", [((), avatar_cache_stats["deduplicated"])]),
+            ("akrasia_avatar_cache_evictions_total", "counter", "Avatars evicted from the cache, by tier",
+             [((("tier", "memory"),), avatar_cache_stats["memory_evictions"]), ((("tier", "disk"),), avatar_cache_stats["disk_evictions"])]),
+            ("akrasia_quote_cache_quotes", "gauge", "Rendered quotes kept in memory", [((), quote_cache_stats["quotes"])]),
+            ("akrasia_quote_cache_bytes", "gauge", "Size of the rendered quotes kept in memory", [((), quote_cache_stats["bytes"])]),
+            ("akrasia_quote_cache_hits_total", "counter", "Quotes found already rendered", [((), quote_cache_stats["hits"])]),
+            ("akrasia_quote_cache_misses_total", "counter", "Quotes that had to be rendered", [((), quote_cache_stats["misses"])]),
+            ("akrasia_quote_cache_deduplicated_total", "counter", "Quote requests that shared a render already in flight", [((), quote_cache_stats["deduplicated"])]),
+            ("akrasia_quote_cache_evictions_total", "counter", "Rendered quotes evicted from the cache", [((), quote_cache_stats["evictions"])]),
+            ("akrasia_quote_cache_invalidations_total", "counter", "Times the cache was emptied because the render settings changed", [((), quote_cache_stats["invalidations"])]),
+            ("akrasia_reaction_events", "gauge", "Reaction events registered", [((), len(reaction_events))]),
+            ("akrasia_reaction_events_expired_total", "counter", "Reaction events that expired", [((), reaction_events.n_expired)]),
+            ("akrasia_unit_of_work_commits_total", "counter", "Commits, by command or hook",
+             [((("name", name),), commits) for name, (_, _, commits) in unit_of_work_totals])
+        ]
+
+    def __start_statement(self, connection, _, __, ___, ____, _____):
+        connection.info.setdefault(STATEMENT_START_TIMES_KEY, []).append(time.perf_counter())
+
+    def __finish_statement(self, connection, _, statement, __, ___, ____):
+        start_time = connection.info[STATEMENT_START_TIMES_KEY].pop()
+        statement_kind = statement.lstrip()[:6].lower()
+        self.observe("akrasia_db_statement_duration_seconds", time.perf_counter() - start_time,
+                     kind=statement_kind if statement_kind in ("select", "insert", "update", "delete") else "other")
+
+    @staticmethod
+    def __format_labels(labels):
+        if len(labels) == 0:
+            return ""
+        return "{" + ",".join(["{}=\"{}\"".format(label, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for label, value in labels]) + "}"
+
+    @staticmethod
+    def __format_seconds(seconds):
+        if seconds is None:
+            return "-"
+        return "{:.0f}ms".format(seconds * 1000) if seconds < 10 else "{:.1f}s".format(seconds)
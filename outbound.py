@@ -0,0 +1,90 @@
+import constants as c
+
+from asyncio import ensure_future, gather, get_event_loop, sleep
+from collections import deque
+from discord import HTTPException, Member, User
+from message_utils import split_lines
+from time import perf_counter
+
+
+class OutboundQueue:
+    """Sends the bot's messages through one queue per destination (channel, or user for DMs), in order and as fast as Discord allows
+
+    discord.py already waits out each rate-limit bucket using the X-RateLimit headers on every response, so messages are sent
+    back-to-back instead of sleeping a fixed time between them. If Discord still answers with a 429 after discord.py's own
+    retries, the send is tried again after the response's Retry-After. Plain text queued behind a send that's in flight is
+    coalesced into as few messages as fit under the length limit."""
+    def __init__(self, metrics=None):
+        self.metrics = metrics # send latencies and errors are recorded here, if given
+        self.pending = {} # destination id -> deque of [content, kwargs, coalesce, futures] waiting to be sent
+        self.senders = {} # destination id -> task working through that destination's queue
+        self.n_sent = 0
+        self.n_coalesced = 0 # sends that were merged into an earlier message instead of being sent on their own
+        self.n_rate_limited = 0
+
+    def enqueue(self, destination, content=None, coalesce=True, **kwargs):
+        """Queues a message and returns a future for the discord.Message it ends up in; coalesce=False always sends it on its own"""
+        future = get_event_loop().create_future()
+        destination_pending = self.pending.get(destination.id)
+        if destination_pending is None:
+            destination_pending = self.pending[destination.id] = deque()
+
+        coalesce = coalesce and content is not None and len(kwargs) == 0 # anything with files or embeds goes out as-is
+        if coalesce and len(destination_pending) and destination_pending[-1][2]:
+            last_send = destination_pending[-1]
+            coalesced_content = last_send[0].rstrip("\n") + "\n" + content
+            if len(coalesced_content) <= c.MAX_CHARS_PER_MESSAGE:
+                last_send[0] = coalesced_content
+                last_send[3].append(future)
+                self.n_coalesced += 1
+                return future
+        destination_pending.append([content, kwargs, coalesce, [future]])
+
+        if destination.id not in self.senders:
+            self.senders[destination.id] = ensure_future(self.__deliver(destination.id, destination))
+        return future
+
+    async def send(self, destination, content=None, coalesce=True, **kwargs):
+        return await self.enqueue(destination, content, coalesce, **kwargs)
+
+    async def send_lines(self, recipient, lines, code_mode=False):
+        if isinstance(recipient, (User, Member)) and recipient.bot: # can't DM bots
+            return
+        await gather(*[self.enqueue(recipient, message) for message in split_lines(lines, code_mode)])
+
+    async def __deliver(self, destination_id, destination):
+        destination_pending = self.pending[destination_id]
+        while len(destination_pending):
+            content, kwargs, _, futures = destination_pending.popleft()
+            start_time = perf_counter()
+            try:
+                sent_message = await self.__send(destination, content, kwargs)
+            except Exception as e:
+                if self.metrics is not None:
+                    self.metrics.increment("akrasia_outbound_errors_total", status=getattr(e, "status", "none"))
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                if self.metrics is not None:
+                    self.metrics.observe("akrasia_outbound_send_duration_seconds", perf_counter() - start_time)
+                for future in futures:
+                    if not future.done():
+                        future.set_result(sent_message)
+
+        del self.pending[destination_id]
+        del self.senders[destination_id]
+
+    async def __send(self, destination, content, kwargs):
+        retries_left = 0 if "file" in kwargs or "files" in kwargs else c.OUTBOUND_MAX_RETRIES # a file's been read by the first attempt, so it can't be resent
+        while True:
+            try:
+                sent_message = await destination.send(content, **kwargs)
+                self.n_sent += 1
+                return sent_message
+            except HTTPException as e:
+                if e.status != 429 or retries_left == 0:
+                    raise
+                retries_left -= 1
+                self.n_rate_limited += 1
+                await sleep(float(e.response.headers.get("Retry-After", c.OUTBOUND_DEFAULT_RETRY_AFTER)))
@@ -0,0 +1,138 @@
+import constants as c
+import os
+import sys
+
+from asyncio import current_task, get_event_loop
+from collections import Counter
+from datetime import datetime as dt
+from threading import Lock, Thread, get_ident
+from time import sleep
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class CommandProfile:
+    __slots__ = ("task", "samples")
+
+    def __init__(self, task):
+        self.task = task
+        self.samples = Counter() # collapsed stack -> times it was seen
+
+
+class CommandProfiler:
+    """Samples the stacks of chosen commands while they run, and saves the slow ones as collapsed stacks (for flamegraph.pl, speedscope, etc.)
+
+    A command is profiled if its keyword is in commands, its guild is in guild_ids, or (when latency_threshold is set) if it
+    turns out to be slower than that. While anything is being profiled, a thread looks at the event loop every sample_interval
+    seconds: a profiled command that's running has its stack recorded, and one that's waiting (on the database thread, Discord,
+    a sleep...) has the chain of awaits it's suspended in recorded instead, ending in "(waiting)". With everything turned off,
+    handle_command only checks the enabled property, and the sampling thread isn't running at all."""
+    def __init__(self, commands=(), guild_ids=(), latency_threshold=0, sample_interval=c.PROFILE_SAMPLE_INTERVAL, profile_dir=c.PROFILE_DIR, max_profiles=c.MAX_PROFILES):
+        self.commands = set(commands)
+        self.guild_ids = set(guild_ids)
+        self.latency_threshold = latency_threshold # seconds; 0 to only profile the chosen commands and guilds
+        self.sample_interval = sample_interval
+        self.profile_dir = profile_dir
+        self.max_profiles = max_profiles # older profiles are deleted past this
+        self.profiles = {} # task -> CommandProfile, for every command being profiled right now
+        self.loop = None
+        self.loop_thread_id = None
+        self.thread = None
+        self.thread_lock = Lock() # so a profile can't be started just as the sampling thread decides there's nothing left to do
+
+    @property
+    def enabled(self):
+        return len(self.commands) > 0 or len(self.guild_ids) > 0 or self.latency_threshold > 0
+
+    def start(self):
+        """Starts sampling the current task; returns its profile, to be given to finish()"""
+        task = current_task()
+        with self.thread_lock:
+            profile = self.profiles[task] = CommandProfile(task)
+            if self.thread is None:
+                self.loop = get_event_loop()
+                self.loop_thread_id = get_ident()
+                self.thread = Thread(target=self.__sample, name="akrasia-profiler", daemon=True)
+                self.thread.start()
+        return profile
+
+    async def finish(self, profile, keyword, guild_id, duration):
+        """Stops sampling; saves the profile and returns its file name if the command was one we wanted (None otherwise)"""
+        self.profiles.pop(profile.task, None)
+        wanted = keyword in self.commands or guild_id in self.guild_ids or (self.latency_threshold > 0 and duration >= self.latency_threshold)
+        if not wanted or len(profile.samples) == 0:
+            return None
+
+        profile_name = "{}_{}_{}_{}ms.collapsed".format(dt.now().strftime("%Y%m%d-%H%M%S-%f"), keyword.replace(" ", "-"), guild_id, int(duration * 1000))
+        await get_event_loop().run_in_executor(None, self.__save, profile_name, profile.samples)
+        return profile_name
+
+    def list_profiles(self):
+        """Returns the saved profiles' file names, newest first"""
+        if not os.path.exists(self.profile_dir):
+            return []
+        return sorted([file_name for file_name in os.listdir(self.profile_dir) if file_name.endswith(".collapsed")], reverse=True)
+
+    def profile_path(self, profile_name):
+        if os.path.basename(profile_name) != profile_name or profile_name not in self.list_profiles(): # nothing outside the profile directory
+            return None
+        return os.path.join(self.profile_dir, profile_name)
+
+    def __save(self, profile_name, samples):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        with open(os.path.join(self.profile_dir, profile_name), "w") as profile_file:
+            for stack, count in samples.most_common():
+                profile_file.write("{} {}\n".format(stack, count))
+
+        for old_profile_name in self.list_profiles()[self.max_profiles:]:
+            try:
+                os.remove(os.path.join(self.profile_dir, old_profile_name))
+            except OSError: # already gone
+                pass
+
+    def __sample(self):
+        while True:
+            with self.thread_lock:
+                if len(self.profiles) == 0:
+                    self.thread = None # the next start() makes a new one
+                    return
+
+            running_task = current_task(self.loop)
+            for task, profile in list(self.profiles.items()):
+                try:
+                    stack = self.__running_stack(task) if task is running_task else self.__waiting_stack(task)
+                except (AttributeError, ValueError): # the task moved on while we were looking at it
+                    continue
+                if stack:
+                    profile.samples[stack] += 1
+            sleep(self.sample_interval)
+
+    def __running_stack(self, task):
+        root_frame = task.get_coro().cr_frame
+        frame = sys._current_frames().get(self.loop_thread_id)
+        frames = []
+        while frame is not None:
+            frames.append(frame)
+            if frame is root_frame: # everything above this is asyncio's own machinery
+                break
+            frame = frame.f_back
+        if frame is None: # the task stopped running between us checking and looking at the stack
+            return None
+        return ";".join([self.__frame_name(frame) for frame in reversed(frames)])
+
+    def __waiting_stack(self, task):
+        frames = []
+        awaiting = task.get_coro()
+        while getattr(awaiting, "cr_frame", None) is not None: # follow the chain of awaits down to whatever's actually pending
+            frames.append(awaiting.cr_frame)
+            awaiting = awaiting.cr_await
+        return ";".join([self.__frame_name(frame) for frame in frames] + ["(waiting)"]) if frames else None
+
+    @staticmethod
+    def __frame_name(frame):
+        file_name = frame.f_code.co_filename
+        if file_name.startswith(SOURCE_DIR):
+            file_name = os.path.relpath(file_name, SOURCE_DIR)
+        else:
+            file_name = os.path.basename(file_name)
+        return "{}:{}".format(file_name, frame.f_code.co_name)
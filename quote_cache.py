@@ -0,0 +1,123 @@
+import constants as c
+import hashlib
+import os
+
+from asyncio import get_event_loop, shield
+from collections import OrderedDict
+
+
+class QuoteCache:
+    """Rendered quotes (PNG bytes, and the link they were uploaded to, if they were) by content key, so a repeat is instant
+
+    Keys are whatever identifies everything a quote shows (see quotes.get_quote_key). The current render settings version
+    is mixed into every key, and a change in it (any constant named in c.QUOTE_RENDER_SETTINGS, or the contents of a file
+    named in c.QUOTE_RENDER_FILES) empties the cache. Entries are dropped least recently used first once they add up to
+    more than max_bytes. Concurrent requests for the same key share one render."""
+    def __init__(self, max_bytes=c.QUOTE_CACHE_BYTES):
+        self.max_bytes = max_bytes # 0 turns the cache off
+        self.entries = OrderedDict() # key -> [PNG bytes, uploaded link or None], least recently used first
+        self.n_bytes = 0
+        self.pending = {} # key -> future for a quote that's being rendered right now
+        self.version = None
+        self.file_digests = {} # path -> ((modification time, size), digest), so the files are only read again when they change
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0 # requests that waited on another request's render instead of starting their own
+        self.evictions = 0
+        self.invalidations = 0
+
+    async def get(self, key, render):
+        """Returns the cached PNG bytes for key, or awaits render() for them (and caches them, unless they're None)"""
+        key = self.__versioned(key)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+        pending_render = self.pending.get(key)
+        if pending_render is not None:
+            self.deduplicated += 1
+            return await shield(pending_render) # so this request being cancelled doesn't cancel the render for everyone else
+
+        self.misses += 1
+        pending_render = self.pending[key] = get_event_loop().create_future()
+        try:
+            quote_png = await render()
+        except Exception as e:
+            pending_render.set_exception(e)
+            pending_render.exception() # retrieved here, so nobody waiting on it is fine too
+            raise
+        else:
+            pending_render.set_result(quote_png)
+        finally:
+            if not pending_render.done(): # this request was cancelled (CancelledError isn't an Exception); don't leave the others waiting forever
+                pending_render.cancel()
+            del self.pending[key]
+
+        if quote_png is not None and 0 < len(quote_png) <= self.max_bytes:
+            self.entries[key] = [quote_png, None]
+            self.n_bytes += len(quote_png)
+            while self.n_bytes > self.max_bytes:
+                _, (evicted_png, _) = self.entries.popitem(last=False)
+                self.n_bytes -= len(evicted_png)
+                self.evictions += 1
+        return quote_png
+
+    def get_link(self, key):
+        """The link the quote for key was uploaded to, if it's cached and was uploaded (which counts as a hit)"""
+        key = self.__versioned(key)
+        entry = self.entries.get(key)
+        if entry is None or entry[1] is None:
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set_link(self, key, link):
+        entry = self.entries.get(self.__versioned(key))
+        if entry is not None:
+            entry[1] = link
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "quotes": len(self.entries),
+            "bytes": self.n_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "deduplicated": self.deduplicated,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else None
+        }
+
+    def render_settings_version(self):
+        """A digest of every constant and file that changes how a quote looks"""
+        settings_hash = hashlib.sha256(repr([(name, getattr(c, name)) for name in c.QUOTE_RENDER_SETTINGS]).encode())
+        for name in c.QUOTE_RENDER_FILES:
+            settings_hash.update(self.__file_digest(getattr(c, name)))
+        return settings_hash.hexdigest()
+
+    def __versioned(self, key):
+        version = self.render_settings_version()
+        if version != self.version:
+            if self.version is not None:
+                self.invalidations += 1
+            self.entries.clear()
+            self.n_bytes = 0
+            self.version = version
+        return "{}:{}".format(version, key) # so a render that started under the old settings can't be found under the new ones
+
+    def __file_digest(self, path):
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            return b"missing"
+        file_version = (file_stat.st_mtime, file_stat.st_size)
+        cached_digest = self.file_digests.get(path)
+        if cached_digest is None or cached_digest[0] != file_version:
+            with open(path, "rb") as render_file:
+                cached_digest = self.file_digests[path] = (file_version, hashlib.sha256(render_file.read()).digest())
+        return cached_digest[1]
@@ -1,46 +1,194 @@
+import constants as c
+import json
+import os
+import time
+
+from asyncio import sleep
+from collections import OrderedDict
+from importlib import import_module
+
+
 class BasicReactionEvent:
-    def __init__(self, message, emoji_names, callback, allowed_users=None, one_time=False, uses=-1):
-        if allowed_users is None:
-            allowed_users = []
+    """Calls callback(user, channel, emoji_name) when one of emoji_names is added to a message
 
-        self.message = message
-        self.allowed_users = allowed_users
-        if one_time:
-            self.uses = 1
-        else:
-            self.uses = uses
+    Only the message's and channel's IDs are kept, not the message itself, so a registered event stays small."""
+    __slots__ = ("message_id", "channel_id", "allowed_users", "uses", "responses", "expires_at", "persistent")
+
+    def __init__(self, message, emoji_names, callback, allowed_users=None, one_time=False, uses=-1):
+        self.message_id = message.id
+        self.channel_id = message.channel.id
+        self.allowed_users = frozenset(allowed_users) if allowed_users is not None else frozenset() # user IDs; empty means anyone
+        self.uses = 1 if one_time else uses # -1 for unlimited (until the event expires)
+        self.responses = {emoji_name: callback for emoji_name in emoji_names}
+        self.expires_at = None # set by ReactionEventRegistry.register()
+        self.persistent = False
 
-        self.responses = {}
-        for emoji_name in emoji_names:
-            self.responses[emoji_name] = callback
+    @classmethod
+    def from_ids(cls, message_id, channel_id, responses, allowed_users=None, uses=-1):
+        """Rebuilds an event without the message it was made for (e.g. when loading saved events)"""
+        event = cls.__new__(cls)
+        event.message_id = message_id
+        event.channel_id = channel_id
+        event.allowed_users = frozenset(allowed_users) if allowed_users is not None else frozenset()
+        event.uses = uses
+        event.responses = responses
+        event.expires_at = None
+        event.persistent = False
+        return event
 
     @property
     def universal(self):
         return len(self.allowed_users) == 0
 
 
-class ReactionEvent:
+class ReactionEvent(BasicReactionEvent):
+    __slots__ = ()
+
     def __init__(self, *args, allowed_users=None, one_time=False, uses=-1): # *args will either be (message, emoji_name, callback) or (message, response_dict)
-        if allowed_users is None:
-            allowed_users = []
-        if len(args) < 2 or len(args) > 3:
+        if len(args) == 2 and isinstance(args[1], dict):
+            super().__init__(args[0], [], None, allowed_users, one_time, uses)
+            self.responses = dict(args[1]) # a response dict of {emoji_name: callback}
+        elif len(args) == 3:
+            super().__init__(args[0], [args[1]], args[2], allowed_users, one_time, uses)
+        else:
             raise TypeError("ReactionEvent constructors must have either (message, emoji_name, callback) or (message, response_dict) arguments!")
 
-        self.message = args[0]
-        if len(args) == 2:
-            if args[1] is dict:
-                self.responses = args[1]
-            else:
-                raise TypeError("ReactionEvent constructors must have either (message, emoji_name, callback) or (message, response_dict) arguments!")
-        else:
-            self.responses = {args[1]: args[2]} # a response dict of {emoji_name: callback}
 
-        self.allowed_users = allowed_users
-        if one_time:
-            self.uses = 1
-        else:
-            self.uses = uses
+class ReactionEventRegistry:
+    """Every live reaction event, keyed by message ID
 
-    @property
-    def universal(self):
-        return len(self.allowed_users) == 0
+    Events expire after ttl seconds (unless registered with ttl=0) and are swept out by sweep_loop; past max_size, the least
+    recently used event is dropped to make room. Persistent events (whose callbacks must be module-level functions) are saved
+    to persist_path and restored on startup, so they keep working across restarts."""
+    def __init__(self, ttl=c.REACTION_EVENT_TTL, max_size=c.MAX_REACTION_EVENTS, persist_path=c.REACTION_EVENTS_PATH):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.persist_path = persist_path
+        self.events = OrderedDict() # message id -> event, least recently used first
+        self.persistent_changed = False # whether there's anything new to save
+        self.n_expired = 0
+        self.n_evicted = 0
+
+    def __len__(self):
+        return len(self.events)
+
+    def register(self, event, ttl=None, persist=False):
+        ttl = self.ttl if ttl is None else ttl
+        if persist:
+            for callback in event.responses.values():
+                self.__callback_name(callback) # raises if it couldn't be found again after a restart
+        event.expires_at = time.time() + ttl if ttl > 0 else None
+        event.persistent = persist
+
+        self.events[event.message_id] = event
+        self.events.move_to_end(event.message_id)
+        while len(self.events) > self.max_size:
+            _, evicted_event = self.events.popitem(last=False)
+            self.n_evicted += 1
+            self.persistent_changed = self.persistent_changed or evicted_event.persistent
+        self.persistent_changed = self.persistent_changed or persist
+
+    def get(self, message_id, now=None):
+        event = self.events.get(message_id)
+        if event is None:
+            return None
+        if event.expires_at is not None and event.expires_at <= (now if now is not None else time.time()):
+            self.remove(message_id)
+            self.n_expired += 1
+            return None
+        self.events.move_to_end(message_id)
+        return event
+
+    def use(self, message_id):
+        """Counts one use of a message's event, removing it if that was its last; returns the number of uses left"""
+        event = self.events[message_id]
+        if event.uses > 0:
+            event.uses -= 1
+            if event.uses == 0:
+                self.remove(message_id)
+            elif event.persistent:
+                self.persistent_changed = True
+        return event.uses
+
+    def remove(self, message_id):
+        event = self.events.pop(message_id, None)
+        if event is not None and event.persistent:
+            self.persistent_changed = True
+
+    def sweep(self, now=None):
+        """Removes every expired event; returns how many there were"""
+        now = now if now is not None else time.time()
+        expired_ids = [message_id for message_id, event in self.events.items() if event.expires_at is not None and event.expires_at <= now]
+        for message_id in expired_ids:
+            self.remove(message_id)
+        self.n_expired += len(expired_ids)
+        return len(expired_ids)
+
+    async def sweep_loop(self, client):
+        while True:
+            await sleep(c.REACTION_EVENT_SWEEP_INTERVAL)
+            n_expired = self.sweep()
+            if n_expired > 0:
+                client.bot_log.info("Removed {} expired reaction events ({} still registered)".format(n_expired, len(self.events)))
+            if self.persistent_changed:
+                self.save(client)
+
+    def save(self, client):
+        saved_events = [{
+            "message_id": event.message_id,
+            "channel_id": event.channel_id,
+            "allowed_users": list(event.allowed_users),
+            "uses": event.uses,
+            "expires_at": event.expires_at,
+            "responses": {emoji_name: self.__callback_name(callback) for emoji_name, callback in event.responses.items()}
+        } for event in self.events.values() if event.persistent]
+
+        try:
+            with open(self.persist_path + ".tmp", "w") as events_file:
+                json.dump(saved_events, events_file)
+            os.replace(self.persist_path + ".tmp", self.persist_path) # so a crash mid-write can't leave half a file behind
+            self.persistent_changed = False
+        except Exception as e:
+            client.bot_log.error("Failed to save {} persistent reaction events; error was: {}".format(len(saved_events), e))
+
+    def load(self, client):
+        if not os.path.exists(self.persist_path):
+            return
+
+        try:
+            with open(self.persist_path) as events_file:
+                saved_events = json.load(events_file)
+        except Exception as e:
+            client.bot_log.error("Failed to load persistent reaction events; error was: {}".format(e))
+            return
+
+        now = time.time()
+        for saved_event in saved_events:
+            if saved_event["expires_at"] is not None and saved_event["expires_at"] <= now:
+                continue
+            try:
+                event = ReactionEvent.from_ids(saved_event["message_id"], saved_event["channel_id"],
+                                               {emoji_name: self.__find_callback(callback_name) for emoji_name, callback_name in saved_event["responses"].items()},
+                                               saved_event["allowed_users"], saved_event["uses"])
+            except Exception as e:
+                client.bot_log.warning("Dropped persistent reaction event on message {}; error was: {}".format(saved_event["message_id"], e))
+                continue
+            event.expires_at = saved_event["expires_at"]
+            event.persistent = True
+            self.events[event.message_id] = event
+        client.bot_log.info("Loaded {} persistent reaction events".format(len(self.events)))
+
+    @staticmethod
+    def __callback_name(callback):
+        callback_name = "{}:{}".format(getattr(callback, "__module__", None), getattr(callback, "__qualname__", None))
+        if "<" in callback_name or ReactionEventRegistry.__find_callback(callback_name) is not callback: # lambdas, closures and bound methods can't be found by name
+            raise ValueError("Reaction event callback {} can't be persisted; only module-level functions can".format(callback_name))
+        return callback_name
+
+    @staticmethod
+    def __find_callback(callback_name):
+        module_name, qualified_name = callback_name.split(":")
+        callback = import_module(module_name)
+        for name in qualified_name.split("."):
+            callback = getattr(callback, name)
+        return callback
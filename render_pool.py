@@ -0,0 +1,62 @@
+import constants as c
+
+from asyncio import Semaphore, get_event_loop
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from multiprocessing import get_context
+from time import perf_counter
+
+
+class RenderPool:
+    """Runs CPU-bound rendering (quote images) in worker processes, so PIL can't hold the GIL and stall the event loop
+
+    Functions and their arguments have to be picklable, so callers pass plain descriptions (names, timestamps, image bytes)
+    rather than discord.py objects. Workers are started on first use and run initializer once each, to load whatever every
+    render needs (fonts, masks) up front. At most max_pending renders can be queued up at once; anything past that waits
+    (asynchronously) for a free slot. With n_workers=0, renders run on the event loop thread instead."""
+    def __init__(self, n_workers=c.RENDER_WORKERS, max_pending=c.RENDER_MAX_PENDING, initializer=None, metrics=None):
+        self.n_workers = n_workers
+        self.max_pending = max_pending
+        self.initializer = initializer
+        self.metrics = metrics # render latencies (queueing included) are recorded here, if given
+        self.process_pool = None # made on first use, and again if a worker dies
+        self.pending_slots = None # made on first use, so it's bound to the loop the bot actually runs on
+        self.n_rendered = 0
+
+    async def run(self, function, *args, **kwargs):
+        if self.pending_slots is None:
+            self.pending_slots = Semaphore(self.max_pending)
+
+        start_time = perf_counter()
+        async with self.pending_slots:
+            if self.n_workers == 0:
+                result = function(*args, **kwargs)
+            else:
+                if self.process_pool is None:
+                    # spawn rather than fork: the bot has threads (database, audit log) that a forked child would inherit mid-operation
+                    self.process_pool = ProcessPoolExecutor(max_workers=self.n_workers, mp_context=get_context("spawn"), initializer=init_worker, initargs=(self.initializer,))
+                process_pool = self.process_pool
+                try:
+                    result = await get_event_loop().run_in_executor(process_pool, partial(function, *args, **kwargs))
+                except BrokenProcessPool: # a worker died (e.g. killed for memory); start fresh ones next time instead of failing forever
+                    process_pool.shutdown(wait=False, cancel_futures=True) # otherwise its management thread (and the other workers) linger
+                    if self.process_pool is process_pool: # a render that failed along with this one might've already replaced it
+                        self.process_pool = None
+                    raise
+
+        self.n_rendered += 1
+        if self.metrics is not None:
+            self.metrics.observe("akrasia_render_duration_seconds", perf_counter() - start_time)
+        return result
+
+    def shutdown(self):
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=True, cancel_futures=True)
+            self.process_pool = None
+
+
+def init_worker(initializer):
+    """Runs first in every worker; being in this module means constants is imported before anything that needs it (like a default module)"""
+    if initializer is not None:
+        initializer()
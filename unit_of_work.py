@@ -0,0 +1,95 @@
+from sqlalchemy import event
+
+
+class UnitOfWork:
+    """All of one command's (or hook's) database work: one session, committed once at the end, and only if it changed something
+
+    Handlers shouldn't commit the session themselves; anything they add or change goes out in the single commit at the end,
+    or not at all if they (or anything after them) failed. Statements and commits are counted per unit of work (see
+    UnitOfWorkStats.listen_to), so a command that starts committing more than once shows up in the logs."""
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name # what the unit of work is recorded under, e.g. the command keyword
+        self.session = client.db_session_builder()
+        self.session.info["unit_of_work"] = self
+        self.connections = [] # connections this unit of work's statements are counted on
+        self.n_statements = 0
+        self.n_writes = 0 # statements other than SELECTs
+        self.n_commits = 0
+
+    @property
+    def has_changes(self):
+        return self.n_writes > 0 or len(self.session.new) > 0 or len(self.session.dirty) > 0 or len(self.session.deleted) > 0
+
+    async def commit(self):
+        if self.has_changes:
+            await self.session.run(self.session.commit)
+        else: # nothing to write, so just end the (read-only) transaction
+            await self.session.run(self.session.rollback)
+
+    async def rollback(self):
+        await self.session.run(self.session.rollback)
+
+    def close(self):
+        self.session.close()
+        self.release_connections()
+        self.client.unit_of_work_stats.record(self)
+
+    def release_connections(self):
+        for connection in self.connections:
+            if connection.info.get("unit_of_work") is self:
+                del connection.info["unit_of_work"]
+        self.connections = []
+
+
+class UnitOfWorkStats:
+    def __init__(self, client):
+        self.client = client
+        self.totals = {} # unit of work name -> [units, statements, commits]
+
+    def record(self, unit_of_work):
+        totals = self.totals.setdefault(unit_of_work.name, [0, 0, 0])
+        totals[0] += 1
+        totals[1] += unit_of_work.n_statements
+        totals[2] += unit_of_work.n_commits
+        if unit_of_work.n_commits > 1:
+            self.client.bot_log.warning("{} committed {} times in one unit of work ({} statements); it should commit once, at the end".format(unit_of_work.name, unit_of_work.n_commits, unit_of_work.n_statements))
+
+    def averages(self):
+        """Returns {name: (units, statements per unit, commits per unit)}"""
+        return {name: (units, statements / units, commits / units) for name, (units, statements, commits) in self.totals.items()}
+
+    @staticmethod
+    def listen_to(engine, session_builder):
+        event.listen(session_builder, "after_begin", UnitOfWorkStats.__track_connection)
+        event.listen(session_builder, "after_commit", UnitOfWorkStats.__count_commit)
+        event.listen(session_builder, "after_rollback", UnitOfWorkStats.__release_connections)
+        event.listen(engine, "before_cursor_execute", UnitOfWorkStats.__count_statement)
+
+    @staticmethod
+    def __track_connection(session, _, connection):
+        unit_of_work = session.info.get("unit_of_work")
+        if unit_of_work is not None:
+            connection.info["unit_of_work"] = unit_of_work
+            unit_of_work.connections.append(connection)
+
+    @staticmethod
+    def __count_commit(session):
+        unit_of_work = session.info.get("unit_of_work")
+        if unit_of_work is not None:
+            unit_of_work.n_commits += 1
+            unit_of_work.release_connections() # the connection goes back to the pool, where someone else might pick it up
+
+    @staticmethod
+    def __release_connections(session):
+        unit_of_work = session.info.get("unit_of_work")
+        if unit_of_work is not None:
+            unit_of_work.release_connections()
+
+    @staticmethod
+    def __count_statement(connection, _, statement, __, ___, ____):
+        unit_of_work = connection.info.get("unit_of_work")
+        if unit_of_work is not None:
+            unit_of_work.n_statements += 1
+            if not statement.lstrip()[:6].upper() == "SELECT":
+                unit_of_work.n_writes += 1